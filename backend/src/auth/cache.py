@@ -0,0 +1,73 @@
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from config import AUTH_TOKEN_CACHE_SIZE, AUTH_TOKEN_CACHE_TTL_SECONDS
+
+import metrics
+
+
+class TokenCache:
+    """
+    LRU-кэш access-токен -> (payload, Principal).
+
+    Повторный запрос с тем же токеном не проверяет подпись заново и не идёт в
+    базу. Запись удаляется при истечении exp токена, а также явно при изменении
+    пользователя; TTL страхует от изменений, сделанных другими воркерами.
+    """
+
+    def __init__(self, max_size: int = AUTH_TOKEN_CACHE_SIZE, ttl: float = AUTH_TOKEN_CACHE_TTL_SECONDS):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple[float, dict, object]]" = OrderedDict()
+        self._tokens_by_user: dict[int, set[str]] = {}
+        # Растёт при каждом сбросе: проверка, начатая до сброса, не попадёт в кэш
+        self.version = 0
+        self.hits = metrics.counter("auth_token_cache_hits_total", "Попадания в кэш токенов")
+        self.misses = metrics.counter("auth_token_cache_misses_total", "Промахи кэша токенов")
+        metrics.gauge("auth_token_cache_size", "Токены в кэше", func=lambda: len(self._entries))
+
+    def get(self, token: str) -> Optional[tuple[dict, object]]:
+        entry = self._entries.get(token)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                self._remove(token)
+            self.misses.inc()
+            return None
+        self._entries.move_to_end(token)
+        self.hits.inc()
+        return entry[1], entry[2]
+
+    def put(self, token: str, payload: dict, user, version: int):
+        if version != self.version:
+            return
+        lifetime = min(payload["exp"] - time.time(), self.ttl) if "exp" in payload else self.ttl
+        if lifetime <= 0:
+            return
+        self._entries[token] = (time.monotonic() + lifetime, payload, user)
+        self._entries.move_to_end(token)
+        self._tokens_by_user.setdefault(user.id, set()).add(token)
+        while len(self._entries) > self.max_size:
+            self._remove(next(iter(self._entries)))
+
+    def invalidate_user(self, user_id: int):
+        """Сброс всех токенов пользователя (вызывать при любом изменении строки users)"""
+        self.version += 1
+        for token in self._tokens_by_user.pop(user_id, ()):
+            self._entries.pop(token, None)
+
+    def clear(self):
+        self.version += 1
+        self._entries.clear()
+        self._tokens_by_user.clear()
+
+    def _remove(self, token: str):
+        _, _, user = self._entries.pop(token)
+        tokens = self._tokens_by_user.get(user.id)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._tokens_by_user[user.id]
+
+
+token_cache = TokenCache()
@@ -1,13 +1,16 @@
+from typing import Optional
+
 from auth.schemas import UserLogin, UserRegister, AuthResponse, UserInfo
 from auth.tables import User
+from auth.cache import token_cache
 from auth.utils import (create_access_token, create_refresh_token,
-                        decode_token, hash_password, verify_password, get_current_user)
+                        decode_token, hash_password, verify_and_update_password, get_current_principal,
+                        load_user_infos)
 from database import database
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Query, Response
+from sqlalchemy import select
 from starlette import status
 
-from groups.tables import Groups, UserGroups
-
 auth_router = APIRouter(prefix="/auth", tags=["auth"])
 
 
@@ -16,7 +19,8 @@ auth_router = APIRouter(prefix="/auth", tags=["auth"])
                   responses={
                       400: {"description": "Пароли не совпадают"},
                       403: {"description": "Разрешен доступ только для студентов УрФУ"},
-                      409: {"description": "Пользователь с таким email уже существует"}
+                      409: {"description": "Пользователь с таким email уже существует"},
+                      503: {"description": "Слишком много запросов на регистрацию, повторите позже"},
                   })
 async def register(user: UserRegister):
     if not str(user.email).endswith('@urfu.me'):
@@ -29,12 +33,12 @@ async def register(user: UserRegister):
     if existing:
         raise HTTPException(status_code=409, detail="Пользователь с таким email уже существует")
 
-    hashed_password = hash_password(user.password)
+    hashed_password = await hash_password(user.password)
     user_id = await database.execute(User.insert().values(email=user.email, hashed_password=hashed_password))
 
     return AuthResponse(message="Пользователь успешно зарегистрирован",
-                        access_token=create_access_token(str(user.email)),
-                        refresh_token=create_refresh_token(str(user.email)),
+                        access_token=create_access_token(str(user.email), user_id),
+                        refresh_token=create_refresh_token(str(user.email), user_id),
                         token_type="bearer",
                         user_id=user_id)
 
@@ -43,6 +47,7 @@ async def register(user: UserRegister):
                   response_model=AuthResponse,
                   responses={
                       401: {"description": "Неверный email или пароль"},
+                      503: {"description": "Слишком много запросов на вход, повторите позже"},
                   })
 async def login(user: UserLogin):
     email = user.email
@@ -52,12 +57,20 @@ async def login(user: UserLogin):
     if not existing_user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Неверный email или пароль")
 
-    if not verify_password(password, existing_user.hashed_password):
+    verified, new_hash = await verify_and_update_password(password, existing_user.hashed_password)
+    if not verified:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Неверный email или пароль")
 
+    if new_hash is not None:
+        # Хеш посчитан с прежней стоимостью bcrypt — сохраняем пересчитанный
+        await database.execute(User.update().where(User.c.id == existing_user.id).values(hashed_password=new_hash))
+        token_cache.invalidate_user(existing_user.id)
+
     return AuthResponse(message="Успешный вход в систему",
-                        access_token=create_access_token(str(user.email)),
-                        refresh_token=create_refresh_token(str(user.email)),
+                        access_token=create_access_token(
+                            str(user.email), existing_user.id, existing_user.token_version),
+                        refresh_token=create_refresh_token(
+                            str(user.email), existing_user.id, existing_user.token_version),
                         token_type="bearer",
                         user_id=existing_user.id)
 
@@ -81,6 +94,10 @@ async def login(user: UserLogin):
                                       "user_not_found": {
                                           "summary": "Пользователь не существует",
                                           "value": {"detail": "Пользователь не найден"},
+                                      },
+                                      "token_revoked": {
+                                          "summary": "Версия токена устарела",
+                                          "value": {"detail": "Токен отозван"},
                                       }
                                   }
                               }
@@ -106,16 +123,28 @@ async def refresh(refresh_token: str):
             detail="Токен не содержит информации о пользователе"
         )
 
-    existing_user = await database.fetch_one(User.select().where(User.c.email == email))
+    if "uid" in payload:
+        existing_user = await database.fetch_one(User.select().where(User.c.id == payload["uid"]))
+    else:
+        # Токен, выпущенный до появления claim "uid"
+        existing_user = await database.fetch_one(User.select().where(User.c.email == email))
     if not existing_user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Пользователь не найден"
         )
 
+    if "uid" in payload and payload.get("ver", 0) != existing_user.token_version:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Токен отозван"
+        )
+
     return AuthResponse(message="Токены успешно обновлены",
-                        access_token=create_access_token(str(email)),
-                        refresh_token=create_refresh_token(str(email)),
+                        access_token=create_access_token(
+                            str(existing_user.email), existing_user.id, existing_user.token_version),
+                        refresh_token=create_refresh_token(
+                            str(existing_user.email), existing_user.id, existing_user.token_version),
                         token_type="bearer",
                         user_id=existing_user.id)
 
@@ -124,25 +153,9 @@ user_router = APIRouter(prefix="/users", tags=["users"])
 
 
 @user_router.get("/me/", response_model=UserInfo, responses={401: {"description": "Неавторизованный доступ"}})
-async def get_user(current_user=Depends(get_current_user)):
-    user_id = current_user.id
-
-    creator_rows = await database.fetch_all(
-        query=Groups.select().with_only_columns(Groups.c.id).where(Groups.c.creator_id == user_id)
-    )
-    group_creator_ids = [row.id for row in creator_rows]
-
-    member_rows = await database.fetch_all(
-        query=UserGroups.select().with_only_columns(UserGroups.c.group_id).where(UserGroups.c.user_id == user_id)
-    )
-    group_member_ids = [row.group_id for row in member_rows]
-
-    return UserInfo(
-        email=current_user.email,
-        id=user_id,
-        group_creator_ids=group_creator_ids,
-        group_member_ids=group_member_ids,
-    )
+async def get_user(current_user=Depends(get_current_principal)):
+    [user_info] = await load_user_infos([current_user])
+    return user_info
 
 
 @user_router.get("/{user_id}/", response_model=UserInfo,
@@ -152,47 +165,29 @@ async def get_user_by_id(user_id: int):
     if not user:
         raise HTTPException(status_code=404, detail="Пользователь не найден")
 
-    creator_rows = await database.fetch_all(
-        query=Groups.select().with_only_columns(Groups.c.id).where(Groups.c.creator_id == user_id)
-    )
-    group_creator_ids = [row.id for row in creator_rows]
-
-    member_rows = await database.fetch_all(
-        query=UserGroups.select().with_only_columns(UserGroups.c.group_id).where(UserGroups.c.user_id == user_id)
-    )
-    group_member_ids = [row.group_id for row in member_rows]
-
-    return UserInfo(
-        email=user.email,
-        id=user.id,
-        group_creator_ids=group_creator_ids,
-        group_member_ids=group_member_ids,
-    )
+    [user_info] = await load_user_infos([user])
+    return user_info
 
 
 @user_router.get("/", response_model=list[UserInfo])
-async def get_all_users():
-    users = await database.fetch_all(User.select())
-    if not users:
-        return []
-
-    user_info_list = []
-    for user in users:
-        creator_rows = await database.fetch_all(
-            query=Groups.select().with_only_columns(Groups.c.id).where(Groups.c.creator_id == user.id)
-        )
-        group_creator_ids = [row.id for row in creator_rows]
-
-        member_rows = await database.fetch_all(
-            query=UserGroups.select().with_only_columns(UserGroups.c.group_id).where(UserGroups.c.user_id == user.id)
-        )
-        group_member_ids = [row.group_id for row in member_rows]
-
-        user_info_list.append(UserInfo(
-            email=user.email,
-            id=user.id,
-            group_creator_ids=group_creator_ids,
-            group_member_ids=group_member_ids,
-        ))
-
-    return user_info_list
+async def get_all_users(
+        response: Response,
+        after_id: Optional[int] = None,
+        limit: int = Query(100, ge=1, le=1000),
+        email_prefix: Optional[str] = None,
+):
+    """
+    Список пользователей по возрастанию id, постранично.
+    Если страница полная, в заголовке X-Next-Cursor приходит after_id следующей страницы.
+    email_prefix — фильтр по началу email без учёта регистра.
+    """
+    query = select(User.c.id, User.c.email)
+    if after_id is not None:
+        query = query.where(User.c.id > after_id)
+    if email_prefix:
+        query = query.where(User.c.email.istartswith(email_prefix, autoescape=True))
+    users = await database.fetch_all(query.order_by(User.c.id).limit(limit))
+
+    if len(users) == limit:
+        response.headers["X-Next-Cursor"] = str(users[-1].id)
+    return await load_user_infos(users)
@@ -1,11 +1,13 @@
 from database import metadata
-from sqlalchemy import Column, Integer, String, Table
+from sqlalchemy import Column, Integer, String, Table, text
 
 
 User = Table(
     "users",
     metadata,
     Column("id", Integer, primary_key=True),
-    Column("email", String, nullable=False),
+    Column("email", String, nullable=False, index=True),
     Column("hashed_password", String, nullable=False),
+    # Версия токенов: токены с другим значением claim "ver" недействительны
+    Column("token_version", Integer, nullable=False, server_default=text("0")),
 )
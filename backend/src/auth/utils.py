@@ -1,59 +1,124 @@
+import asyncio
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
+from typing import Optional
 
 import jwt
+from auth.cache import token_cache
+from auth.schemas import UserInfo
 from auth.tables import User
-from config import ACCESS_TOKEN_EXPIRE_DAYS, SECRET_KEY, ALGORITHM, REFRESH_TOKEN_EXPIRE_DAYS
+from config import (ACCESS_TOKEN_EXPIRE_DAYS, BCRYPT_ROUNDS, PASSWORD_HASH_QUEUE_SIZE, PASSWORD_HASH_WORKERS,
+                    SECRET_KEY, ALGORITHM, REFRESH_TOKEN_EXPIRE_DAYS)
 from database import database
 from fastapi import Depends, HTTPException
 from fastapi.security import (HTTPAuthorizationCredentials, HTTPBearer)
+from groups.tables import Groups, UserGroups
 from jwt import ExpiredSignatureError, PyJWTError
 from passlib.context import CryptContext
+from sqlalchemy import select
 from starlette import status
 
+import metrics
 
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
 security = HTTPBearer()
 
 
-def hash_password(password: str) -> str:
+class PasswordHasher:
     """
-    Хеширует пароль с помощью алгоритма SHA-256.
+    Выполняет bcrypt в отдельном пуле потоков, не блокируя цикл событий.
+
+    Одновременно в работе и в очереди не больше queue_size операций: при
+    переполнении запрос сразу получает 503, а не ждёт, пока разберутся
+    остальные. bcrypt отпускает GIL, поэтому потоки считают параллельно.
+    """
+
+    def __init__(self, workers: int = PASSWORD_HASH_WORKERS, queue_size: int = PASSWORD_HASH_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.pending = 0
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self.duration = metrics.histogram("auth_password_hash_seconds", "Время bcrypt-операции с ожиданием в очереди")
+        self.rejected = metrics.counter("auth_password_hash_rejected_total", "Запросы, отклонённые из-за очереди bcrypt")
+        metrics.gauge("auth_password_hash_pending", "bcrypt-операции в работе и в очереди", func=lambda: self.pending)
+
+    async def run(self, func, *args):
+        if self.pending >= self.queue_size:
+            self.rejected.inc()
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many authentication requests, try again later",
+                headers={"Retry-After": "1"},
+            )
+        self.pending += 1
+        try:
+            with self.duration.time():
+                return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        finally:
+            self.pending -= 1
+
+
+password_hasher = PasswordHasher()
+
+
+async def hash_password(password: str) -> str:
+    """
+    Хеширует пароль алгоритмом bcrypt в пуле password_hasher.
     :param password: исходный пароль
-    :return: шестнадцатеричный хеш
+    :return: хеш пароля
+    :raises HTTPException: 503, если очередь хеширования переполнена
     """
-    return pwd_context.hash(password)
+    return await password_hasher.run(pwd_context.hash, password)
 
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
     """
     Проверяет соответствие пароля и его хеша.
     :param plain_password: исходный пароль
     :param hashed_password: ранее сохранённый хеш
     :return: True, если пароль соответствует хешу
+    :raises HTTPException: 503, если очередь хеширования переполнена
+    """
+    return await password_hasher.run(pwd_context.verify, plain_password, hashed_password)
+
+
+async def verify_and_update_password(plain_password: str, hashed_password: str) -> tuple[bool, Optional[str]]:
+    """
+    Проверяет пароль и, если хеш посчитан с устаревшими параметрами, считает новый.
+    :param plain_password: исходный пароль
+    :param hashed_password: ранее сохранённый хеш
+    :return: (пароль верен, новый хеш или None, если обновлять не нужно)
+    :raises HTTPException: 503, если очередь хеширования переполнена
     """
-    return pwd_context.verify(plain_password, hashed_password)
+    return await password_hasher.run(pwd_context.verify_and_update, plain_password, hashed_password)
 
 
-def create_access_token(email: str) -> str:
+def create_access_token(email: str, user_id: int, token_version: int = 0) -> str:
     """
     Создаёт токен доступа с заданным сроком действия.
     :param email: адрес электронной почты пользователя
+    :param user_id: id пользователя (claim "uid")
+    :param token_version: users.token_version (claim "ver")
     :return: JWT-токен
     """
     expires_delta = timedelta(days=ACCESS_TOKEN_EXPIRE_DAYS)
-    to_encode = {"sub": email, "exp": datetime.now(timezone.utc) + expires_delta, "type": "access"}
+    to_encode = {"sub": email, "uid": user_id, "ver": token_version,
+                 "exp": datetime.now(timezone.utc) + expires_delta, "type": "access"}
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
 
-def create_refresh_token(email: str) -> str:
+def create_refresh_token(email: str, user_id: int, token_version: int = 0) -> str:
     """
     Создаёт токен обновления с заданным сроком действия.
     :param email: адрес электронной почты пользователя
+    :param user_id: id пользователя (claim "uid")
+    :param token_version: users.token_version (claim "ver")
     :return: JWT-токен
     """
     expires_delta = timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
-    to_encode = {"sub": email, "exp": datetime.now(timezone.utc) + expires_delta, "type": "refresh"}
+    to_encode = {"sub": email, "uid": user_id, "ver": token_version,
+                 "exp": datetime.now(timezone.utc) + expires_delta, "type": "refresh"}
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
 
@@ -77,7 +142,57 @@ def decode_token(token: str) -> dict:
         )
 
 
-async def get_user_by_token(access_token: str) -> User:
+class Principal:
+    """
+    Пользователь запроса, собранный из claims токена.
+
+    id и email берутся из токена, поэтому маршрутам, которым нужны только
+    они, строка users не нужна. Полная строка загружается по требованию через
+    load() и запоминается.
+    """
+
+    __slots__ = ("id", "email", "token_version", "_user")
+
+    def __init__(self, id: int, email: str, token_version: int = 0, user=None):
+        self.id = id
+        self.email = email
+        self.token_version = token_version
+        self._user = user
+
+    @classmethod
+    def from_user(cls, user) -> "Principal":
+        return cls(user.id, user.email, user.token_version, user)
+
+    async def load(self):
+        """
+        Строка users этого пользователя.
+        :raises HTTPException: если пользователь удалён
+        """
+        if self._user is None:
+            user = await database.fetch_one(User.select().where(User.c.id == self.id))
+            if not user:
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail="User not found"
+                )
+            self._user = user
+        return self._user
+
+
+async def get_principal_by_token(access_token: str) -> Principal:
+    """
+    Проверяет access-токен и возвращает Principal.
+
+    Токен с claims uid/ver проверяется по первичному ключу users (только
+    token_version); старые токены только с sub — поиском по email.
+    Проверенный токен кэшируется до своего exp.
+    """
+    # Уже проверенный токен: ни подписи, ни запроса к базе
+    cached = token_cache.get(access_token)
+    if cached is not None:
+        return cached[1]
+
+    version = token_cache.version
     payload = decode_token(access_token)
 
     if payload.get("type") != "access":
@@ -93,13 +208,49 @@ async def get_user_by_token(access_token: str) -> User:
             detail="Invalid token: missing email"
         )
 
-    user = await database.fetch_one(User.select().where(User.c.email == email))
-    if not user:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="User not found"
-        )
-    return user
+    if "uid" in payload:
+        token_version = await database.fetch_val(
+            select(User.c.token_version).where(User.c.id == payload["uid"]))
+        if token_version is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="User not found"
+            )
+        if token_version != payload.get("ver", 0):
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Token has been revoked"
+            )
+        principal = Principal(payload["uid"], email, token_version)
+    else:
+        user = await database.fetch_one(User.select().where(User.c.email == email))
+        if not user:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="User not found"
+            )
+        principal = Principal.from_user(user)
+
+    token_cache.put(access_token, payload, principal, version)
+    return principal
+
+
+async def get_user_by_token(access_token: str) -> User:
+    principal = await get_principal_by_token(access_token)
+    return await principal.load()
+
+
+async def get_current_principal(credentials: HTTPAuthorizationCredentials = Depends(security)) -> Principal:
+    """
+    Получает текущего пользователя из токена доступа без загрузки строки users.
+
+    :param credentials: Объект, содержащий заголовки авторизации,
+                        из которых извлекается токен.
+    :return: Principal с id и email пользователя.
+    :raises HTTPException: Если токен не является access-токеном, отозван или
+                            пользователь не найден в базе данных.
+    """
+    return await get_principal_by_token(credentials.credentials)
 
 
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
@@ -114,3 +265,40 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
     """
     token = credentials.credentials
     return await get_user_by_token(token)
+
+
+async def load_user_infos(users: list) -> list[UserInfo]:
+    """
+    Собирает UserInfo для списка пользователей: группы, созданные ими и в
+    которых они состоят, загружаются двумя запросами на весь список.
+    :param users: объекты с полями id и email (строки users, Principal)
+    :return: список UserInfo в том же порядке
+    """
+    if not users:
+        return []
+
+    user_ids = [user.id for user in users]
+
+    creator_rows = await database.fetch_all(
+        select(Groups.c.creator_id, Groups.c.id).where(Groups.c.creator_id.in_(user_ids))
+    )
+    group_creator_ids = defaultdict(list)
+    for row in creator_rows:
+        group_creator_ids[row.creator_id].append(row.id)
+
+    member_rows = await database.fetch_all(
+        select(UserGroups.c.user_id, UserGroups.c.group_id).where(UserGroups.c.user_id.in_(user_ids))
+    )
+    group_member_ids = defaultdict(list)
+    for row in member_rows:
+        group_member_ids[row.user_id].append(row.group_id)
+
+    return [
+        UserInfo(
+            email=user.email,
+            id=user.id,
+            group_creator_ids=group_creator_ids.get(user.id, []),
+            group_member_ids=group_member_ids.get(user.id, []),
+        )
+        for user in users
+    ]
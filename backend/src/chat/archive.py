@@ -0,0 +1,368 @@
+import asyncio
+import gzip
+import io
+import json
+import logging
+import re
+import time
+import zlib
+from collections import OrderedDict, deque
+from datetime import date, datetime
+from typing import Iterator, Optional
+
+from chat.tables import Message, MessageArchiveSegment
+from chat.utils import serialize_message, utc_now
+from config import (CHAT_ARCHIVE_AFTER_MONTHS, CHAT_ARCHIVE_BATCH_SIZE, CHAT_ARCHIVE_BUCKET,
+                    CHAT_ARCHIVE_INTERVAL_SECONDS, CHAT_ARCHIVE_SEGMENT_CACHE_SIZE, CHAT_PARTITION_PREMAKE_MONTHS)
+from database import database
+from sqlalchemy import func, select, text, tuple_
+from sqlalchemy.schema import CreateTable
+from storage import storage
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Ключ advisory-блокировки: обслуживанием секций занимается один воркер за раз
+MAINTENANCE_LOCK_ID = 0x6D736773
+PARTITION_NAME_RE = re.compile(r"messages_(\d{4})_(\d{2})")
+# Сколько секунд воркер доверяет закэшированной границе архива чата: сегменты,
+# выгруженные другим воркером, становятся видны не позже чем через столько
+ARCHIVE_BOUNDS_TTL_SECONDS = 60
+ARCHIVE_BOUNDS_CACHE_SIZE = 10000
+# Размер куска сжатого сегмента, который распаковывается за раз
+SEGMENT_DECODE_CHUNK_SIZE = 64 * 1024
+
+archived_segments = metrics.counter("chat_archive_segments_total", "Выгруженные в MinIO сегменты сообщений")
+archived_messages = metrics.counter("chat_archive_messages_total", "Выгруженные в MinIO сообщения")
+segment_reads = metrics.histogram("chat_archive_segment_read_seconds", "Загрузка сегмента архива из MinIO")
+
+
+def month_start(value: datetime) -> date:
+    return date(value.year, value.month, 1)
+
+
+def add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f"messages_{month:%Y_%m}"
+
+
+def partition_ddl(month: date) -> str:
+    return (
+        f"CREATE TABLE IF NOT EXISTS {partition_name(month)} PARTITION OF messages "
+        f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+    )
+
+
+def segment_key(chat_id: int, month: date) -> str:
+    return f"messages/{chat_id}/{month:%Y-%m}.ndjson.gz"
+
+
+def _iter_segment(body: bytes) -> Iterator[dict]:
+    """
+    Сообщения сжатого сегмента от старых к новым (created_at — datetime).
+    Распаковка идёт кусками, поэтому, прервав обход, вызывающий не платит
+    за разбор остатка сегмента.
+    """
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    tail = b""
+    for offset in range(0, len(body), SEGMENT_DECODE_CHUNK_SIZE):
+        lines = (tail + decompressor.decompress(body[offset:offset + SEGMENT_DECODE_CHUNK_SIZE])).split(b"\n")
+        tail = lines.pop()
+        for line in lines:
+            message = json.loads(line)
+            created_at = datetime.fromisoformat(message["created_at"])
+            yield {**message, "created_at": created_at, "updated_at": created_at}
+
+
+def _partition_months(first: date) -> list[date]:
+    """Месяцы от first до текущего плюс CHAT_PARTITION_PREMAKE_MONTHS вперёд"""
+    last = add_months(month_start(utc_now()), CHAT_PARTITION_PREMAKE_MONTHS)
+    months = []
+    while first <= last:
+        months.append(first)
+        first = add_months(first, 1)
+    return months
+
+
+def prepare_partitions(connection):
+    """
+    Миграция схемы: переводит несекционированную messages на секции и
+    создаёт секции на ближайшие месяцы.
+
+    Старая таблица переименовывается, её строки копируются в новую
+    секционированную таблицу, после чего она удаляется — всё в одной
+    транзакции. Всё это время messages заблокирована и для чтения, и для
+    записи, а длительность растёт с числом сообщений, поэтому перевод
+    большой базы нужно проводить в окно обслуживания. Новая таблица
+    создаётся без индексов: строки копируются быстрее, а индексы строит
+    следующий шаг миграций (9) по секциям, не блокируя запись.
+    """
+    partitioned = connection.execute(text(
+        "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'messages'::regclass)"
+    )).scalar()
+    # Прошлый месяц тоже: now() в базе может отставать от UTC
+    first = add_months(month_start(utc_now()), -1)
+
+    if not partitioned:
+        logger.info("Перевожу таблицу messages на помесячные секции...")
+        for statement in (
+                "ALTER TABLE messages RENAME TO messages_legacy",
+                "ALTER SEQUENCE IF EXISTS messages_id_seq RENAME TO messages_legacy_id_seq",
+                "ALTER INDEX IF EXISTS messages_pkey RENAME TO messages_legacy_pkey",
+                "ALTER INDEX IF EXISTS ix_messages_chat_id_created_at_id "
+                "RENAME TO ix_messages_legacy_chat_id_created_at_id",
+                "ALTER INDEX IF EXISTS ix_messages_text_tsv RENAME TO ix_messages_legacy_text_tsv",
+        ):
+            connection.execute(text(statement))
+        connection.execute(CreateTable(Message))
+
+        oldest = connection.execute(text("SELECT min(created_at) FROM messages_legacy")).scalar()
+        if oldest is not None:
+            first = min(first, month_start(oldest))
+        for month in _partition_months(first):
+            connection.execute(text(partition_ddl(month)))
+
+        connection.execute(text(
+            "INSERT INTO messages (id, chat_id, sender_id, text, created_at, updated_at) "
+            "SELECT id, chat_id, sender_id, text, created_at, updated_at FROM messages_legacy"
+        ))
+        connection.execute(text(
+            "SELECT setval(pg_get_serial_sequence('messages', 'id'), "
+            "COALESCE((SELECT max(id) FROM messages), 0) + 1, false)"
+        ))
+        connection.execute(text("DROP TABLE messages_legacy"))
+        logger.info("Таблица messages переведена на секции.")
+        return
+
+    for month in _partition_months(first):
+        connection.execute(text(partition_ddl(month)))
+
+
+class MessageArchive:
+    """
+    Холодное хранилище истории чатов.
+
+    Фоновая задача раз в interval секунд создаёт секции messages на
+    ближайшие месяцы, а секции старше archive_after месяцев выгружает в MinIO
+    (сегмент на чат и месяц, сжатый NDJSON от старых сообщений к новым),
+    записывает в message_archive_segments и удаляет. История дочитывается из
+    сегментов, когда курсор уходит старше данных в базе; последние
+    прочитанные сегменты держатся в памяти в сжатом виде. Начало архива
+    каждого чата кэшируется на ARCHIVE_BOUNDS_TTL_SECONDS, чтобы не ходить
+    в message_archive_segments за чатами без архива.
+    """
+
+    def __init__(self, archive_after: int = CHAT_ARCHIVE_AFTER_MONTHS, bucket: str = CHAT_ARCHIVE_BUCKET,
+                 interval: float = CHAT_ARCHIVE_INTERVAL_SECONDS, cache_size: int = CHAT_ARCHIVE_SEGMENT_CACHE_SIZE):
+        self.archive_after = archive_after
+        self.bucket = bucket
+        self.interval = interval
+        self.cache_size = cache_size
+        self._segments: "OrderedDict[str, bytes]" = OrderedDict()
+        # chat_id -> (момент устаревания, first_created_at самого старого сегмента или None)
+        self._bounds: "OrderedDict[int, tuple[float, Optional[datetime]]]" = OrderedDict()
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.maintain()
+            except Exception as e:
+                logger.error(f"Ошибка обслуживания секций messages: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def maintain(self):
+        """Создание будущих секций и архивация старых под advisory-блокировкой"""
+        async with database.connection():
+            locked = await database.fetch_val(
+                query="SELECT pg_try_advisory_lock(:lock_id)", values={"lock_id": MAINTENANCE_LOCK_ID})
+            if not locked:
+                return
+            try:
+                for month in _partition_months(add_months(month_start(utc_now()), -1)):
+                    await database.execute(partition_ddl(month))
+                if self.archive_after > 0:
+                    cutoff = add_months(month_start(utc_now()), -self.archive_after)
+                    for month in await self._partitions_before(cutoff):
+                        await self.archive_partition(month)
+            finally:
+                await database.fetch_val(
+                    query="SELECT pg_advisory_unlock(:lock_id)", values={"lock_id": MAINTENANCE_LOCK_ID})
+
+    @staticmethod
+    async def _partitions_before(cutoff: date) -> list[date]:
+        rows = await database.fetch_all(
+            "SELECT c.relname AS name FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = 'messages'::regclass"
+        )
+        months = []
+        for row in rows:
+            match = PARTITION_NAME_RE.fullmatch(row["name"])
+            if match:
+                month = date(int(match.group(1)), int(match.group(2)), 1)
+                if month < cutoff:
+                    months.append(month)
+        return sorted(months)
+
+    async def archive_partition(self, month: date):
+        """
+        Выгружает секцию месяца в MinIO по чатам и удаляет её.
+        Уже выгруженные чаты пропускаются, поэтому прерванную архивацию можно повторить.
+        """
+        in_month = (Message.c.created_at >= month, Message.c.created_at < add_months(month, 1))
+        chat_ids = [row["chat_id"] for row in await database.fetch_all(
+            select(Message.c.chat_id).where(*in_month).distinct())]
+        done = {row["chat_id"] for row in await database.fetch_all(
+            select(MessageArchiveSegment.c.chat_id).where(MessageArchiveSegment.c.month == month))}
+
+        for chat_id in chat_ids:
+            if chat_id in done:
+                continue
+            key = segment_key(chat_id, month)
+            segment = {"chat_id": chat_id, "month": month, "key": key, "message_count": 0}
+            await storage.upload_stream(self.bucket, key, self._segment_chunks(chat_id, in_month, segment),
+                                        ContentType="application/x-ndjson", ContentEncoding="gzip")
+            await database.execute(MessageArchiveSegment.insert().values(**segment))
+            self._bounds.pop(chat_id, None)
+            archived_segments.inc()
+            archived_messages.inc(segment["message_count"])
+
+        # Секция удаляется, только если в архиве все её сообщения
+        total = await database.fetch_val(select(func.count()).select_from(Message).where(*in_month))
+        saved = await database.fetch_val(
+            select(func.coalesce(func.sum(MessageArchiveSegment.c.message_count), 0))
+            .where(MessageArchiveSegment.c.month == month)
+        )
+        if total != saved:
+            logger.error(f"Секция {partition_name(month)} не удалена: в базе {total} сообщений, в архиве {saved}")
+            return
+        await database.execute(f"DROP TABLE IF EXISTS {partition_name(month)}")
+        logger.info(f"Секция {partition_name(month)} выгружена в архив и удалена.")
+
+    @staticmethod
+    async def _segment_chunks(chat_id: int, in_month: tuple, segment: dict):
+        """
+        Сжатый NDJSON сообщений чата за месяц, от старых к новым. Строки
+        читаются keyset-пачками по CHAT_ARCHIVE_BATCH_SIZE и сразу сжимаются,
+        в памяти держится одна пачка. Попутно заполняет в segment
+        message_count, min_id, max_id, first_created_at и last_created_at.
+        """
+        buffer = io.BytesIO()
+        compressor = gzip.GzipFile(fileobj=buffer, mode="wb")
+        query = select(Message).where(Message.c.chat_id == chat_id, *in_month)
+        after = None
+        while True:
+            page = query if after is None else query.where(tuple_(Message.c.created_at, Message.c.id) > after)
+            rows = await database.fetch_all(
+                page.order_by(Message.c.created_at, Message.c.id).limit(CHAT_ARCHIVE_BATCH_SIZE))
+            if not rows:
+                break
+            for row in rows:
+                compressor.write((json.dumps(serialize_message(row), ensure_ascii=False) + "\n").encode())
+            if segment["message_count"] == 0:
+                segment["first_created_at"] = rows[0]["created_at"]
+                segment["min_id"] = segment["max_id"] = rows[0]["id"]
+            segment["message_count"] += len(rows)
+            segment["min_id"] = min(segment["min_id"], *(row["id"] for row in rows))
+            segment["max_id"] = max(segment["max_id"], *(row["id"] for row in rows))
+            segment["last_created_at"] = rows[-1]["created_at"]
+            after = tuple_(rows[-1]["created_at"], rows[-1]["id"])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        compressor.close()
+        yield buffer.getvalue()
+
+    async def oldest_archived(self, chat_id: int) -> Optional[datetime]:
+        """Время самого старого архивного сообщения чата или None, если архива нет"""
+        now = time.monotonic()
+        cached = self._bounds.get(chat_id)
+        if cached is not None and cached[0] > now:
+            self._bounds.move_to_end(chat_id)
+            return cached[1]
+
+        oldest = await database.fetch_val(
+            select(func.min(MessageArchiveSegment.c.first_created_at))
+            .where(MessageArchiveSegment.c.chat_id == chat_id)
+        )
+        self._bounds[chat_id] = (now + ARCHIVE_BOUNDS_TTL_SECONDS, oldest)
+        self._bounds.move_to_end(chat_id)
+        while len(self._bounds) > ARCHIVE_BOUNDS_CACHE_SIZE:
+            self._bounds.popitem(last=False)
+        return oldest
+
+    async def has_messages_before(self, chat_id: int, before_ts: Optional[datetime]) -> bool:
+        """Может ли в архиве чата быть что-то старше before_ts (без before_ts — есть ли архив вообще)"""
+        oldest = await self.oldest_archived(chat_id)
+        return oldest is not None and (before_ts is None or oldest <= before_ts)
+
+    async def load_segment(self, key: str) -> bytes:
+        """Сжатое содержимое сегмента (разбирается через _iter_segment)"""
+        body = self._segments.get(key)
+        if body is not None:
+            self._segments.move_to_end(key)
+            return body
+
+        with segment_reads.time():
+            body = await storage.read_object(self.bucket, key)
+        self._segments[key] = body
+        while len(self._segments) > self.cache_size:
+            self._segments.popitem(last=False)
+        return body
+
+    async def fetch_before(self, chat_id: int, before_ts: Optional[datetime], before_id: Optional[int],
+                           limit: int) -> list[dict]:
+        """
+        Архивные сообщения чата строго старше позиции (before_ts, before_id),
+        от новых к старым. Без before_ts — начиная с самого нового архивного.
+        Сегмент читается от старых сообщений к новым и только до позиции;
+        в памяти держится не больше limit разобранных сообщений.
+        """
+        query = select(MessageArchiveSegment.c.key).where(MessageArchiveSegment.c.chat_id == chat_id)
+        if before_ts is not None:
+            query = query.where(MessageArchiveSegment.c.first_created_at <= before_ts)
+        query = query.order_by(MessageArchiveSegment.c.month.desc())
+
+        result = []
+        for segment in await database.fetch_all(query):
+            older = deque(maxlen=limit - len(result))
+            for message in _iter_segment(await self.load_segment(segment["key"])):
+                if before_ts is not None:
+                    if before_id is None and message["created_at"] >= before_ts:
+                        break
+                    if before_id is not None and (message["created_at"], message["id"]) >= (before_ts, before_id):
+                        break
+                older.append(message)
+            result.extend(reversed(older))
+            if len(result) == limit:
+                return result
+        return result
+
+    async def find_message(self, chat_id: int, message_id: int) -> Optional[dict]:
+        """Поиск архивного сообщения чата по id"""
+        query = select(MessageArchiveSegment.c.key).where(
+            MessageArchiveSegment.c.chat_id == chat_id,
+            MessageArchiveSegment.c.min_id <= message_id,
+            MessageArchiveSegment.c.max_id >= message_id,
+        )
+        for segment in await database.fetch_all(query):
+            for message in _iter_segment(await self.load_segment(segment["key"])):
+                if message["id"] == message_id:
+                    return message
+        return None
+
+
+message_archive = MessageArchive()
@@ -0,0 +1,170 @@
+import asyncio
+import json
+import logging
+from abc import ABC, abstractmethod
+from typing import Awaitable, Callable, Optional
+
+import asyncpg
+from sqlalchemy import select
+
+from chat.cache import chat_cache, recent_messages
+from chat.tables import Message
+from chat.utils import serialize_message
+from config import CHAT_BROADCAST_BACKEND, CHAT_NOTIFY_CHANNEL, POSTGRES_DSN
+from database import database
+
+logger = logging.getLogger(__name__)
+
+# Обработчик события: (chat_id, event) -> None
+EventHandler = Callable[[int, dict], Awaitable[None]]
+
+# Ограничение Postgres на размер payload в NOTIFY — 8000 байт
+NOTIFY_PAYLOAD_LIMIT = 7900
+# При write-behind сообщение по ссылке может ещё не быть записано
+MESSAGE_REF_RETRIES = 5
+MESSAGE_REF_RETRY_DELAY_SECONDS = 0.1
+RECONNECT_DELAY_SECONDS = 1.0
+RECONNECT_DELAY_MAX_SECONDS = 30.0
+
+
+class BroadcastBackend(ABC):
+    """
+    Канал доставки событий чатов (новые сообщения и т.п.) всем воркерам.
+
+    Опубликованное событие возвращается через обработчик в каждый процесс,
+    включая отправивший, и уже там раздаётся локальным соединениям.
+    """
+
+    def __init__(self):
+        self._handler: Optional[EventHandler] = None
+
+    def set_handler(self, handler: EventHandler):
+        self._handler = handler
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    @abstractmethod
+    async def publish(self, chat_id: int, event: dict):
+        """Отправка события всем воркерам, включая текущий"""
+
+    async def _dispatch(self, chat_id: int, event: dict):
+        if self._handler is not None:
+            await self._handler(chat_id, event)
+
+
+class MemoryBroadcastBackend(BroadcastBackend):
+    """Рассылка в пределах одного процесса (один воркер, тесты)"""
+
+    async def publish(self, chat_id: int, event: dict):
+        await self._dispatch(chat_id, event)
+
+
+class PostgresBroadcastBackend(BroadcastBackend):
+    """
+    Рассылка через LISTEN/NOTIFY на отдельном asyncpg-соединении.
+
+    NOTIFY отправляется через общий пул database, слушает выделенное
+    соединение, которое переподключается при обрыве; после переподключения
+    кэши участников и последних сообщений сбрасываются. События, не влезающие в
+    лимит NOTIFY, передаются ссылкой на сообщение и дочитываются из messages.
+    """
+
+    def __init__(self, dsn: str = POSTGRES_DSN, channel: str = CHAT_NOTIFY_CHANNEL):
+        super().__init__()
+        self.dsn = dsn
+        self.channel = channel
+        self._connection: Optional[asyncpg.Connection] = None
+        self._events: asyncio.Queue = asyncio.Queue()
+        self._consumer: Optional[asyncio.Task] = None
+        self._reconnect: Optional[asyncio.Task] = None
+        self._stopping = False
+
+    async def start(self):
+        self._stopping = False
+        self._consumer = asyncio.create_task(self._consume())
+        await self._listen()
+
+    async def stop(self):
+        self._stopping = True
+        for task in (self._reconnect, self._consumer):
+            if task is not None:
+                task.cancel()
+        if self._connection is not None and not self._connection.is_closed():
+            await self._connection.close()
+        self._connection = None
+
+    async def publish(self, chat_id: int, event: dict):
+        payload = json.dumps({"chat_id": chat_id, **event}, ensure_ascii=False)
+        if len(payload.encode()) > NOTIFY_PAYLOAD_LIMIT and event.get("type") == "message":
+            payload = json.dumps({"chat_id": chat_id, "type": "message_ref", "id": event["message"]["id"]})
+        await database.execute(
+            query="SELECT pg_notify(:channel, :payload)",
+            values={"channel": self.channel, "payload": payload},
+        )
+
+    async def _listen(self):
+        self._connection = await asyncpg.connect(self.dsn)
+        self._connection.add_termination_listener(self._on_terminate)
+        await self._connection.add_listener(self.channel, self._on_notify)
+        logger.info(f'Подписка на канал "{self.channel}" установлена.')
+
+    def _on_notify(self, connection, pid, channel, payload):
+        # Колбэк синхронный: события обрабатываются по порядку отдельной задачей
+        self._events.put_nowait(payload)
+
+    def _on_terminate(self, connection):
+        if not self._stopping:
+            logger.error(f'Соединение LISTEN "{self.channel}" потеряно, переподключаюсь...')
+            self._reconnect = asyncio.create_task(self._reconnect_loop())
+
+    async def _reconnect_loop(self):
+        delay = RECONNECT_DELAY_SECONDS
+        while not self._stopping:
+            try:
+                await self._listen()
+                # События, пришедшие без подписки, потеряны: кэши этого процесса
+                # больше не отражают базу и заново читаются из неё
+                recent_messages.clear()
+                chat_cache.clear()
+                return
+            except (OSError, asyncpg.PostgresError) as e:
+                logger.error(f"Ошибка переподключения LISTEN: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RECONNECT_DELAY_MAX_SECONDS)
+
+    async def _consume(self):
+        while True:
+            payload = await self._events.get()
+            try:
+                event = json.loads(payload)
+                chat_id = event.pop("chat_id")
+                if event.get("type") == "message_ref":
+                    row = await self._load_message(event["id"])
+                    if row is None:
+                        logger.error(f"Сообщение {event['id']} не найдено для рассылки")
+                        continue
+                    event = {"type": "message", "message": serialize_message(row)}
+                await self._dispatch(chat_id, event)
+            except Exception as e:
+                logger.error(f"Ошибка обработки события чата: {e}")
+
+    @staticmethod
+    async def _load_message(message_id: int):
+        for _ in range(MESSAGE_REF_RETRIES):
+            row = await database.fetch_one(select(Message).where(Message.c.id == message_id))
+            if row is not None:
+                return row
+            await asyncio.sleep(MESSAGE_REF_RETRY_DELAY_SECONDS)
+        return None
+
+
+def create_broadcast_backend(kind: str = CHAT_BROADCAST_BACKEND) -> BroadcastBackend:
+    if kind == "postgres":
+        return PostgresBroadcastBackend()
+    if kind == "memory":
+        return MemoryBroadcastBackend()
+    raise ValueError(f"Unknown chat broadcast backend: {kind}")
@@ -0,0 +1,207 @@
+import sys
+import time
+from collections import OrderedDict, deque
+from datetime import datetime
+from typing import Optional
+
+from chat.schemas import ChatResponse
+from config import (CHAT_CACHE_SIZE, CHAT_CACHE_TTL_SECONDS, CHAT_RECENT_MEMORY_BUDGET, CHAT_RECENT_MESSAGES,
+                    CHAT_RECENT_TTL_SECONDS)
+
+import metrics
+
+
+class ChatMembershipCache:
+    """
+    LRU-кэш chat_id -> (чат, множество участников) с ограниченным временем жизни.
+
+    Записи явно сбрасываются при изменении состава чата; TTL страхует от
+    пропущенных сбросов с других воркеров.
+    """
+
+    def __init__(self, max_size: int = CHAT_CACHE_SIZE, ttl: float = CHAT_CACHE_TTL_SECONDS):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: "OrderedDict[int, tuple[float, ChatResponse, frozenset]]" = OrderedDict()
+        # Растёт при каждом сбросе: загрузка, начатая до сброса, не попадёт в кэш
+        self.version = 0
+        self.hits = metrics.counter("chat_membership_cache_hits_total", "Попадания в кэш участников чатов")
+        self.misses = metrics.counter("chat_membership_cache_misses_total", "Промахи кэша участников чатов")
+        metrics.gauge("chat_membership_cache_size", "Чаты в кэше участников", func=lambda: len(self._entries))
+
+    def get(self, chat_id: int) -> Optional[tuple[ChatResponse, frozenset]]:
+        entry = self._entries.get(chat_id)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[chat_id]
+            self.misses.inc()
+            return None
+        self._entries.move_to_end(chat_id)
+        self.hits.inc()
+        return entry[1], entry[2]
+
+    def put(self, chat: ChatResponse, version: int):
+        if version != self.version:
+            return
+        self._entries[chat.id] = (time.monotonic() + self.ttl, chat, frozenset(chat.members))
+        self._entries.move_to_end(chat.id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, chat_id: int):
+        self.version += 1
+        self._entries.pop(chat_id, None)
+
+    def clear(self):
+        self.version += 1
+        self._entries.clear()
+
+
+# Примерный расход памяти на одно сообщение помимо текста (словарь, строки, числа)
+MESSAGE_OVERHEAD_BYTES = 600
+
+
+def message_position(message: dict) -> tuple[datetime, int]:
+    """
+    Место сообщения (в виде для рассылки) в истории чата. id берутся из
+    последовательности разными воркерами и сами по себе порядка не задают.
+    """
+    return datetime.fromisoformat(message["created_at"]), message["id"]
+
+
+class _RecentEntry:
+    __slots__ = ("messages", "warm", "expires_at", "size")
+
+    def __init__(self, capacity: int):
+        self.messages: deque = deque(maxlen=capacity)
+        # warm: буфер заполнен из базы и действительно содержит последние сообщения чата
+        self.warm = False
+        # после этого момента (time.monotonic) буфер заново прогревается из базы
+        self.expires_at = 0.0
+        self.size = 0
+
+    def is_warm(self) -> bool:
+        return self.warm and self.expires_at >= time.monotonic()
+
+
+class RecentMessagesCache:
+    """
+    Кольцевые буферы последних сообщений чатов.
+
+    Буфер пополняется тем же путём, которым сообщения раздаются соединениям,
+    и при первом чтении прогревается из messages. Сообщения в буфере всегда
+    упорядочены по (created_at, id), даже если рассылка пришла не по порядку.
+    Прогретый буфер живёт ttl секунд, потом прогревается снова: это страхует
+    от сообщений, рассылка которых до процесса не дошла. Суммарный объём
+    ограничен бюджетом памяти: при превышении вытесняются давно не
+    использованные чаты.
+    """
+
+    def __init__(self, capacity: int = CHAT_RECENT_MESSAGES, memory_budget: int = CHAT_RECENT_MEMORY_BUDGET,
+                 ttl: float = CHAT_RECENT_TTL_SECONDS):
+        self.capacity = capacity
+        self.memory_budget = memory_budget
+        self.ttl = ttl
+        self.total_size = 0
+        self._entries: "OrderedDict[int, _RecentEntry]" = OrderedDict()
+        # Растёт при каждом сбросе: прогрев, начатый до сброса, не попадёт в буфер
+        self.version = 0
+        self.hits = metrics.counter("chat_recent_messages_hits_total", "Чтения последних сообщений из памяти")
+        self.misses = metrics.counter("chat_recent_messages_misses_total", "Чтения последних сообщений из базы")
+        metrics.gauge("chat_recent_messages_bytes", "Оценка памяти под буферы сообщений", func=lambda: self.total_size)
+        metrics.gauge("chat_recent_messages_chats", "Чаты с буфером сообщений", func=lambda: len(self._entries))
+
+    @staticmethod
+    def _message_size(message: dict) -> int:
+        return MESSAGE_OVERHEAD_BYTES + sys.getsizeof(message["text"])
+
+    def get(self, chat_id: int) -> Optional[tuple[list[dict], bool]]:
+        """
+        :return: (сообщения от старых к новым, буфер заполнен до предела) или None,
+                 если буфер не прогрет
+        """
+        entry = self._entries.get(chat_id)
+        if entry is None or not entry.is_warm():
+            self.misses.inc()
+            return None
+        self._entries.move_to_end(chat_id)
+        self.hits.inc()
+        return list(entry.messages), len(entry.messages) == self.capacity
+
+    def append(self, message: dict):
+        entry = self._entries.get(message["chat_id"])
+        if entry is None:
+            entry = self._entries[message["chat_id"]] = _RecentEntry(self.capacity)
+        self._push(entry, message)
+        self._entries.move_to_end(message["chat_id"])
+        self._evict()
+
+    def warm(self, chat_id: int, messages: list[dict], version: int) -> tuple[list[dict], bool]:
+        """
+        Заполняет буфер последними сообщениями из базы (от старых к новым).
+        Сообщения, пришедшие во время чтения из базы, не теряются. Если после
+        начала чтения (version) буферы сбрасывались, прочитанное не сохраняется.
+        :return: то же, что get
+        """
+        entry = self._entries.get(chat_id)
+        if entry is not None and entry.is_warm():
+            return list(entry.messages), len(entry.messages) == self.capacity
+        arrived = list(entry.messages) if entry is not None else []
+        known = {m["id"] for m in messages}
+        merged = messages + [m for m in arrived if m["id"] not in known]
+        merged.sort(key=message_position)
+        if version != self.version:
+            merged = merged[-self.capacity:]
+            return merged, len(merged) == self.capacity
+
+        if entry is not None:
+            self.total_size -= entry.size
+        entry = self._entries[chat_id] = _RecentEntry(self.capacity)
+        for message in merged:
+            self._push(entry, message)
+        entry.warm = True
+        entry.expires_at = time.monotonic() + self.ttl
+        self._entries.move_to_end(chat_id)
+        self._evict()
+        return list(entry.messages), len(entry.messages) == self.capacity
+
+    def invalidate(self, chat_id: int):
+        self.version += 1
+        entry = self._entries.pop(chat_id, None)
+        if entry is not None:
+            self.total_size -= entry.size
+
+    def clear(self):
+        """Сброс всех буферов, например когда часть рассылки могла быть потеряна"""
+        self.version += 1
+        self._entries.clear()
+        self.total_size = 0
+
+    def _push(self, entry: _RecentEntry, message: dict):
+        position = message_position(message)
+        index = len(entry.messages)
+        while index > 0 and message_position(entry.messages[index - 1]) > position:
+            index -= 1
+        if index > 0 and entry.messages[index - 1]["id"] == message["id"]:
+            return
+        if len(entry.messages) == entry.messages.maxlen:
+            if index == 0:
+                # старше всего полного буфера
+                return
+            dropped = entry.messages.popleft()
+            index -= 1
+            entry.size -= self._message_size(dropped)
+            self.total_size -= self._message_size(dropped)
+        entry.messages.insert(index, message)
+        size = self._message_size(message)
+        entry.size += size
+        self.total_size += size
+
+    def _evict(self):
+        while self.total_size > self.memory_budget and len(self._entries) > 1:
+            _, entry = self._entries.popitem(last=False)
+            self.total_size -= entry.size
+
+
+chat_cache = ChatMembershipCache()
+recent_messages = RecentMessagesCache()
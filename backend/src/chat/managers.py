@@ -1,43 +1,255 @@
-from typing import Dict, List
+import asyncio
+import json
+import logging
+import time
+from typing import TYPE_CHECKING, Dict, List, Optional
 
-from chat.tables import ChatMember
-from database import database
-from fastapi import HTTPException, WebSocket
-from sqlalchemy import select
+from chat.cache import chat_cache, message_position, recent_messages
+from chat.utils import load_chat
+from config import CHAT_SEND_QUEUE_HIGH_WATER, CHAT_SEND_QUEUE_SIZE, CHAT_SLOW_CLIENT_GRACE_SECONDS
+from fastapi import HTTPException, WebSocket, WebSocketDisconnect
+
+import metrics
+
+if TYPE_CHECKING:
+    from chat.backends import BroadcastBackend
+
+logger = logging.getLogger(__name__)
+
+# Код закрытия для клиентов, не успевающих забирать сообщения ("Try Again Later")
+SLOW_CLIENT_CLOSE_CODE = 1013
+
+delivery_latency = metrics.histogram(
+    "chat_ws_delivery_latency_seconds", "Время от постановки сообщения в очередь до отправки клиенту")
+broadcast_duration = metrics.histogram(
+    "chat_ws_broadcast_seconds", "Время раскладки одного сообщения по очередям соединений")
+slow_clients_dropped = metrics.counter(
+    "chat_ws_slow_clients_dropped_total", "Соединения, отключённые из-за переполненной очереди")
+
+
+class ChatConnection:
+    """
+    WebSocket-соединение участника чата с собственной исходящей очередью.
+
+    Все отправки идут через очередь и одну задачу-писателя, поэтому медленный
+    клиент не тормозит остальных. Старые клиенты получают строки вида
+    "user_id: текст", клиенты, приславшие last_seen_id, — JSON-кадры (json_mode).
+    Пока клиенту досылается история, сообщения рассылки не ставятся в
+    очередь, а копятся в held (см. hold и release).
+    """
+
+    def __init__(self, websocket: WebSocket, chat_id: int, user_id: int, manager: "WSChatConnectionManager"):
+        self.websocket = websocket
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.json_mode = False
+        self.manager = manager
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=CHAT_SEND_QUEUE_SIZE)
+        self.closed = False
+        self.close_code = 1000
+        self._high_water_since: Optional[float] = None
+        self.held: Optional[list[dict]] = None
+        self._writer = asyncio.create_task(self._write_loop())
+
+    def format_message(self, message: dict) -> str:
+        if self.json_mode:
+            return self.format_json({"type": "message", **message})
+        return f"{message['sender_id']}: {message['text']}"
+
+    @staticmethod
+    def format_json(frame: dict) -> str:
+        return json.dumps(frame, ensure_ascii=False)
+
+    async def send_message(self, message: dict):
+        await self.send_text(self.format_message(message))
+
+    async def send_json(self, frame: dict):
+        await self.send_text(self.format_json(frame))
+
+    async def send_text(self, text: str):
+        """Постановка в очередь с ожиданием места (для собственных кадров соединения)"""
+        if self.closed:
+            raise WebSocketDisconnect(code=self.close_code)
+        await self.queue.put((text, time.perf_counter()))
+        if self.closed:
+            raise WebSocketDisconnect(code=self.close_code)
+
+    def offer(self, text: str) -> bool:
+        """
+        Неблокирующая постановка в очередь для рассылки.
+        :return: False, если клиент не успевает и должен быть отключён
+        """
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait((text, time.perf_counter()))
+        except asyncio.QueueFull:
+            return False
+
+        if self.queue.qsize() < CHAT_SEND_QUEUE_HIGH_WATER:
+            self._high_water_since = None
+            return True
+        now = time.monotonic()
+        if self._high_water_since is None:
+            self._high_water_since = now
+        return now - self._high_water_since <= CHAT_SLOW_CLIENT_GRACE_SECONDS
+
+    def hold(self):
+        """Начать копить сообщения рассылки (до release)"""
+        self.held = []
+
+    def hold_message(self, message: dict) -> bool:
+        """
+        Откладывает сообщение рассылки до release.
+        :return: False, если отложено уже CHAT_SEND_QUEUE_SIZE сообщений
+        """
+        if self.closed or len(self.held) >= CHAT_SEND_QUEUE_SIZE:
+            return False
+        self.held.append(message)
+        return True
+
+    async def release(self, last_sent: Optional[dict]):
+        """
+        Отправляет отложенные сообщения новее last_sent (последнего сообщения
+        истории) и возвращает соединение к обычной рассылке. Пришедшие во
+        время отправки сообщения тоже попадают в held, поэтому порядок
+        сохраняется.
+        """
+        after = message_position(last_sent) if last_sent is not None else None
+        while self.held:
+            message = self.held.pop(0)
+            if after is None or message_position(message) > after:
+                await self.send_message(message)
+        self.held = None
+
+    async def receive_text(self) -> str:
+        if self.closed:
+            raise WebSocketDisconnect(code=self.close_code)
+        return await self.websocket.receive_text()
+
+    async def _write_loop(self):
+        try:
+            while True:
+                text, enqueued_at = await self.queue.get()
+                await self.websocket.send_text(text)
+                delivery_latency.observe(time.perf_counter() - enqueued_at)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.info(f"Error sending message to chat {self.chat_id}: {e}")
+            self.closed = True
+            self.manager.disconnect(self)
+
+    async def close(self, code: int = 1000):
+        """Остановка писателя и закрытие сокета с указанным кодом"""
+        self.close_code = code
+        self.stop()
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+    def stop(self):
+        """Остановка писателя; ожидающие места в очереди отправители получают отказ"""
+        self.closed = True
+        self._writer.cancel()
+        while not self.queue.empty():
+            self.queue.get_nowait()
 
 
 class WSChatConnectionManager:
-    def __init__(self):
-        # Словарь для хранения активных соединений по chat_id
-        self.active_connections: Dict[int, List[WebSocket]] = {}
-
-    async def connect(self, websocket: WebSocket, chat_id: int, user_id: int):
-        """Подключение пользователя к чату"""
-        query = select(ChatMember).where(ChatMember.c.chat_id == chat_id, ChatMember.c.user_id == user_id)
-        result = await database.fetch_one(query)
-        if not result:
+    def __init__(self, backend: "BroadcastBackend"):
+        # Словарь для хранения активных соединений по chat_id (только этого процесса)
+        self.active_connections: Dict[int, List[ChatConnection]] = {}
+        # Канал, через который сообщения доходят до соединений других воркеров
+        self.backend = backend
+        self.backend.set_handler(self._handle_event)
+        metrics.gauge("chat_ws_connections", "Активные WebSocket-соединения чатов",
+                      func=lambda: sum(len(c) for c in self.active_connections.values()))
+        metrics.gauge("chat_ws_queue_depth_total", "Суммарная длина исходящих очередей",
+                      func=lambda: sum(c.queue.qsize() for c in self._all_connections()))
+        metrics.gauge("chat_ws_queue_depth_max", "Максимальная длина исходящей очереди",
+                      func=lambda: max((c.queue.qsize() for c in self._all_connections()), default=0))
+
+    async def start(self):
+        await self.backend.start()
+
+    async def stop(self):
+        await self.backend.stop()
+        for connection in list(self._all_connections()):
+            self.disconnect(connection)
+            await connection.close(code=1001)
+
+    def _all_connections(self):
+        for connections in self.active_connections.values():
+            yield from connections
+
+    async def connect(self, websocket: WebSocket, chat_id: int, user_id: int) -> ChatConnection:
+        """Проверка членства и принятие соединения (без подписки на рассылку)"""
+        loaded = await load_chat(chat_id)
+        if loaded is None or user_id not in loaded[1]:
             raise HTTPException(status_code=403, detail="User is not a member of the chat")
 
         await websocket.accept()
+        return ChatConnection(websocket, chat_id, user_id, self)
 
-        if chat_id not in self.active_connections:
-            self.active_connections[chat_id] = []
-        self.active_connections[chat_id].append(websocket)
+    def register(self, connection: ChatConnection):
+        """Подписка соединения на рассылку сообщений чата"""
+        self.active_connections.setdefault(connection.chat_id, []).append(connection)
 
-    def disconnect(self, websocket: WebSocket, chat_id: int):
+    def disconnect(self, connection: ChatConnection):
         """Отключение пользователя от чата"""
+        connection.stop()
+        chat_id = connection.chat_id
         if chat_id in self.active_connections:
-            self.active_connections[chat_id].remove(websocket)
+            if connection in self.active_connections[chat_id]:
+                self.active_connections[chat_id].remove(connection)
             if not self.active_connections[chat_id]:  # Удаление чата из словаря, если соединений больше нет
                 del self.active_connections[chat_id]
 
-    async def broadcast(self, message: str, chat_id: int):
-        """Отправка сообщения всем подключенным пользователям в чате"""
-        if chat_id in self.active_connections:
-            for connection in self.active_connections[chat_id]:
-                try:
-                    await connection.send_text(message)
-                except Exception as e:
-                    print(f"Error sending message to chat {chat_id}: {e}")
-                    self.active_connections[chat_id].remove(connection)
-                    await connection.close()
+    async def broadcast(self, message: dict, chat_id: int):
+        """Отправка сообщения всем подключенным пользователям в чате (на всех воркерах)"""
+        await self.backend.publish(chat_id, {"type": "message", "message": message})
+
+    async def invalidate_chat(self, chat_id: int):
+        """Сброс кэша участников чата в этом и во всех остальных воркерах"""
+        chat_cache.invalidate(chat_id)
+        await self.backend.publish(chat_id, {"type": "invalidate"})
+
+    async def _handle_event(self, chat_id: int, event: dict):
+        if event.get("type") == "message":
+            self.deliver(event["message"], chat_id)
+        elif event.get("type") == "invalidate":
+            chat_cache.invalidate(chat_id)
+
+    def deliver(self, message: dict, chat_id: int):
+        """
+        Раздача сообщения соединениям этого процесса и запись в буфер
+        последних сообщений чата.
+
+        Сообщение только раскладывается по очередям соединений; клиенты,
+        не успевающие их разбирать, отключаются.
+        """
+        recent_messages.append(message)
+        connections = self.active_connections.get(chat_id)
+        if not connections:
+            return
+
+        with broadcast_duration.time():
+            frames = {}
+            slow = []
+            for connection in list(connections):
+                if connection.held is not None:
+                    if not connection.hold_message(message):
+                        slow.append(connection)
+                    continue
+                if connection.json_mode not in frames:
+                    frames[connection.json_mode] = connection.format_message(message)
+                if not connection.offer(frames[connection.json_mode]):
+                    slow.append(connection)
+
+        for connection in slow:
+            logger.info(f"Dropping slow client {connection.user_id} from chat {chat_id}")
+            slow_clients_dropped.inc()
+            self.disconnect(connection)
+            asyncio.create_task(connection.close(code=SLOW_CLIENT_CLOSE_CODE))
@@ -1,56 +1,87 @@
+import asyncio
 from datetime import datetime
-from typing import List
+from typing import List, Optional
 
-from auth.tables import User
-from auth.utils import get_current_user
+from auth.utils import Principal, get_current_principal
+from chat.archive import message_archive
+from chat.backends import create_broadcast_backend
+from chat.cache import recent_messages
 from chat.managers import WSChatConnectionManager
-from chat.schemas import ChatCreate, ChatResponse, ChatMessageResponse
+from chat.schemas import (ChatCreate, ChatListResponse, ChatMessageResponse, ChatMessageSearchResponse,
+                          ChatReadRequest, ChatReadResponse, ChatResponse)
 from chat.tables import Chat, ChatMember, Message
-from chat.utils import get_chat_if_member
+from chat.utils import (decode_cursor, encode_cursor, encode_search_cursor, enrich_chats_with_members,
+                        get_chat_if_member, increment_unread_counts, load_recent_messages, mark_read,
+                        parse_resume_frame, replay_history, search_messages, serialize_message, to_naive_utc)
+from chat.writer import MessageWriteBuffer
+from config import CHAT_RESUME_TIMEOUT_SECONDS, CHAT_WRITE_BEHIND
 from database import database
-from fastapi import (APIRouter, Depends, HTTPException, WebSocket,
+from fastapi import (APIRouter, Depends, HTTPException, Query, Response, WebSocket,
                      WebSocketDisconnect)
-from sqlalchemy import select
+from sqlalchemy import select, tuple_
 
 from models.utils import MessageResponse
 
 router = APIRouter(prefix="/chats", tags=["chats"])
-manager = WSChatConnectionManager()
-
-
-@router.get("/", response_model=list[ChatResponse])
-async def get_chats(current_user: User = Depends(get_current_user)):
-    """Получить список чатов, в которых состоит пользователь"""
-    query = select(Chat.c.id, Chat.c.name, Chat.c.description, Chat.c.owner_id).join(ChatMember).where(
-        ChatMember.c.user_id == current_user.id)
-    chats = await database.fetch_all(query)
-    results = []
-    for chat in chats:
-        members_query = select(ChatMember.c.user_id).where(ChatMember.c.chat_id == chat["id"])
-        members = await database.fetch_all(members_query)
-        results.append({
-            "id": chat["id"],
-            "name": chat["name"],
-            "description": chat["description"],
-            "owner_id": chat["owner_id"],
-            "members": [m["user_id"] for m in members],
-        })
-    return results
+manager = WSChatConnectionManager(create_broadcast_backend())
+message_writer = MessageWriteBuffer() if CHAT_WRITE_BEHIND else None
+
+
+@router.get("/", response_model=list[ChatListResponse])
+async def get_chats(current_user: Principal = Depends(get_current_principal)):
+    """Получить список чатов, в которых состоит пользователь, со счётчиками непрочитанных"""
+    query = select(
+        Chat.c.id, Chat.c.name, Chat.c.description, Chat.c.owner_id,
+        ChatMember.c.unread_count, ChatMember.c.last_read_message_id,
+    ).join(ChatMember).where(ChatMember.c.user_id == current_user.id)
+    chats = [dict(chat._mapping) for chat in await database.fetch_all(query)]
+    enriched = await enrich_chats_with_members(chats)
+    return [
+        ChatListResponse(
+            **chat_response.model_dump(),
+            unread_count=chat["unread_count"],
+            last_read_message_id=chat["last_read_message_id"],
+        )
+        for chat, chat_response in zip(chats, enriched)
+    ]
 
 
 @router.post("/", response_model=ChatResponse)
-async def create_chat(chat: ChatCreate, current_user: User = Depends(get_current_user)):
+async def create_chat(chat: ChatCreate, current_user: Principal = Depends(get_current_principal)):
     """Создать новый чат"""
     current_user_id = current_user.id
     query = Chat.insert().values(owner_id=current_user_id, name=chat.name, description=chat.description)
     chat_id = await database.execute(query)
     query = ChatMember.insert().values(chat_id=chat_id, user_id=current_user_id)
     await database.execute(query)
-    query = ChatMember.select().where(ChatMember.c.chat_id == chat_id)
-    members_result = await database.fetch_all(query)
-    members = [m["user_id"] for m in members_result]
-    return ChatResponse(id=chat_id, name=chat.name, description=chat.description, owner_id=current_user_id,
-                        members=members)
+    await manager.invalidate_chat(chat_id)
+    [chat_response] = await enrich_chats_with_members([{
+        "id": chat_id,
+        "name": chat.name,
+        "description": chat.description,
+        "owner_id": current_user_id,
+    }])
+    return chat_response
+
+
+@router.get("/messages/search", response_model=List[ChatMessageSearchResponse], responses={
+    400: {"description": "Invalid cursor"}})
+async def search_all_messages(
+        response: Response,
+        q: str = Query(..., min_length=1),
+        limit: int = Query(20, ge=1, le=100),
+        cursor: Optional[str] = None,
+        current_user: Principal = Depends(get_current_principal),
+):
+    """
+    Поиск по сообщениям всех чатов пользователя (от более релевантных к менее).
+    Курсор следующей страницы приходит в заголовке X-Next-Cursor.
+    """
+    user_chats = select(ChatMember.c.chat_id).where(ChatMember.c.user_id == current_user.id)
+    results = await search_messages(Message.c.chat_id.in_(user_chats), q, limit, cursor)
+    if len(results) == limit:
+        response.headers["X-Next-Cursor"] = encode_search_cursor(results[-1]["rank"], results[-1]["id"])
+    return results
 
 
 @router.get("/{chat_id}", response_model=ChatResponse, responses={
@@ -61,24 +92,112 @@ async def get_chat_info(chat=Depends(get_chat_if_member)):
     return chat
 
 
-@router.get("/{chat_id}/messages", response_model=List[ChatMessageResponse])
+@router.get("/{chat_id}/messages", response_model=List[ChatMessageResponse], responses={
+    400: {"description": "Invalid cursor"},
+    404: {"description": "Message not found"}})
 async def get_messages(
+        response: Response,
         chat=Depends(get_chat_if_member),
         skip: int = 0,
         limit: int = 50,
+        cursor: Optional[str] = None,
+        before_id: Optional[int] = None,
+        before_ts: Optional[datetime] = None,
 ):
-    """Получить последние сообщения из чата (от новых к старым)"""
-    query = (
-        select(Message)
-        .where(Message.c.chat_id == chat.id)
-        .order_by(Message.c.created_at.desc())
-        .offset(skip)
-        .limit(limit)
-    )
-    messages = await database.fetch_all(query)
+    """
+    Получить последние сообщения из чата (от новых к старым).
+
+    Если передан cursor, before_id или before_ts, используется keyset-пагинация:
+    возвращаются сообщения строго старше указанной позиции. Курсор следующей
+    страницы приходит в заголовке X-Next-Cursor. Параметры skip/limit
+    оставлены для совместимости. Первая страница берётся из буфера последних
+    сообщений чата, сообщения старше данных в базе — из архива в MinIO.
+    """
+    first_page = cursor is None and before_id is None and before_ts is None and skip == 0
+    if first_page and limit <= recent_messages.capacity:
+        # Первая страница отдаётся из буфера последних сообщений
+        recent, _ = await load_recent_messages(chat.id)
+        messages = []
+        for message in reversed(recent[-limit:]):
+            created_at = datetime.fromisoformat(message["created_at"])
+            messages.append({**message, "created_at": created_at, "updated_at": created_at})
+    else:
+        query = select(Message).where(Message.c.chat_id == chat.id)
+
+        if cursor is not None:
+            before_ts, before_id = decode_cursor(cursor)
+        elif before_ts is not None:
+            before_ts = to_naive_utc(before_ts)
+        elif before_id is not None:
+            before_ts = await database.fetch_val(
+                select(Message.c.created_at).where(Message.c.id == before_id, Message.c.chat_id == chat.id)
+            )
+            if before_ts is None:
+                archived = await message_archive.find_message(chat.id, before_id)
+                if archived is None:
+                    raise HTTPException(status_code=404, detail="Message not found")
+                before_ts = archived["created_at"]
+
+        if before_ts is not None and before_id is not None:
+            query = query.where(tuple_(Message.c.created_at, Message.c.id) < tuple_(before_ts, before_id))
+        elif before_ts is not None:
+            query = query.where(Message.c.created_at < before_ts)
+        else:
+            query = query.offset(skip)
+
+        query = query.order_by(Message.c.created_at.desc(), Message.c.id.desc()).limit(limit)
+        messages = list(await database.fetch_all(query))
+
+    if len(messages) < limit and (before_ts is not None or skip == 0):
+        # Данные в базе кончились — продолжаем по архивным сегментам, если
+        # в архиве чата вообще есть что-то старше страницы
+        if messages:
+            before_ts, before_id = messages[-1]["created_at"], messages[-1]["id"]
+        if await message_archive.has_messages_before(chat.id, before_ts):
+            messages += await message_archive.fetch_before(chat.id, before_ts, before_id, limit - len(messages))
+
+    if messages and len(messages) == limit:
+        last = messages[-1]
+        response.headers["X-Next-Cursor"] = encode_cursor(last["created_at"], last["id"])
     return messages  # фронт получает [новое, ..., старое]
 
 
+@router.get("/{chat_id}/messages/search", response_model=List[ChatMessageSearchResponse], responses={
+    400: {"description": "Invalid cursor"},
+    403: {"description": "You are not a member of this chat"},
+    404: {"description": "Chat not found"}})
+async def search_chat_messages(
+        response: Response,
+        chat=Depends(get_chat_if_member),
+        q: str = Query(..., min_length=1),
+        limit: int = Query(20, ge=1, le=100),
+        cursor: Optional[str] = None,
+):
+    """
+    Поиск по сообщениям чата (от более релевантных к менее).
+    Курсор следующей страницы приходит в заголовке X-Next-Cursor.
+    """
+    results = await search_messages(Message.c.chat_id == chat.id, q, limit, cursor)
+    if len(results) == limit:
+        response.headers["X-Next-Cursor"] = encode_search_cursor(results[-1]["rank"], results[-1]["id"])
+    return results
+
+
+@router.post("/{chat_id}/read", response_model=ChatReadResponse, responses={
+    403: {"description": "You are not a member of this chat"},
+    404: {"description": "Chat or message not found"}})
+async def mark_chat_read(
+        body: ChatReadRequest,
+        chat=Depends(get_chat_if_member),
+        current_user: Principal = Depends(get_current_principal),
+):
+    """
+    Сдвинуть отметку прочитанного в чате вперёд.
+    Без last_read_message_id чат отмечается прочитанным целиком.
+    """
+    return await mark_read(chat.id, current_user.id, body.last_read_message_id)
+
+
 @router.post("/{chat_id}/members",
              response_model=MessageResponse,
              responses={
@@ -89,7 +208,7 @@ async def get_messages(
 async def add_member(
         chat_id: int,
         user_id: int,
-        current_user: User = Depends(get_current_user)
+        current_user: Principal = Depends(get_current_principal)
 ):
     """Добавить пользователя в чат"""
 
@@ -112,6 +231,7 @@ async def add_member(
     # Добавляем нового участника
     query = ChatMember.insert().values(chat_id=chat_id, user_id=user_id)
     await database.execute(query)
+    await manager.invalidate_chat(chat_id)
 
     return {"message": "User added to chat"}
 
@@ -126,7 +246,7 @@ async def add_member(
 async def remove_member(
         chat_id: int,
         user_id: int,
-        current_user: User = Depends(get_current_user)
+        current_user: Principal = Depends(get_current_principal)
 ):
     """Удалить пользователя из чата"""
 
@@ -149,30 +269,58 @@ async def remove_member(
     # Удаляем участника
     query = ChatMember.delete().where(ChatMember.c.chat_id == chat_id, ChatMember.c.user_id == user_id)
     await database.execute(query)
+    await manager.invalidate_chat(chat_id)
 
     return {"message": "User removed from chat"}
 
 
 @router.websocket("/ws/{chat_id}/{user_id}")
-async def websocket_endpoint(websocket: WebSocket, chat_id: int, user_id: int):
-    await manager.connect(websocket, chat_id, user_id)
+async def websocket_endpoint(websocket: WebSocket, chat_id: int, user_id: int, last_seen_id: Optional[int] = None,
+                             resume: bool = False):
+    connection = await manager.connect(websocket, chat_id, user_id)
     try:
-        # Отправляем историю сообщений при подключении
-        print("here1")
-        query = select(Message).where(Message.c.chat_id == chat_id).order_by(Message.c.created_at)
-        messages = await database.fetch_all(query)
-        print("here2")
-        for message in messages:
-            await websocket.send_text(f"{message['sender_id']}: {message['text']}")
+        # Клиент может сообщить last_seen_id параметром или, передав resume=true,
+        # первым кадром {"type": "resume"}; остальные получают историю сразу
+        pending_text = None
+        if last_seen_id is not None:
+            connection.json_mode = True
+        elif resume:
+            try:
+                pending_text = await asyncio.wait_for(connection.receive_text(), CHAT_RESUME_TIMEOUT_SECONDS)
+            except asyncio.TimeoutError:
+                pending_text = None
+            resume = parse_resume_frame(pending_text)
+            if resume is not None:
+                connection.json_mode = True
+                last_seen_id = resume.get("last_seen_id")
+                pending_text = None
+
+        # Пока отправляется история, сообщения рассылки откладываются, а потом
+        # досылаются те, что новее истории: без пропусков и повторов
+        connection.hold()
+        manager.register(connection)
+        await connection.release(await replay_history(connection, last_seen_id))
 
         while True:
-            message = await websocket.receive_text()
-
-            # Сохраняем сообщение в базе данных
-            query = Message.insert().values(chat_id=chat_id, sender_id=user_id, text=message)
-            await database.execute(query)
-
-            await manager.broadcast(f"{user_id}: {message}", chat_id)
+            if pending_text is not None:
+                message, pending_text = pending_text, None
+            else:
+                message = await connection.receive_text()
+
+            if message_writer is not None:
+                # Сообщение уходит сразу, а в базу попадёт со следующей пачкой
+                payload = await message_writer.submit(chat_id, user_id, message, connection)
+            else:
+                # Сохраняем сообщение в базе данных вместе со счётчиками непрочитанных
+                query = Message.insert().values(chat_id=chat_id, sender_id=user_id, text=message).returning(Message)
+                async with database.transaction():
+                    row = await database.fetch_one(query)
+                    await increment_unread_counts([row._mapping])
+                payload = serialize_message(row)
+
+            await manager.broadcast(payload, chat_id)
 
     except WebSocketDisconnect:
-        manager.disconnect(websocket, chat_id)
+        pass
+    finally:
+        manager.disconnect(connection)
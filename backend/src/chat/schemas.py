@@ -15,10 +15,26 @@ class ChatResponse(BaseModel):
     owner_id: int
     members: list[int]
 
+class ChatListResponse(ChatResponse):
+    unread_count: int
+    last_read_message_id: Optional[int] = None
+
 class ChatMessageResponse(BaseModel):
     id: int
     chat_id: int
-    user_id: int
-    content: str
+    sender_id: int
+    text: str
     created_at: datetime
-    updated_at: datetime = None
+    updated_at: Optional[datetime] = None
+
+class ChatMessageSearchResponse(ChatMessageResponse):
+    rank: float
+
+class ChatReadRequest(BaseModel):
+    # None — отметить прочитанным всё до последнего сообщения
+    last_read_message_id: Optional[int] = None
+
+class ChatReadResponse(BaseModel):
+    chat_id: int
+    last_read_message_id: Optional[int] = None
+    unread_count: int
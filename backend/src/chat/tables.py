@@ -1,17 +1,35 @@
+import re
+
+from config import CHAT_SEARCH_TS_CONFIG
 from database import metadata
 from models.utils import timestamp_columns
-from sqlalchemy import Column, ForeignKey, Integer, String, Table
+from sqlalchemy import Column, Date, DateTime, ForeignKey, Index, Integer, String, Table, UniqueConstraint, func, text
 
+# Сообщения секционированы по месяцам created_at (секции создаёт chat.archive),
+# поэтому created_at входит в первичный ключ
 Message = Table(
     "messages",
     metadata,
-    Column("id", Integer, primary_key=True),
+    Column("id", Integer, primary_key=True, autoincrement=True),
     Column("chat_id", Integer, ForeignKey("chats.id"), nullable=False),
     Column("sender_id", Integer, ForeignKey("users.id"), nullable=False),
     Column("text", String, nullable=False),
-    *timestamp_columns(),
+    Column("created_at", DateTime, primary_key=True, server_default=func.now()),
+    Column("updated_at", DateTime, nullable=False, server_default=func.now(), onupdate=func.now()),
+    # Индекс под keyset-пагинацию истории: (chat_id, created_at, id)
+    Index("ix_messages_chat_id_created_at_id", "chat_id", "created_at", "id"),
+    postgresql_partition_by="RANGE (created_at)",
 )
 
+if not re.fullmatch(r"[a-z_]+", CHAT_SEARCH_TS_CONFIG):
+    raise ValueError(f"Invalid CHAT_SEARCH_TS_CONFIG: {CHAT_SEARCH_TS_CONFIG}")
+
+# Конфигурация подставляется литералом: иначе выражение запроса не совпадёт с индексом
+SEARCH_TS_CONFIG = text(f"'{CHAT_SEARCH_TS_CONFIG}'::regconfig")
+MESSAGE_TSVECTOR = func.to_tsvector(SEARCH_TS_CONFIG, Message.c.text)
+
+Index("ix_messages_text_tsv", MESSAGE_TSVECTOR, postgresql_using="gin")
+
 Chat = Table(
     "chats",
     metadata,
@@ -28,4 +46,28 @@ ChatMember = Table(
     Column("id", Integer, primary_key=True),
     Column("chat_id", Integer, ForeignKey("chats.id"), nullable=False),
     Column("user_id", Integer, ForeignKey("users.id"), nullable=False),
+    # Последнее прочитанное сообщение и счётчик непрочитанных после него.
+    # Счётчик поддерживается при записи сообщений, а не пересчитывается при чтении.
+    # Отметка сравнивается по (last_read_at, last_read_message_id): id не упорядочены по времени
+    Column("last_read_message_id", Integer, nullable=True),
+    Column("last_read_at", DateTime, nullable=True),
+    Column("unread_count", Integer, nullable=False, server_default=text("0")),
+    Index("ix_chat_members_chat_id_user_id", "chat_id", "user_id"),
+)
+
+# Выгруженные в MinIO сегменты старых секций messages: один сегмент на чат и месяц
+MessageArchiveSegment = Table(
+    "message_archive_segments",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("chat_id", Integer, ForeignKey("chats.id"), nullable=False),
+    Column("month", Date, nullable=False),
+    Column("key", String, nullable=False),
+    Column("message_count", Integer, nullable=False),
+    Column("min_id", Integer, nullable=False),
+    Column("max_id", Integer, nullable=False),
+    Column("first_created_at", DateTime, nullable=False),
+    Column("last_created_at", DateTime, nullable=False),
+    *timestamp_columns(),
+    UniqueConstraint("chat_id", "month", name="uq_message_archive_segments_chat_id_month"),
 )
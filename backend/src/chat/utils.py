@@ -1,42 +1,426 @@
-from auth.tables import User
-from auth.utils import get_current_user
+import base64
+import json
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING, AsyncIterator, Optional
+
+from auth.utils import Principal, get_current_principal
+from chat.cache import chat_cache, message_position, recent_messages
 from chat.schemas import ChatResponse
-from chat.tables import Chat, ChatMember
+from chat.tables import MESSAGE_TSVECTOR, SEARCH_TS_CONFIG, Chat, ChatMember, Message
+from config import CHAT_HISTORY_BATCH_SIZE, CHAT_HISTORY_REPLAY_LIMIT
 from database import database
 from fastapi import Depends, HTTPException
-from sqlalchemy import select
+from sqlalchemy import DateTime, Integer, cast, column, func, or_, select, tuple_, values
 from starlette import status
 
+if TYPE_CHECKING:
+    from chat.managers import ChatConnection
+
+
+async def enrich_chats_with_members(chats_list: list[dict]) -> list[ChatResponse]:
+    """
+    Добавляет к чатам списки участников одним запросом на все чаты.
+    :param chats_list: строки таблицы chats в виде словарей
+    :return: список ChatResponse в том же порядке
+    """
+    if not chats_list:
+        return []
+
+    chat_ids = [chat["id"] for chat in chats_list]
+
+    # Получаем всех участников этих чатов
+    members_query = select(ChatMember.c.chat_id, ChatMember.c.user_id).where(ChatMember.c.chat_id.in_(chat_ids))
+    members = await database.fetch_all(members_query)
+
+    # Словарь chat_id -> список user_id
+    members_map = defaultdict(list)
+    for record in members:
+        members_map[record["chat_id"]].append(record["user_id"])
+
+    return [
+        ChatResponse(
+            id=chat["id"],
+            name=chat["name"],
+            description=chat["description"],
+            owner_id=chat["owner_id"],
+            members=members_map.get(chat["id"], []),
+        )
+        for chat in chats_list
+    ]
+
+
+async def load_chat(chat_id: int) -> Optional[tuple[ChatResponse, frozenset]]:
+    """
+    Возвращает чат и множество его участников, по возможности из кэша.
+    :return: (ChatResponse, frozenset(user_id)) или None, если чата нет
+    """
+    cached = chat_cache.get(chat_id)
+    if cached is not None:
+        return cached
+
+    version = chat_cache.version
+    chat = await database.fetch_one(select(Chat).where(Chat.c.id == chat_id))
+    if not chat:
+        return None
+
+    [chat_response] = await enrich_chats_with_members([dict(chat._mapping)])
+    chat_cache.put(chat_response, version)
+    return chat_response, frozenset(chat_response.members)
+
 
 async def get_chat_if_member(
         chat_id: int,
-        current_user: User = Depends(get_current_user),
+        current_user: Principal = Depends(get_current_principal),
 ):
-    query = select(ChatMember).where(
-        (ChatMember.c.chat_id == chat_id) &
-        (ChatMember.c.user_id == current_user.id)
-    )
-    member = await database.fetch_one(query)
+    loaded = await load_chat(chat_id)
+    if loaded is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Chat not found"
+        )
 
-    if not member:
+    chat, members = loaded
+    if current_user.id not in members:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="You are not a member of this chat"
         )
 
-    query = select(Chat).where(Chat.c.id == chat_id)
-    chat = await database.fetch_one(query)
-    if not chat:
+    return chat
+
+
+def to_naive_utc(value: datetime) -> datetime:
+    """
+    Приводит время к naive UTC — в таком виде хранятся timestamp-колонки.
+    """
+    if value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _pack_cursor(data: dict) -> str:
+    raw = json.dumps(data, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def _unpack_cursor(cursor: str) -> dict:
+    padded = cursor + "=" * (-len(cursor) % 4)
+    data = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    if not isinstance(data, dict):
+        raise ValueError("cursor must be an object")
+    return data
+
+
+def encode_cursor(created_at: datetime, message_id: int) -> str:
+    """
+    Кодирует позицию сообщения в непрозрачный курсор для keyset-пагинации.
+    :param created_at: время создания сообщения
+    :param message_id: id сообщения
+    :return: строка курсора (base64url)
+    """
+    return _pack_cursor({"ts": created_at.isoformat(), "id": message_id})
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    """
+    Разбирает курсор, созданный encode_cursor.
+    :param cursor: строка курсора
+    :return: пара (created_at, id)
+    :raises HTTPException: если курсор повреждён
+    """
+    try:
+        data = _unpack_cursor(cursor)
+        return to_naive_utc(datetime.fromisoformat(data["ts"])), int(data["id"])
+    except (ValueError, KeyError, TypeError):
         raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Chat not found"
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor"
         )
 
-    query = select(ChatMember.c.user_id).where(ChatMember.c.chat_id == chat_id)
-    members = await database.fetch_all(query)
-    member_ids = [m['user_id'] for m in members]
 
-    chat_dict = dict(chat)
-    chat_dict['members'] = member_ids
+def encode_search_cursor(rank: float, message_id: int) -> str:
+    """
+    Кодирует позицию в выдаче поиска (ранг, id) в непрозрачный курсор.
+    """
+    return _pack_cursor({"rank": rank, "id": message_id})
+
+
+def decode_search_cursor(cursor: str) -> tuple[float, int]:
+    """
+    Разбирает курсор, созданный encode_search_cursor.
+    :raises HTTPException: если курсор повреждён
+    """
+    try:
+        data = _unpack_cursor(cursor)
+        return float(data["rank"]), int(data["id"])
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor"
+        )
+
+
+async def search_messages(chat_filter, q: str, limit: int, cursor: Optional[str]) -> list:
+    """
+    Полнотекстовый поиск по сообщениям через GIN-индекс ix_messages_text_tsv.
+    :param chat_filter: условие на Message.c.chat_id (один чат или чаты пользователя)
+    :param q: поисковая строка в синтаксисе websearch_to_tsquery
+    :return: строки messages с колонкой rank, по убыванию релевантности
+    """
+    ts_query = func.websearch_to_tsquery(SEARCH_TS_CONFIG, q)
+    rank = func.ts_rank_cd(MESSAGE_TSVECTOR, ts_query).label("rank")
+
+    query = select(Message, rank).where(chat_filter, MESSAGE_TSVECTOR.op("@@")(ts_query))
+    if cursor is not None:
+        before_rank, before_id = decode_search_cursor(cursor)
+        query = query.where(tuple_(rank, Message.c.id) < tuple_(before_rank, before_id))
+    query = query.order_by(rank.desc(), Message.c.id.desc()).limit(limit)
+    return await database.fetch_all(query)
+
+
+def serialize_message(row) -> dict:
+    """
+    Превращает строку таблицы messages в словарь для отправки по WebSocket.
+    """
+    return {
+        "id": row["id"],
+        "chat_id": row["chat_id"],
+        "sender_id": row["sender_id"],
+        "text": row["text"],
+        "created_at": row["created_at"].isoformat(),
+    }
+
+
+def utc_now() -> datetime:
+    """Текущее время в naive UTC, как в timestamp-колонках"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+async def persist_messages(messages: list[dict]):
+    """
+    Сохраняет пачку сообщений одним многострочным INSERT.
+    :param messages: словари с id, chat_id, sender_id, text, created_at
+    """
+    if not messages:
+        return
+    rows = [
+        {
+            "id": m["id"],
+            "chat_id": m["chat_id"],
+            "sender_id": m["sender_id"],
+            "text": m["text"],
+            "created_at": m["created_at"],
+            "updated_at": m["created_at"],
+        }
+        for m in messages
+    ]
+    async with database.transaction():
+        await database.execute(Message.insert().values(rows))
+        await increment_unread_counts(messages)
+
+
+async def increment_unread_counts(messages: list[dict]):
+    """
+    Увеличивает счётчики непрочитанных у участников чатов на новые сообщения.
+    Не учитываются собственные сообщения участника и сообщения не новее его
+    отметки прочитанного (по created_at и id). Один UPDATE на чат.
+    :param messages: словари с id, chat_id, sender_id, created_at
+    """
+    by_chat = defaultdict(list)
+    for m in messages:
+        by_chat[m["chat_id"]].append((m["id"], m["sender_id"], m["created_at"]))
+
+    for chat_id, rows in by_chat.items():
+        # Значения подставляются литералами: у параметров в VALUES Postgres не знает типов
+        batch = values(column("id", Integer), column("sender_id", Integer), column("created_at", DateTime),
+                       name="batch", literal_binds=True).data(rows)
+        increment = select(func.count()).select_from(batch).where(
+            or_(
+                ChatMember.c.last_read_at.is_(None),
+                # время в VALUES приходит строкой
+                tuple_(cast(batch.c.created_at, DateTime), batch.c.id)
+                > tuple_(ChatMember.c.last_read_at, ChatMember.c.last_read_message_id),
+            ),
+            batch.c.sender_id != ChatMember.c.user_id,
+        ).scalar_subquery()
+        await database.execute(
+            ChatMember.update()
+            .where(ChatMember.c.chat_id == chat_id)
+            .values(unread_count=ChatMember.c.unread_count + increment)
+        )
+
+
+def parse_resume_frame(frame: Optional[str]) -> Optional[dict]:
+    """
+    Распознаёт первый кадр клиента вида {"type": "resume", "last_seen_id": 123}.
+    :param frame: текст кадра
+    :return: словарь кадра или None, если это обычное сообщение
+    """
+    if not frame:
+        return None
+    try:
+        data = json.loads(frame)
+    except ValueError:
+        return None
+    if not isinstance(data, dict) or data.get("type") != "resume":
+        return None
+    last_seen_id = data.get("last_seen_id")
+    if last_seen_id is not None and not isinstance(last_seen_id, int):
+        return None
+    return data
+
+
+async def load_recent_messages(chat_id: int) -> tuple[list[dict], bool]:
+    """
+    Последние CHAT_RECENT_MESSAGES сообщений чата (от старых к новым) из
+    кольцевого буфера; при промахе или истёкшем буфере он прогревается из базы.
+    :return: (сообщения, буфер заполнен до предела — в базе могут быть более старые)
+    """
+    cached = recent_messages.get(chat_id)
+    if cached is not None:
+        return cached
+
+    version = recent_messages.version
+    query = (
+        select(Message)
+        .where(Message.c.chat_id == chat_id)
+        .order_by(Message.c.created_at.desc(), Message.c.id.desc())
+        .limit(recent_messages.capacity)
+    )
+    rows = await database.fetch_all(query)
+    return recent_messages.warm(chat_id, [serialize_message(row) for row in reversed(rows)], version)
+
+
+async def mark_read(chat_id: int, user_id: int, last_read_message_id: Optional[int] = None) -> dict:
+    """
+    Сдвигает отметку прочитанного участника вперёд (назад она не двигается)
+    и пересчитывает счётчик непрочитанных после неё. Порядок сообщений —
+    (created_at, id), а не id.
+    :param last_read_message_id: id сообщения чата; None — последнее сообщение
+    :return: словарь с chat_id, last_read_message_id, unread_count
+    """
+    recent, _ = await load_recent_messages(chat_id)
+    if last_read_message_id is None:
+        # Последнее сообщение — по времени, из буфера (он упорядочен по позиции)
+        position = message_position(recent[-1]) if recent else None
+    else:
+        message = next((m for m in recent if m["id"] == last_read_message_id), None)
+        if message is not None:
+            position = message_position(message)
+        else:
+            created_at = await database.fetch_val(select(Message.c.created_at).where(
+                Message.c.id == last_read_message_id, Message.c.chat_id == chat_id))
+            if created_at is None:
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Message not found")
+            position = created_at, last_read_message_id
+
+    member = ChatMember.c.chat_id == chat_id, ChatMember.c.user_id == user_id
+    if position is not None:
+        last_read_at, last_read_message_id = position
+        # Пересчёт затрагивает только сообщения после отметки
+        unread = select(func.count()).select_from(Message).where(
+            Message.c.chat_id == chat_id,
+            tuple_(Message.c.created_at, Message.c.id) > tuple_(last_read_at, last_read_message_id),
+            Message.c.sender_id != user_id,
+        ).scalar_subquery()
+        await database.execute(
+            ChatMember.update()
+            .where(*member, or_(
+                ChatMember.c.last_read_at.is_(None),
+                tuple_(ChatMember.c.last_read_at, ChatMember.c.last_read_message_id)
+                < tuple_(last_read_at, last_read_message_id),
+            ))
+            .values(last_read_message_id=last_read_message_id, last_read_at=last_read_at, unread_count=unread)
+        )
+
+    row = await database.fetch_one(
+        select(ChatMember.c.last_read_message_id, ChatMember.c.unread_count).where(*member))
+    return {"chat_id": chat_id, **row._mapping}
+
+
+async def replay_history(connection: "ChatConnection", last_seen_id: Optional[int] = None) -> Optional[dict]:
+    """
+    Досылает клиенту пропущенный хвост истории чата.
+
+    Отдаётся не больше CHAT_HISTORY_REPLAY_LIMIT сообщений новее last_seen_id.
+    Обычно хвост берётся из буфера последних сообщений; если клиент отстал
+    сильнее, строки читаются из базы до отправки. Сообщения уходят пакетами по
+    CHAT_HISTORY_BATCH_SIZE. Если пропущено больше лимита, JSON-клиент получает
+    в кадре history_end курсор для догрузки старых сообщений через
+    GET /chats/{chat_id}/messages.
+    :return: последнее отправленное сообщение или None
+    """
+    chat_id = connection.chat_id
+
+    recent, full = await load_recent_messages(chat_id)
+    tail = recent
+    if last_seen_id is not None:
+        # Новее — по (created_at, id), а не по id: id не упорядочены по времени
+        seen = next((m for m in recent if m["id"] == last_seen_id), None)
+        tail = None if seen is None else [m for m in recent if message_position(m) > message_position(seen)]
+    if tail is not None:
+        truncated = len(tail) > CHAT_HISTORY_REPLAY_LIMIT or (last_seen_id is None and full)
+        return await send_history(connection, _iterate(tail[-CHAT_HISTORY_REPLAY_LIMIT:]), truncated)
+
+    # Клиент отстал больше, чем хранит буфер: читаем из базы
+    newer = [Message.c.chat_id == chat_id]
+    last_seen_ts = await database.fetch_val(
+        select(Message.c.created_at).where(Message.c.id == last_seen_id, Message.c.chat_id == chat_id)
+    )
+    if last_seen_ts is not None:
+        newer.append(tuple_(Message.c.created_at, Message.c.id) > tuple_(last_seen_ts, last_seen_id))
+
+    # Первое сообщение, которое уже не помещается в лимит (считая с конца)
+    boundary = await database.fetch_one(
+        select(Message.c.created_at, Message.c.id)
+        .where(*newer)
+        .order_by(Message.c.created_at.desc(), Message.c.id.desc())
+        .offset(CHAT_HISTORY_REPLAY_LIMIT)
+        .limit(1)
+    )
+    query = select(Message).where(*newer)
+    if boundary:
+        query = query.where(tuple_(Message.c.created_at, Message.c.id) > tuple_(boundary["created_at"], boundary["id"]))
+    query = query.order_by(Message.c.created_at, Message.c.id)
+
+    # Строки читаются целиком (их не больше лимита), чтобы соединение с базой
+    # не держалось, пока медленный клиент принимает историю
+    rows = [serialize_message(row) for row in await database.fetch_all(query)]
+    return await send_history(connection, _iterate(rows), boundary is not None)
+
+
+async def _iterate(messages: list[dict]):
+    for message in messages:
+        yield message
+
+
+async def send_history(connection: "ChatConnection", messages: AsyncIterator[dict],
+                       truncated: bool) -> Optional[dict]:
+    """
+    Отправляет сообщения истории: JSON-клиентам пакетами с кадром history_end,
+    старым клиентам — по одной строке.
+    :return: последнее отправленное сообщение или None
+    """
+    first = last = None
+    batch = []
+    async for message in messages:
+        last = message
+        if first is None:
+            first = message
+        if connection.json_mode:
+            batch.append(message)
+            if len(batch) >= CHAT_HISTORY_BATCH_SIZE:
+                await connection.send_json({"type": "history", "messages": batch})
+                batch = []
+        else:
+            await connection.send_message(message)
 
-    return ChatResponse(**chat_dict)
+    if connection.json_mode:
+        if batch:
+            await connection.send_json({"type": "history", "messages": batch})
+        end_frame = {"type": "history_end", "truncated": truncated}
+        if truncated and first is not None:
+            end_frame["cursor"] = encode_cursor(datetime.fromisoformat(first["created_at"]), first["id"])
+        await connection.send_json(end_frame)
+    return last
@@ -0,0 +1,135 @@
+import asyncio
+import logging
+from collections import deque
+from typing import Optional
+
+from chat.managers import ChatConnection
+from chat.utils import persist_messages, serialize_message, utc_now
+from config import CHAT_WRITE_BEHIND_BATCH_SIZE, CHAT_WRITE_BEHIND_FLUSH_INTERVAL
+from database import database
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+flush_duration = metrics.histogram("chat_write_behind_flush_seconds", "Длительность записи одной пачки сообщений")
+flushed_messages = metrics.counter("chat_write_behind_messages_total", "Сообщения, записанные пачками")
+failed_messages = metrics.counter("chat_write_behind_failed_total", "Сообщения, которые не удалось записать")
+
+
+class MessageWriteBuffer:
+    """
+    Буфер отложенной записи сообщений чата.
+
+    id сообщения берётся из последовательности messages при отправке, поэтому
+    сообщение можно разослать сразу, а сохранить позже. Одновременные запросы
+    id обслуживаются одним nextval на всех, запаса id впрок не делается.
+    id уникальны, но не упорядочены по времени (их берут и другие воркеры):
+    порядок сообщений — только (created_at, id). Пачка сбрасывается
+    многострочным INSERT при наборе batch_size сообщений или раз в
+    flush_interval секунд. Если запись не удалась, отправители получают
+    JSON-кадр {"type": "error"} с id потерянного сообщения.
+    """
+
+    def __init__(self, batch_size: int = CHAT_WRITE_BEHIND_BATCH_SIZE,
+                 flush_interval: float = CHAT_WRITE_BEHIND_FLUSH_INTERVAL):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending: list[tuple[dict, Optional[ChatConnection]]] = []
+        self._ids: deque = deque()
+        # Сколько отправителей ждут id (включая того, кто сейчас их запрашивает)
+        self._id_requests = 0
+        self._ids_lock = asyncio.Lock()
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        metrics.gauge("chat_write_behind_pending", "Сообщения, ожидающие записи", func=lambda: len(self._pending))
+
+    async def start(self):
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """
+        Остановка фоновой задачи и финальный сброс буфера. Задача не
+        отменяется, а дожидается: пачка, которая уже пишется, не теряется.
+        """
+        if self._task is not None:
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+    async def submit(self, chat_id: int, sender_id: int, text: str,
+                     connection: Optional[ChatConnection] = None) -> dict:
+        """
+        Ставит сообщение в очередь на запись.
+        :return: сообщение в виде для рассылки (с уже известным id)
+        """
+        message = {
+            "id": await self._next_id(),
+            "chat_id": chat_id,
+            "sender_id": sender_id,
+            "text": text,
+            "created_at": utc_now(),
+        }
+        self._pending.append((message, connection))
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+        return serialize_message(message)
+
+    async def flush(self):
+        async with self._flush_lock:
+            while self._pending:
+                batch = self._pending[:self.batch_size]
+                del self._pending[:self.batch_size]
+                try:
+                    with flush_duration.time():
+                        await persist_messages([message for message, _ in batch])
+                    flushed_messages.inc(len(batch))
+                except asyncio.CancelledError:
+                    # Пачка возвращается в очередь и будет записана следующим flush
+                    self._pending[:0] = batch
+                    raise
+                except Exception as e:
+                    logger.error(f"Не удалось сохранить {len(batch)} сообщений: {e}")
+                    failed_messages.inc(len(batch))
+                    self._report_failure(batch)
+
+    async def _next_id(self) -> int:
+        self._id_requests += 1
+        try:
+            async with self._ids_lock:
+                if not self._ids:
+                    # Берётся ровно по id на каждого, кто сейчас ждёт
+                    rows = await database.fetch_all(
+                        query="SELECT nextval(pg_get_serial_sequence('messages', 'id')) AS id "
+                              "FROM generate_series(1, :count)",
+                        values={"count": self._id_requests},
+                    )
+                    self._ids.extend(row["id"] for row in rows)
+                return self._ids.popleft()
+        finally:
+            self._id_requests -= 1
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    @staticmethod
+    def _report_failure(batch: list[tuple[dict, Optional[ChatConnection]]]):
+        for message, connection in batch:
+            if connection is None or connection.closed or not connection.json_mode:
+                continue
+            connection.offer(ChatConnection.format_json({
+                "type": "error",
+                "detail": "Message was not saved",
+                "message_id": message["id"],
+            }))
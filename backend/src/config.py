@@ -2,6 +2,7 @@ import os
 from pathlib import Path
 
 import boto3
+from botocore.config import Config as BotoConfig
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -13,9 +14,13 @@ POSTGRES_HOST = os.getenv("POSTGRES_HOST")
 POSTGRES_PORT = os.getenv("POSTGRES_PORT")
 
 DATABASE_URL = f"postgresql+asyncpg://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
+# DSN для прямых asyncpg-соединений (LISTEN/NOTIFY)
+POSTGRES_DSN = f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
 STATIC_DIR = Path(__file__).resolve().parent.parent / "static"
 
 TOKEN_ENCODE_SECRET_KEY = os.getenv("TOKEN_ENCODE_SECRET_KEY")
+# Bearer-токен для GET /metrics; пусто — метрики наружу не отдаются (404)
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
 
 MINIO_ROOT_USER = os.getenv("MINIO_ROOT_USER")
 MINIO_ROOT_PASSWORD = os.getenv("MINIO_ROOT_PASSWORD")
@@ -25,6 +30,62 @@ ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_DAYS = 1
 REFRESH_TOKEN_EXPIRE_DAYS = 30
 
+# Хеширование паролей: стоимость bcrypt (хеши с другой стоимостью пересчитываются
+# при входе), потоки под bcrypt и предел запросов в работе и очереди (дальше — 503)
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", min(4, os.cpu_count() or 1)))
+PASSWORD_HASH_QUEUE_SIZE = int(os.getenv("PASSWORD_HASH_QUEUE_SIZE", 32))
+
+# Кэш проверенных access-токенов: токен -> (payload, пользователь). Запись живёт
+# до exp токена, но не дольше AUTH_TOKEN_CACHE_TTL_SECONDS
+AUTH_TOKEN_CACHE_SIZE = int(os.getenv("AUTH_TOKEN_CACHE_SIZE", 10000))
+AUTH_TOKEN_CACHE_TTL_SECONDS = float(os.getenv("AUTH_TOKEN_CACHE_TTL_SECONDS", 300))
+
+# Чат: сколько сообщений максимум отдаётся при подключении к WebSocket,
+# размер одного пакета истории и время ожидания кадра {"type": "resume"}
+CHAT_HISTORY_REPLAY_LIMIT = int(os.getenv("CHAT_HISTORY_REPLAY_LIMIT", 200))
+CHAT_HISTORY_BATCH_SIZE = int(os.getenv("CHAT_HISTORY_BATCH_SIZE", 50))
+CHAT_RESUME_TIMEOUT_SECONDS = float(os.getenv("CHAT_RESUME_TIMEOUT_SECONDS", 0.3))
+
+# Чат: исходящая очередь каждого соединения. Клиент, чья очередь переполнена
+# или дольше CHAT_SLOW_CLIENT_GRACE_SECONDS держится выше high-water, отключается
+CHAT_SEND_QUEUE_SIZE = int(os.getenv("CHAT_SEND_QUEUE_SIZE", 256))
+CHAT_SEND_QUEUE_HIGH_WATER = int(os.getenv("CHAT_SEND_QUEUE_HIGH_WATER", 128))
+CHAT_SLOW_CLIENT_GRACE_SECONDS = float(os.getenv("CHAT_SLOW_CLIENT_GRACE_SECONDS", 5))
+
+# Чат: рассылка между воркерами. "postgres" — LISTEN/NOTIFY, "memory" — только текущий процесс
+CHAT_BROADCAST_BACKEND = os.getenv("CHAT_BROADCAST_BACKEND", "postgres")
+CHAT_NOTIFY_CHANNEL = os.getenv("CHAT_NOTIFY_CHANNEL", "chat_events")
+
+# Чат: отложенная пакетная запись сообщений (write-behind). Сообщение рассылается
+# сразу, а в messages попадает пачкой по размеру или по таймеру
+CHAT_WRITE_BEHIND = os.getenv("CHAT_WRITE_BEHIND", "false").lower() in ("1", "true", "yes")
+CHAT_WRITE_BEHIND_BATCH_SIZE = int(os.getenv("CHAT_WRITE_BEHIND_BATCH_SIZE", 200))
+CHAT_WRITE_BEHIND_FLUSH_INTERVAL = float(os.getenv("CHAT_WRITE_BEHIND_FLUSH_INTERVAL", 0.05))
+
+# Чат: кэш "чат -> участники" в памяти процесса
+CHAT_CACHE_SIZE = int(os.getenv("CHAT_CACHE_SIZE", 10000))
+CHAT_CACHE_TTL_SECONDS = float(os.getenv("CHAT_CACHE_TTL_SECONDS", 30))
+
+# Чат: кольцевой буфер последних сообщений каждого чата и общий бюджет памяти на все буферы
+CHAT_RECENT_MESSAGES = int(os.getenv("CHAT_RECENT_MESSAGES", 200))
+CHAT_RECENT_MEMORY_BUDGET = int(os.getenv("CHAT_RECENT_MEMORY_BUDGET_MB", 64)) * 1024 * 1024
+# Через сколько секунд прогретый буфер заново сверяется с базой
+CHAT_RECENT_TTL_SECONDS = float(os.getenv("CHAT_RECENT_TTL_SECONDS", 60))
+
+# Чат: конфигурация полнотекстового поиска Postgres (должна совпадать с GIN-индексом messages)
+CHAT_SEARCH_TS_CONFIG = os.getenv("CHAT_SEARCH_TS_CONFIG", "russian")
+
+# Чат: помесячные секции messages. Секции старше CHAT_ARCHIVE_AFTER_MONTHS месяцев
+# выгружаются в MinIO сжатыми NDJSON-сегментами и удаляются (0 — не архивировать)
+CHAT_PARTITION_PREMAKE_MONTHS = int(os.getenv("CHAT_PARTITION_PREMAKE_MONTHS", 2))
+CHAT_ARCHIVE_AFTER_MONTHS = int(os.getenv("CHAT_ARCHIVE_AFTER_MONTHS", 12))
+CHAT_ARCHIVE_BUCKET = os.getenv("CHAT_ARCHIVE_BUCKET", "chat-archive")
+CHAT_ARCHIVE_INTERVAL_SECONDS = float(os.getenv("CHAT_ARCHIVE_INTERVAL_SECONDS", 3600))
+CHAT_ARCHIVE_SEGMENT_CACHE_SIZE = int(os.getenv("CHAT_ARCHIVE_SEGMENT_CACHE_SIZE", 16))
+# Сколько сообщений читается из секции за один запрос при выгрузке сегмента
+CHAT_ARCHIVE_BATCH_SIZE = int(os.getenv("CHAT_ARCHIVE_BATCH_SIZE", 1000))
+
 SUPPORTED_COLLABORA_EXTENSIONS = [
     # Текстовые документы
     ".odt", ".doc", ".docx", ".rtf", ".txt",
@@ -36,13 +97,53 @@ SUPPORTED_COLLABORA_EXTENSIONS = [
     ".odp", ".ppt", ".pptx",
 ]
 
+# S3 (MinIO): размер пула HTTP-соединений boto3 и потоков storage.py, в которых
+# выполняются синхронные вызовы boto3. Потоков не больше, чем соединений
+S3_MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS", 32))
+S3_EXECUTOR_WORKERS = int(os.getenv("S3_EXECUTOR_WORKERS", S3_MAX_POOL_CONNECTIONS))
+
+# Размер части multipart-загрузки (S3 требует не меньше 5 МиБ для всех частей, кроме последней)
+S3_UPLOAD_PART_SIZE = max(int(os.getenv("S3_UPLOAD_PART_SIZE", 8 * 1024 * 1024)), 5 * 1024 * 1024)
+
 S3_CLIENT = boto3.client(
     's3',
     endpoint_url='http://minio:9000',
     aws_access_key_id=MINIO_ROOT_USER,
     aws_secret_access_key=MINIO_ROOT_PASSWORD,
     region_name='us-east-1',
+    config=BotoConfig(max_pool_connections=S3_MAX_POOL_CONNECTIONS),
 )
 
+# Адрес MinIO, доступный браузеру: по нему подписываются временные ссылки на
+# скачивание и загрузку файлов. Пусто — ссылки не выдаются, байты идут через backend
+S3_PUBLIC_ENDPOINT_URL = os.getenv("S3_PUBLIC_ENDPOINT_URL", "")
+S3_PRESIGN_CLIENT = boto3.client(
+    's3',
+    endpoint_url=S3_PUBLIC_ENDPOINT_URL,
+    aws_access_key_id=MINIO_ROOT_USER,
+    aws_secret_access_key=MINIO_ROOT_PASSWORD,
+    region_name='us-east-1',
+    config=BotoConfig(signature_version='s3v4'),
+) if S3_PUBLIC_ENDPOINT_URL else None
+S3_PRESIGNED_URL_TTL_SECONDS = int(os.getenv("S3_PRESIGNED_URL_TTL_SECONDS", 300))
+
 WOPI_BUCKET = "wopi"
+# Сколько head_object одновременно выполняет GET /wopi/files
+WOPI_LIST_HEAD_CONCURRENCY = int(os.getenv("WOPI_LIST_HEAD_CONCURRENCY", 16))
+# Максимальный размер файла, сохраняемого через PutFile
+WOPI_MAX_FILE_SIZE = int(os.getenv("WOPI_MAX_FILE_SIZE", 100 * 1024 * 1024))
+# Дисковый кэш файлов WOPI перед S3: каталог (пусто — кэш выключен), объём на
+# один воркер (у каждого свой подкаталог) и максимальный размер кэшируемого файла
+WOPI_DISK_CACHE_DIR = os.getenv("WOPI_DISK_CACHE_DIR", "")
+WOPI_DISK_CACHE_MAX_BYTES = int(os.getenv("WOPI_DISK_CACHE_MAX_BYTES", 1024 * 1024 * 1024))
+WOPI_DISK_CACHE_MAX_OBJECT_BYTES = int(os.getenv("WOPI_DISK_CACHE_MAX_OBJECT_BYTES", 64 * 1024 * 1024))
+# Режим хранения файлов WOPI: direct — объект под путём файла, cas — содержимое в
+# общих блобах по sha256 (одинаковые файлы хранятся один раз)
+WOPI_STORAGE_MODE = os.getenv("WOPI_STORAGE_MODE", "direct")
+if WOPI_STORAGE_MODE not in ("direct", "cas"):
+    raise ValueError(f"Invalid WOPI_STORAGE_MODE: {WOPI_STORAGE_MODE}")
+# Блоб без ссылок удаляется не раньше, чем через столько секунд
+WOPI_BLOB_GC_GRACE_SECONDS = int(os.getenv("WOPI_BLOB_GC_GRACE_SECONDS", 3600))
+# Период сверки каталога files с бакетом
+WOPI_CATALOG_RECONCILE_INTERVAL_SECONDS = float(os.getenv("WOPI_CATALOG_RECONCILE_INTERVAL_SECONDS", 600))
 
@@ -1,11 +1,6 @@
 from config import DATABASE_URL
 from databases import Database
-from sqlalchemy import MetaData, create_engine
+from sqlalchemy import MetaData
 
 database = Database(DATABASE_URL)
 metadata = MetaData()
-
-
-def create_tables():
-    engine = create_engine(str(DATABASE_URL).replace("+asyncpg", ""))
-    metadata.create_all(engine)
\ No newline at end of file
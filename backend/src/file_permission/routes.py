@@ -1,6 +1,5 @@
 from fastapi import APIRouter, Depends, HTTPException, Query
-from auth.utils import get_current_user
-from auth.tables import User
+from auth.utils import Principal, get_current_principal
 from file_permission.utils import add_permission, revoke_permission, check_file_access
 from file_permission.schemas import RIGHT_TYPES, FilePermissionGrant
 from models.utils import DetailResponse
@@ -15,7 +14,7 @@ router = APIRouter(prefix="/rights")
 })
 async def list_file_permissions(
         file_path: str = Query(..., description="Путь к файлу"),
-        current_user: User = Depends(get_current_user),
+        current_user: Principal = Depends(get_current_principal),
 ):
     # Проверяем, что юзер владелец файла
     if not await check_file_access(file_path, current_user.id, RIGHT_TYPES.OWNER):
@@ -31,7 +30,7 @@ async def list_file_permissions(
 })
 async def grant_file_permission(
         fp: FilePermissionGrant,
-        current_user: User = Depends(get_current_user),
+        current_user: Principal = Depends(get_current_principal),
 ):
     if not await check_file_access(fp.file_path, current_user.id, RIGHT_TYPES.OWNER):
         raise HTTPException(403, detail="Только владелец может выдавать права")
@@ -50,7 +49,7 @@ async def grant_file_permission(
 async def revoke_file_permission(
         file_path: str,
         user_id: int,
-        current_user: User = Depends(get_current_user),
+        current_user: Principal = Depends(get_current_principal),
 ):
     if not await check_file_access(file_path, current_user.id, RIGHT_TYPES.OWNER):
         raise HTTPException(403, detail="Только владелец может отзывать права")
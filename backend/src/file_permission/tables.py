@@ -1,5 +1,5 @@
 from database import metadata
-from sqlalchemy import Column, Integer, String, Table,  Enum, ForeignKey
+from sqlalchemy import Column, Integer, String, Table,  Enum, ForeignKey, Index
 from enum import Enum as PyEnum
 
 class RightsType(str, PyEnum):
@@ -14,4 +14,5 @@ FilePermissions = Table(
     Column("file_path", String, index=True),
     Column("user_id", Integer, ForeignKey("users.id")),
     Column("rights_type", Enum(RightsType)),
+    Index("ix_file_permissions_file_path_user_id", "file_path", "user_id"),
 )
\ No newline at end of file
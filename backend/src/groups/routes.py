@@ -8,14 +8,14 @@ from database import database
 from groups.tables import Invitations, Groups, UserGroups
 from groups.utils import create_group, update_invite_status, check_success
 from groups.schemas import GroupCreate, GroupResponse, InviteResponse, InviteStatus, InviteCreate
-from auth.utils import get_current_user
+from auth.utils import get_current_principal
 from models.utils import DetailResponse
 
 groups_router = APIRouter(prefix="/groups")
 
 
 @groups_router.post("/", response_model=GroupResponse)
-async def create_new_group(group: GroupCreate, current_user=Depends(get_current_user)):
+async def create_new_group(group: GroupCreate, current_user=Depends(get_current_principal)):
     group_id = await create_group(group.name, current_user.id)
     return GroupResponse(id=group_id, name=group.name, creator_id=current_user.id)
 
@@ -48,7 +48,7 @@ async def enrich_groups_with_members(groups_list: list[dict]) -> list[GroupRespo
 
 
 @groups_router.get("/member/", response_model=list[GroupResponse])
-async def get_user_groups(current_user=Depends(get_current_user)):
+async def get_user_groups(current_user=Depends(get_current_principal)):
     """Получить все группы, в которых состоит пользователь"""
     query = select(Groups).join(UserGroups).where(UserGroups.c.user_id == current_user.id)
     groups_list = await database.fetch_all(query)
@@ -56,7 +56,7 @@ async def get_user_groups(current_user=Depends(get_current_user)):
 
 
 @groups_router.get("/creator/", response_model=list[GroupResponse])
-async def get_created_groups(current_user=Depends(get_current_user)):
+async def get_created_groups(current_user=Depends(get_current_principal)):
     """Получить все группы, созданные пользователем"""
     query = select(Groups).where(Groups.c.creator_id == current_user.id)
     groups_list = await database.fetch_all(query)
@@ -102,7 +102,7 @@ invites_router = APIRouter(prefix="/invites")
 
 
 @invites_router.post("/", response_model=InviteResponse)
-async def create_invite(invite: InviteCreate, current_user=Depends(get_current_user)):
+async def create_invite(invite: InviteCreate, current_user=Depends(get_current_principal)):
     """Создать приглашение в группу"""
     if current_user.id == invite.recipient_id:
         raise HTTPException(status_code=400, detail="Cannot invite yourself")
@@ -170,7 +170,7 @@ async def create_invite(invite: InviteCreate, current_user=Depends(get_current_u
 
 
 @invites_router.get("/", response_model=list[InviteResponse])
-async def list_incoming_invites(current_user=Depends(get_current_user)):
+async def list_incoming_invites(current_user=Depends(get_current_principal)):
     """
     Получить все входящие инвайты для текущего пользователя
     """
@@ -181,7 +181,7 @@ async def list_incoming_invites(current_user=Depends(get_current_user)):
 
 
 @invites_router.post("/{invite_id}/accept", response_model=InviteResponse)
-async def accept_invite(invite_id: int, current_user=Depends(get_current_user)):
+async def accept_invite(invite_id: int, current_user=Depends(get_current_principal)):
     """Принять приглашение в группу"""
     success = await update_invite_status(invite_id, InviteStatus.ACCEPTED, current_user.id)
     if not success:
@@ -195,7 +195,7 @@ async def accept_invite(invite_id: int, current_user=Depends(get_current_user)):
 
 
 @invites_router.post("/{invite_id}/decline", response_model=InviteResponse)
-async def decline_invite(invite_id: int, current_user=Depends(get_current_user)):
+async def decline_invite(invite_id: int, current_user=Depends(get_current_principal)):
     """Отклонить приглашение в группу"""
     success = await update_invite_status(invite_id, InviteStatus.DECLINED, current_user.id)
     if not success:
@@ -1,4 +1,4 @@
-from sqlalchemy import Table, Column, Integer, String, ForeignKey
+from sqlalchemy import Table, Column, Integer, String, ForeignKey, Index
 from database import metadata
 from groups.schemas import InviteStatus
 from models.utils import timestamp_columns
@@ -27,4 +27,5 @@ Invitations = Table(
     Column("recipient_id", Integer, ForeignKey("users.id"), nullable=False),
     Column("status", String, default=InviteStatus.PENDING, nullable=False),
     *timestamp_columns(),
+    Index("ix_invitations_recipient_id_status", "recipient_id", "status"),
 )
@@ -1,21 +1,26 @@
+import secrets
 from contextlib import asynccontextmanager
 from pathlib import Path
 
 from fastapi.security import HTTPAuthorizationCredentials
 
 from auth.routes import auth_router, user_router
-from auth.utils import security, get_user_by_token
-from chat.routes import router as chat_router
+from auth.utils import security, get_principal_by_token
+from chat.archive import message_archive
+from chat.routes import manager as chat_manager, message_writer, router as chat_router
 from file_permission.routes import router as file_permission_router
 from groups.routes import groups_router, invites_router
-from config import SUPPORTED_COLLABORA_EXTENSIONS, WOPI_BUCKET
-from database import create_tables, database
+import metrics
+from config import CHAT_ARCHIVE_BUCKET, METRICS_TOKEN, SUPPORTED_COLLABORA_EXTENSIONS, WOPI_BUCKET
+from database import database
+from migrations import migrate
 from bucket import create_bucket_if_not_exists
 from fastapi import FastAPI, HTTPException, Query, Depends
 from fastapi.middleware.cors import CORSMiddleware
 
 from file_permission.schemas import RIGHT_TYPES
 from file_permission.utils import check_file_access
+from wopi.catalog import file_catalog
 from wopi.router import router as wopi_router
 
 from pydantic import BaseModel
@@ -27,10 +32,23 @@ class CollaboraUrlResponse(BaseModel):
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    create_tables()
-    create_bucket_if_not_exists(WOPI_BUCKET)
+    await migrate()
+    await create_bucket_if_not_exists(WOPI_BUCKET)
+    await create_bucket_if_not_exists(CHAT_ARCHIVE_BUCKET)
     await database.connect()
+    await chat_manager.start()
+    if message_writer is not None:
+        await message_writer.start()
+    await message_archive.start()
+    await file_catalog.start()
     yield
+    await file_catalog.stop()
+    await message_archive.stop()
+    if message_writer is not None:
+        # Дописываем в базу всё, что осталось в буфере, пока отправители ещё
+        # подключены и могут получить кадр об ошибке записи
+        await message_writer.stop()
+    await chat_manager.stop()
     await database.disconnect()
 
 
@@ -50,6 +68,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 
@@ -58,11 +77,24 @@ async def read_root():
     return {"message": "Hello, World!"}
 
 
+@app.get("/metrics", include_in_schema=False)
+async def read_metrics(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """
+    Метрики процесса (очереди WebSocket, задержки доставки и т.п.).
+    Доступны только с токеном METRICS_TOKEN; без него эндпоинт выключен.
+    """
+    if not METRICS_TOKEN:
+        raise HTTPException(status_code=404)
+    if not secrets.compare_digest(credentials.credentials.encode(), METRICS_TOKEN.encode()):
+        raise HTTPException(status_code=403)
+    return metrics.snapshot()
+
+
 @app.get("/get-collabora-url", response_model=CollaboraUrlResponse)
 async def get_collabora_url(file_path: str = Query(...), credentials: HTTPAuthorizationCredentials = Depends(security)):
     ext = Path(file_path).suffix.lower()
     token = credentials.credentials
-    user = await get_user_by_token(token)
+    user = await get_principal_by_token(token)
 
     if not await check_file_access(file_path, user.id, RIGHT_TYPES.VIEWER):
         raise HTTPException(status_code=403)
@@ -0,0 +1,118 @@
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+
+# Простейший реестр метрик процесса, отдаётся через GET /metrics (по METRICS_TOKEN)
+_registry: Dict[str, "Metric"] = {}
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metric(ABC):
+    kind = "metric"
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+
+    @abstractmethod
+    def snapshot(self) -> dict:
+        """Значения метрики для ответа /metrics"""
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, description: str):
+        super().__init__(name, description)
+        self.value = 0
+
+    def inc(self, amount: int = 1):
+        self.value += amount
+
+    def snapshot(self) -> dict:
+        return {"value": self.value}
+
+
+class Gauge(Metric):
+    """Значение задаётся вручную или вычисляется функцией в момент снятия метрик"""
+    kind = "gauge"
+
+    def __init__(self, name: str, description: str, func: Optional[Callable[[], float]] = None):
+        super().__init__(name, description)
+        self.value = 0
+        self.func = func
+
+    def set(self, value: float):
+        self.value = value
+
+    def snapshot(self) -> dict:
+        return {"value": self.func() if self.func else self.value}
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description)
+        self.buckets = tuple(buckets)
+        self.bucket_counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+                break
+
+    @contextmanager
+    def time(self):
+        """Замеряет длительность блока в секундах"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def snapshot(self) -> dict:
+        cumulative = 0
+        buckets = {}
+        for bound, bucket_count in zip(self.buckets, self.bucket_counts):
+            cumulative += bucket_count
+            buckets[str(bound)] = cumulative
+        buckets["+Inf"] = self.count
+        return {"count": self.count, "sum": self.sum, "max": self.max, "buckets": buckets}
+
+
+def _register(metric_class, name: str, description: str, **kwargs):
+    metric = _registry.get(name)
+    if metric is None:
+        metric = metric_class(name, description, **kwargs)
+        _registry[name] = metric
+    return metric
+
+
+def counter(name: str, description: str) -> Counter:
+    return _register(Counter, name, description)
+
+
+def gauge(name: str, description: str, func: Optional[Callable[[], float]] = None) -> Gauge:
+    return _register(Gauge, name, description, func=func)
+
+
+def histogram(name: str, description: str, buckets=DEFAULT_BUCKETS) -> Histogram:
+    return _register(Histogram, name, description, buckets=buckets)
+
+
+def snapshot() -> dict:
+    """Текущие значения всех зарегистрированных метрик"""
+    return {
+        name: {"type": metric.kind, "description": metric.description, **metric.snapshot()}
+        for name, metric in sorted(_registry.items())
+    }
@@ -0,0 +1,181 @@
+import logging
+from typing import Callable, NamedTuple
+
+import auth.tables  # noqa: F401 — таблицы регистрируются в metadata при импорте
+import chat.tables  # noqa: F401
+import file_permission.tables  # noqa: F401
+import groups.tables  # noqa: F401
+from chat.archive import prepare_partitions
+from config import CHAT_SEARCH_TS_CONFIG, DATABASE_URL
+from database import metadata
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine, create_async_engine
+from wopi.tables import Blobs, Files
+
+logger = logging.getLogger(__name__)
+
+# Ключ advisory-блокировки: миграции применяет один воркер, остальные ждут
+MIGRATIONS_LOCK_ID = 0x6D696772
+
+
+class Migration(NamedTuple):
+    """
+    Шаг схемы. apply получает синхронное соединение SQLAlchemy.
+    transactional=False — шаг выполняется в autocommit (нужно для CONCURRENTLY).
+    """
+    version: int
+    name: str
+    apply: Callable
+    transactional: bool = True
+
+
+def _statements(*statements: str) -> Callable:
+    def apply(connection):
+        for statement in statements:
+            connection.execute(text(statement))
+    return apply
+
+
+def _create_index_concurrently(connection, name: str, table: str, columns: str, using: str = "btree"):
+    # Прерванный CREATE INDEX CONCURRENTLY оставляет невалидный индекс — пересоздаём его
+    invalid = connection.execute(text(
+        "SELECT NOT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+        "WHERE c.relname = :name"
+    ), {"name": name}).scalar()
+    if invalid:
+        connection.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+    connection.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} USING {using} ({columns})"))
+
+
+def _create_partitioned_index(connection, name: str, table: str, columns: str, using: str = "btree"):
+    """
+    Индекс секционированной таблицы без блокировки записи на время
+    построения: пустой индекс на самой таблице (ON ONLY), затем
+    CONCURRENTLY на каждой секции с присоединением к нему. Когда
+    присоединены все секции, индекс таблицы становится валидным; новые
+    секции получают его сами. Прерванный шаг продолжается с места остановки.
+    """
+    valid = connection.execute(text(
+        "SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = :name"
+    ), {"name": name}).scalar()
+    if valid:
+        return
+    connection.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON ONLY {table} USING {using} ({columns})"))
+    # Секции, к которым индекс ещё не присоединён
+    partitions = connection.execute(text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = CAST(:table AS regclass) AND NOT EXISTS ("
+        "SELECT 1 FROM pg_inherits a JOIN pg_index x ON x.indexrelid = a.inhrelid "
+        "WHERE a.inhparent = CAST(:name AS regclass) AND x.indrelid = i.inhrelid)"
+    ), {"table": table, "name": name}).scalars().all()
+    for partition in partitions:
+        partition_index = name.replace(table, partition, 1)
+        _create_index_concurrently(connection, partition_index, partition, columns, using)
+        connection.execute(text(f"ALTER INDEX {name} ATTACH PARTITION {partition_index}"))
+
+
+def _create_message_indexes(connection):
+    # Выражение должно совпадать с MESSAGE_TSVECTOR из chat.tables, иначе поиск не использует индекс
+    _create_partitioned_index(connection, "ix_messages_chat_id_created_at_id", "messages", "chat_id, created_at, id")
+    _create_partitioned_index(connection, "ix_messages_text_tsv", "messages",
+                              f"to_tsvector('{CHAT_SEARCH_TS_CONFIG}'::regconfig, text)", using="gin")
+
+
+def _create_lookup_indexes(connection):
+    # messages(chat_id, created_at) покрывает ix_messages_chat_id_created_at_id: он есть в
+    # описании таблицы, а на секционированной таблице CONCURRENTLY не поддерживается
+    _create_index_concurrently(connection, "ix_users_email", "users", "email")
+    _create_index_concurrently(connection, "ix_chat_members_chat_id_user_id", "chat_members", "chat_id, user_id")
+    _create_index_concurrently(connection, "ix_invitations_recipient_id_status", "invitations", "recipient_id, status")
+    _create_index_concurrently(connection, "ix_file_permissions_file_path_user_id", "file_permissions",
+                               "file_path, user_id")
+
+
+def _create_file_blobs(connection):
+    Blobs.create(connection, checkfirst=True)
+    connection.execute(text("ALTER TABLE files ADD COLUMN IF NOT EXISTS blob VARCHAR(64)"))
+
+
+# Только дописывать в конец: номер версии применённого шага хранится в schema_migrations
+MIGRATIONS = [
+    # Недостающие таблицы со всеми индексами; существующие таблицы не трогаются,
+    # индексы к ним добавляются отдельными шагами (5, 9)
+    Migration(1, "create tables", lambda connection: metadata.create_all(connection)),
+    Migration(2, "chat member unread counters", _statements(
+        "ALTER TABLE chat_members ADD COLUMN IF NOT EXISTS last_read_message_id INTEGER",
+        "ALTER TABLE chat_members ADD COLUMN IF NOT EXISTS unread_count INTEGER NOT NULL DEFAULT 0",
+    )),
+    Migration(3, "user token version", _statements(
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS token_version INTEGER NOT NULL DEFAULT 0",
+    )),
+    Migration(4, "monthly messages partitions", prepare_partitions),
+    Migration(5, "lookup indexes", _create_lookup_indexes, transactional=False),
+    # Заполняется сверкой wopi.catalog после запуска
+    Migration(6, "files catalog", lambda connection: Files.create(connection, checkfirst=True)),
+    Migration(7, "content-addressed file blobs", _create_file_blobs),
+    # Время прочитанного сообщения; для выгруженных в архив остаётся NULL
+    Migration(8, "chat member read position", _statements(
+        "ALTER TABLE chat_members ADD COLUMN IF NOT EXISTS last_read_at TIMESTAMP",
+        "UPDATE chat_members SET last_read_at = m.created_at FROM messages m "
+        "WHERE m.id = chat_members.last_read_message_id AND m.chat_id = chat_members.chat_id "
+        "AND chat_members.last_read_at IS NULL",
+    )),
+    # После шага 4 на таблице, переведённой со старой схемы, индексов ещё нет
+    Migration(9, "messages history and search indexes", _create_message_indexes, transactional=False),
+]
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+async def _current_version(connection: AsyncConnection) -> int:
+    exists = await connection.scalar(text("SELECT to_regclass('schema_migrations') IS NOT NULL"))
+    if not exists:
+        return 0
+    return await connection.scalar(text("SELECT COALESCE(max(version), 0) FROM schema_migrations"))
+
+
+async def _apply(engine: AsyncEngine, migration: Migration):
+    logger.info(f"Применяю миграцию {migration.version}: {migration.name}...")
+    if migration.transactional:
+        context = engine.begin()
+    else:
+        context = engine.connect()
+    async with context as connection:
+        if not migration.transactional:
+            await connection.execution_options(isolation_level="AUTOCOMMIT")
+        await connection.run_sync(migration.apply)
+        await connection.execute(
+            text("INSERT INTO schema_migrations (version, name) VALUES (:version, :name)"),
+            {"version": migration.version, "name": migration.name},
+        )
+
+
+async def migrate():
+    """
+    Приводит схему базы к LATEST_VERSION.
+
+    Если схема актуальна, выполняется только чтение версии — без DDL.
+    Иначе под advisory-блокировкой по порядку применяются недостающие шаги;
+    транзакционный шаг записывает свою версию в той же транзакции.
+    """
+    engine = create_async_engine(DATABASE_URL)
+    try:
+        async with engine.connect() as connection:
+            await connection.execution_options(isolation_level="AUTOCOMMIT")
+            if await _current_version(connection) == LATEST_VERSION:
+                return
+
+            await connection.execute(text("SELECT pg_advisory_lock(:id)"), {"id": MIGRATIONS_LOCK_ID})
+            try:
+                await connection.execute(text(
+                    "CREATE TABLE IF NOT EXISTS schema_migrations ("
+                    "version INTEGER PRIMARY KEY, name VARCHAR NOT NULL, "
+                    "applied_at TIMESTAMP NOT NULL DEFAULT now())"
+                ))
+                current = await _current_version(connection)
+                for migration in MIGRATIONS:
+                    if migration.version > current:
+                        await _apply(engine, migration)
+            finally:
+                await connection.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": MIGRATIONS_LOCK_ID})
+    finally:
+        await engine.dispose()
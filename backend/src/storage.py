@@ -0,0 +1,195 @@
+import asyncio
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import AsyncIterable, AsyncIterator, Awaitable, Callable, NamedTuple, Optional
+
+from botocore.exceptions import ClientError
+
+from config import (S3_CLIENT, S3_EXECUTOR_WORKERS, S3_MAX_POOL_CONNECTIONS, S3_PRESIGN_CLIENT,
+                    S3_PRESIGNED_URL_TTL_SECONDS, S3_UPLOAD_PART_SIZE)
+
+import metrics
+
+# Размер куска при потоковом чтении тела объекта
+STREAM_CHUNK_SIZE = 256 * 1024
+
+
+class ObjectTooLarge(Exception):
+    """Загружаемый поток больше допустимого размера (загрузка отменена)"""
+
+
+class UploadResult(NamedTuple):
+    size: int
+    etag: Optional[str]
+    sha256: str
+    # False — skip отказался от записи, объект не создан и не перезаписан
+    written: bool = True
+
+
+def is_not_found(error: ClientError) -> bool:
+    return error.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound", "NoSuchBucket")
+
+
+class ObjectStorage:
+    """
+    Асинхронный доступ к S3 (MinIO) поверх синхронного boto3.
+
+    Каждый вызов boto3 выполняется в собственном ограниченном пуле потоков,
+    размер которого согласован с пулом соединений клиента, поэтому обращения
+    к хранилищу не блокируют цикл событий и не ждут свободного соединения
+    внутри потока. Для каждой операции собирается гистограмма задержек
+    s3_<операция>_seconds и счётчик ошибок s3_errors_total.
+    """
+
+    def __init__(self, client=S3_CLIENT, workers: int = S3_EXECUTOR_WORKERS, presign_client=S3_PRESIGN_CLIENT):
+        self.client = client
+        # Подписывает ссылки для браузера (S3_PUBLIC_ENDPOINT_URL); None — ссылки не выдаются
+        self.presign_client = presign_client
+        self._executor = ThreadPoolExecutor(max_workers=min(workers, S3_MAX_POOL_CONNECTIONS),
+                                            thread_name_prefix="s3")
+        self.errors = metrics.counter("s3_errors_total", "Ошибки обращений к S3")
+
+    async def _call(self, operation: str, func, *args, **kwargs):
+        histogram = metrics.histogram(f"s3_{operation}_seconds", f"Длительность S3 {operation}")
+        try:
+            with histogram.time():
+                return await asyncio.get_running_loop().run_in_executor(
+                    self._executor, partial(func, *args, **kwargs))
+        except ClientError:
+            self.errors.inc()
+            raise
+
+    async def head_bucket(self, bucket: str):
+        return await self._call("head_bucket", self.client.head_bucket, Bucket=bucket)
+
+    async def create_bucket(self, bucket: str, **kwargs):
+        return await self._call("create_bucket", self.client.create_bucket, Bucket=bucket, **kwargs)
+
+    async def head_object(self, bucket: str, key: str) -> Optional[dict]:
+        """Метаданные объекта или None, если его нет"""
+        try:
+            return await self._call("head_object", self.client.head_object, Bucket=bucket, Key=key)
+        except ClientError as e:
+            if is_not_found(e):
+                return None
+            raise
+
+    async def get_object(self, bucket: str, key: str, **kwargs) -> dict:
+        """Ответ get_object; тело читается через read_body или iter_body"""
+        return await self._call("get_object", self.client.get_object, Bucket=bucket, Key=key, **kwargs)
+
+    async def read_object(self, bucket: str, key: str) -> bytes:
+        response = await self.get_object(bucket, key)
+        return await self.read_body(response["Body"])
+
+    async def read_body(self, body) -> bytes:
+        return await self._call("read_body", body.read)
+
+    async def iter_body(self, body, chunk_size: int = STREAM_CHUNK_SIZE) -> AsyncIterator[bytes]:
+        """Потоковое чтение тела объекта кусками в пуле потоков"""
+        try:
+            while True:
+                chunk = await self._call("read_chunk", body.read, chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            body.close()
+
+    async def list_objects(self, bucket: str, prefix: str = "") -> AsyncIterator[list[dict]]:
+        """Объекты бакета страницами list_objects_v2 (до 1000 штук)"""
+        kwargs = {"Bucket": bucket, "Prefix": prefix}
+        while True:
+            page = await self._call("list_objects", self.client.list_objects_v2, **kwargs)
+            yield page.get("Contents", [])
+            if not page.get("IsTruncated"):
+                break
+            kwargs["ContinuationToken"] = page["NextContinuationToken"]
+
+    async def put_object(self, bucket: str, key: str, body: bytes, **kwargs) -> dict:
+        return await self._call("put_object", self.client.put_object, Bucket=bucket, Key=key, Body=body, **kwargs)
+
+    async def upload_stream(self, bucket: str, key: str, chunks: AsyncIterable[bytes],
+                            max_size: Optional[int] = None, part_size: int = S3_UPLOAD_PART_SIZE,
+                            skip: Optional[Callable[[str], Awaitable[bool]]] = None, **kwargs) -> UploadResult:
+        """
+        Загрузка потока кусками по part_size байт: в памяти держится не больше
+        одной части. Поток не длиннее одной части пишется обычным put_object,
+        длиннее — multipart-загрузкой, которая отменяется при любой ошибке
+        (в том числе обрыве соединения клиента и превышении max_size).
+        skip вызывается с sha256 прочитанного потока: если он вернул True,
+        объект не записывается (уже загруженные части отменяются).
+        kwargs (ContentType и т.п.) передаются в put_object/create_multipart_upload.
+        """
+        buffer = bytearray()
+        digest = hashlib.sha256()
+        size = 0
+        upload_id = None
+        parts = []
+        try:
+            async for chunk in chunks:
+                size += len(chunk)
+                if max_size is not None and size > max_size:
+                    raise ObjectTooLarge(f"Object is larger than {max_size} bytes")
+                digest.update(chunk)
+                buffer += chunk
+                while len(buffer) >= part_size:
+                    if upload_id is None:
+                        upload = await self._call("create_multipart_upload", self.client.create_multipart_upload,
+                                                  Bucket=bucket, Key=key, **kwargs)
+                        upload_id = upload["UploadId"]
+                    part = bytes(buffer[:part_size])
+                    del buffer[:part_size]
+                    parts.append(await self._upload_part(bucket, key, upload_id, len(parts) + 1, part))
+
+            sha256 = digest.hexdigest()
+            if skip is not None and await skip(sha256):
+                if upload_id is not None:
+                    await self._abort_upload(bucket, key, upload_id)
+                return UploadResult(size, None, sha256, written=False)
+
+            if upload_id is None:
+                response = await self.put_object(bucket, key, bytes(buffer), **kwargs)
+                return UploadResult(size, response.get("ETag"), sha256)
+
+            if buffer:
+                parts.append(await self._upload_part(bucket, key, upload_id, len(parts) + 1, bytes(buffer)))
+            response = await self._call("complete_multipart_upload", self.client.complete_multipart_upload,
+                                        Bucket=bucket, Key=key, UploadId=upload_id,
+                                        MultipartUpload={"Parts": parts})
+            return UploadResult(size, response.get("ETag"), sha256)
+        except BaseException:
+            if upload_id is not None:
+                # Отмена не должна прерываться вместе с запросом, иначе части останутся в бакете
+                await asyncio.shield(self._abort_upload(bucket, key, upload_id))
+            raise
+
+    async def _abort_upload(self, bucket: str, key: str, upload_id: str):
+        await self._call("abort_multipart_upload", self.client.abort_multipart_upload,
+                         Bucket=bucket, Key=key, UploadId=upload_id)
+
+    async def _upload_part(self, bucket: str, key: str, upload_id: str, number: int, body: bytes) -> dict:
+        response = await self._call("upload_part", self.client.upload_part, Bucket=bucket, Key=key,
+                                    UploadId=upload_id, PartNumber=number, Body=body)
+        return {"ETag": response["ETag"], "PartNumber": number}
+
+    async def copy_object(self, bucket: str, source_key: str, key: str) -> dict:
+        """Копирование объекта внутри S3, без передачи содержимого через сервер"""
+        return await self._call("copy_object", self.client.copy_object, Bucket=bucket, Key=key,
+                                CopySource={"Bucket": bucket, "Key": source_key})
+
+    def presigned_url(self, operation: str, bucket: str, key: str,
+                      expires_in: int = S3_PRESIGNED_URL_TTL_SECONDS, **params) -> str:
+        """
+        Временная ссылка на операцию с объектом (get_object, put_object).
+        Подпись считается локально, без запроса к S3.
+        """
+        return self.presign_client.generate_presigned_url(
+            operation, Params={"Bucket": bucket, "Key": key, **params}, ExpiresIn=expires_in)
+
+    async def delete_object(self, bucket: str, key: str) -> dict:
+        return await self._call("delete_object", self.client.delete_object, Bucket=bucket, Key=key)
+
+
+storage = ObjectStorage()
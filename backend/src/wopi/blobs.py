@@ -0,0 +1,131 @@
+import asyncio
+import uuid
+from datetime import datetime
+from typing import AsyncIterable, Optional, Union
+
+from config import WOPI_BLOB_GC_GRACE_SECONDS, WOPI_BUCKET
+from database import database
+from sqlalchemy import func, select, update
+from sqlalchemy.dialects.postgresql import insert
+from storage import UploadResult, storage
+from wopi.tables import Blobs, Files
+from wopi.utils import CLOCK_NOW, normalize_etag, record_file
+
+# Префикс ключей блобов в WOPI_BUCKET; пути файлов с ним не создаются
+BLOB_PREFIX = ".blobs/"
+
+
+async def _single_chunk(data: bytes):
+    yield data
+
+
+def new_blob_key() -> str:
+    """
+    Случайный ключ под BLOB_PREFIX. Объект под ним, не учтённый в file_blobs
+    (временная загрузка, сбой между записью и учётом), удаляет сверка каталога.
+    """
+    return f"{BLOB_PREFIX}{uuid.uuid4().hex}"
+
+
+async def acquire_blob(sha256: str):
+    """
+    Берёт ссылку на блоб sha256 (refcount + 1) одним UPDATE, поэтому
+    collect_blobs не может удалить его между проверкой и использованием.
+    :return: строка блоба (key, size, etag) или None, если блоба нет
+    """
+    return await database.fetch_one(
+        update(Blobs).where(Blobs.c.sha256 == sha256)
+        .values(refcount=Blobs.c.refcount + 1, updated_at=CLOCK_NOW)
+        .returning(Blobs.c.key, Blobs.c.size, Blobs.c.etag)
+    )
+
+
+async def store_blob(chunks: Union[AsyncIterable[bytes], bytes], max_size: Optional[int] = None,
+                     current_sha256: Optional[str] = None) -> UploadResult:
+    """
+    Загрузка содержимого в новый блоб под случайным ключом.
+    Если блоб с таким sha256 уже есть, ничего не записывается (written=False),
+    на него только берётся ссылка. Для текущего содержимого файла
+    (current_sha256) не записывается ничего и ссылка не берётся.
+    Во всех остальных случаях вызывающий владеет одной ссылкой на блоб
+    upload.sha256 и передаёт её в attach_blob.
+    """
+    if isinstance(chunks, bytes):
+        chunks = _single_chunk(chunks)
+    key = new_blob_key()
+
+    async def known(sha256: str) -> bool:
+        return sha256 == current_sha256 or await acquire_blob(sha256) is not None
+
+    upload = await storage.upload_stream(WOPI_BUCKET, key, chunks, max_size=max_size, skip=known)
+    if upload.written:
+        query = insert(Blobs).values(sha256=upload.sha256, key=key, size=upload.size,
+                                     etag=normalize_etag(upload.etag), refcount=1)
+        stored = await database.fetch_val(
+            query.on_conflict_do_update(
+                index_elements=[Blobs.c.sha256],
+                set_={"refcount": Blobs.c.refcount + 1, "updated_at": CLOCK_NOW},
+            ).returning(Blobs.c.key)
+        )
+        if stored != key:
+            # такое же содержимое параллельно загрузил другой запрос
+            await storage.delete_object(WOPI_BUCKET, key)
+    return upload
+
+
+async def attach_blob(file_key: str, sha256: str, last_modified: datetime, owner_id=None,
+                      expected: Optional[dict] = None):
+    """
+    Файл начинает ссылаться на блоб sha256, ссылку на который вызывающий уже
+    взял (store_blob или acquire_blob); у прежнего блоба файла счётчик
+    уменьшается, строка каталога обновляется. Если записать строку не
+    удалось, взятая ссылка отпускается.
+    :param expected: прочитанная ранее строка каталога, см. record_file
+    :return: строка блоба (key, size, etag)
+    :raises VersionConflict: версия файла изменилась, ничего не записано
+    """
+    try:
+        async with database.transaction():
+            blob = await database.fetch_one(
+                select(Blobs.c.key, Blobs.c.size, Blobs.c.etag).where(Blobs.c.sha256 == sha256))
+            previous = await database.fetch_val(
+                select(Files.c.blob).where(Files.c.key == file_key).with_for_update())
+            await record_file(file_key, blob["size"], blob["etag"], last_modified,
+                              content_hash=sha256, owner_id=owner_id, blob=sha256, expected=expected)
+            if previous is not None:
+                await release_blob(previous)
+    except BaseException:
+        # Отпускание ссылки не должно прерываться вместе с запросом, иначе блоб не удалится никогда
+        await asyncio.shield(release_blob(sha256))
+        raise
+    return blob
+
+
+async def release_blob(sha256: str):
+    await database.execute(
+        update(Blobs).where(Blobs.c.sha256 == sha256)
+        .values(refcount=Blobs.c.refcount - 1, updated_at=CLOCK_NOW)
+    )
+
+
+async def collect_blobs(grace: int = WOPI_BLOB_GC_GRACE_SECONDS) -> int:
+    """
+    Удаление блобов без ссылок, не менявшихся дольше grace секунд
+    (загруженный блоб получает первую ссылку сразу после записи).
+    :return: число удалённых блобов
+    """
+    rows = await database.fetch_all(
+        Blobs.delete().where(Blobs.c.refcount <= 0,
+                             Blobs.c.updated_at < CLOCK_NOW - func.make_interval(0, 0, 0, 0, 0, 0, grace))
+        .returning(Blobs.c.key)
+    )
+    for row in rows:
+        await storage.delete_object(WOPI_BUCKET, row["key"])
+    return len(rows)
+
+
+async def known_blob_keys(keys: list[str]) -> set[str]:
+    if not keys:
+        return set()
+    rows = await database.fetch_all(select(Blobs.c.key).where(Blobs.c.key.in_(keys)))
+    return {row["key"] for row in rows}
@@ -0,0 +1,127 @@
+import asyncio
+import logging
+from datetime import timedelta
+from typing import Optional
+
+from config import WOPI_BLOB_GC_GRACE_SECONDS, WOPI_BUCKET, WOPI_CATALOG_RECONCILE_INTERVAL_SECONDS
+from database import database
+from sqlalchemy import select
+from storage import storage
+from wopi.blobs import BLOB_PREFIX, collect_blobs, known_blob_keys
+from wopi.tables import Files
+from wopi.utils import CLOCK_NOW, file_owner_query, get_file_records, normalize_etag, record_file, to_naive_utc
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Ключ advisory-блокировки: сверкой каталога занимается один воркер за раз
+RECONCILE_LOCK_ID = 0x66696C65
+DELETE_BATCH_SIZE = 500
+
+reconcile_duration = metrics.histogram("wopi_catalog_reconcile_seconds", "Длительность сверки каталога файлов")
+fixed_records = metrics.counter("wopi_catalog_fixed_total", "Строки каталога, исправленные сверкой")
+removed_records = metrics.counter("wopi_catalog_removed_total", "Строки каталога без объекта в бакете")
+collected_blobs = metrics.counter("wopi_blobs_collected_total", "Удалённые блобы без ссылок")
+
+
+class FileCatalogReconciler:
+    """
+    Сверка каталога files с бакетом.
+
+    Раз в interval секунд бакет просматривается целиком: строки с другим
+    размером или ETag обновляются (хэш содержимого при этом неизвестен),
+    недостающие добавляются, строки без объекта удаляются. Строки, изменённые
+    после начала прохода (file_create, PutFile), сверка не трогает.
+
+    Файлы, хранящиеся в блобах (WOPI_STORAGE_MODE=cas), сверкой не
+    затрагиваются. Вместо этого удаляются блобы без ссылок и объекты под
+    BLOB_PREFIX, которых нет в file_blobs (старше WOPI_BLOB_GC_GRACE_SECONDS).
+    """
+
+    def __init__(self, bucket: str = WOPI_BUCKET, interval: float = WOPI_CATALOG_RECONCILE_INTERVAL_SECONDS,
+                 blob_grace: int = WOPI_BLOB_GC_GRACE_SECONDS):
+        self.bucket = bucket
+        self.interval = interval
+        self.blob_grace = blob_grace
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.reconcile()
+            except Exception as e:
+                logger.error(f"Ошибка сверки каталога файлов: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def reconcile(self):
+        async with database.connection():
+            locked = await database.fetch_val(
+                query="SELECT pg_try_advisory_lock(:lock_id)", values={"lock_id": RECONCILE_LOCK_ID})
+            if not locked:
+                return
+            try:
+                with reconcile_duration.time():
+                    await self._reconcile()
+                    collected_blobs.inc(await collect_blobs(self.blob_grace))
+            finally:
+                await database.fetch_val(
+                    query="SELECT pg_advisory_unlock(:lock_id)", values={"lock_id": RECONCILE_LOCK_ID})
+
+    async def _reconcile(self):
+        started = await database.fetch_val(select(CLOCK_NOW))
+        seen = set()
+        fixed = 0
+
+        async for page in storage.list_objects(self.bucket):
+            blob_objects = [obj for obj in page if obj["Key"].startswith(BLOB_PREFIX)]
+            page = [obj for obj in page if not obj["Key"].startswith(BLOB_PREFIX)]
+            await self._remove_orphan_blobs(blob_objects)
+
+            records = await get_file_records([obj["Key"] for obj in page])
+            for obj in page:
+                key = obj["Key"]
+                seen.add(key)
+                etag = normalize_etag(obj.get("ETag"))
+                record = records.get(key)
+                unchanged = record is not None and record["size"] == obj["Size"] and record["etag"] == etag
+                if (record is not None and record["blob"] is not None) or unchanged:
+                    continue
+                await record_file(key, obj["Size"], etag, to_naive_utc(obj["LastModified"]),
+                                  owner_id=file_owner_query(key), older_than=started)
+                fixed += 1
+
+        rows = await database.fetch_all(
+            select(Files.c.key).where(Files.c.updated_at < started, Files.c.blob.is_(None)))
+        missing = [row["key"] for row in rows if row["key"] not in seen]
+        for i in range(0, len(missing), DELETE_BATCH_SIZE):
+            await database.execute(Files.delete().where(
+                Files.c.key.in_(missing[i:i + DELETE_BATCH_SIZE]),
+                Files.c.updated_at < started,
+                Files.c.blob.is_(None),
+            ))
+
+        fixed_records.inc(fixed)
+        removed_records.inc(len(missing))
+        if fixed or missing:
+            logger.info(f"Сверка каталога файлов: исправлено {fixed}, удалено {len(missing)}.")
+
+    async def _remove_orphan_blobs(self, objects: list[dict]):
+        """Объекты блобов, не попавшие в file_blobs (например, после сбоя между записью и учётом)"""
+        known = await known_blob_keys([obj["Key"] for obj in objects])
+        cutoff = to_naive_utc() - timedelta(seconds=self.blob_grace)
+        for obj in objects:
+            if obj["Key"] not in known and to_naive_utc(obj["LastModified"]) < cutoff:
+                await storage.delete_object(self.bucket, obj["Key"])
+                collected_blobs.inc()
+
+
+file_catalog = FileCatalogReconciler()
@@ -0,0 +1,194 @@
+import asyncio
+import hashlib
+import logging
+import os
+import shutil
+import socket
+import tempfile
+from collections import OrderedDict
+from typing import AsyncIterator, Optional
+
+from config import WOPI_DISK_CACHE_DIR, WOPI_DISK_CACHE_MAX_BYTES, WOPI_DISK_CACHE_MAX_OBJECT_BYTES
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+TEMP_SUFFIX = ".tmp"
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class DiskCache:
+    """
+    Локальный дисковый кэш объектов WOPI_BUCKET перед S3.
+
+    Файл кэша называется по sha256 от ключа и ETag, поэтому изменённый объект
+    никогда не читается из старой записи: она просто вытесняется. Запись
+    идёт во временный файл, который переименовывается только после того,
+    как объект прочитан из S3 целиком. Суммарный размер ограничен max_bytes,
+    вытесняются давно не читанные файлы. Без directory кэш выключен.
+
+    Учёт размера ведётся в памяти процесса, поэтому у каждого воркера свой
+    подкаталог <хост>-<pid> внутри directory и свой лимит max_bytes: воркеры
+    не вытесняют файлы, которые отдаёт другой процесс. Подкаталог
+    завершившегося воркера на этом хосте при запуске забирает себе новый
+    воркер (кэш остаётся тёплым после перезапуска), остальные удаляются.
+    """
+
+    def __init__(self, directory: str = WOPI_DISK_CACHE_DIR, max_bytes: int = WOPI_DISK_CACHE_MAX_BYTES,
+                 max_object_bytes: int = WOPI_DISK_CACHE_MAX_OBJECT_BYTES):
+        self.root = directory
+        self.directory = os.path.join(directory, self._worker_dir(os.getpid())) if directory else ""
+        self.max_bytes = max_bytes
+        self.max_object_bytes = max_object_bytes
+        self.total_size = 0
+        # имя файла -> (размер, ключ объекта); у файлов с прошлого запуска ключ неизвестен
+        self._entries: "OrderedDict[str, tuple[int, Optional[str]]]" = OrderedDict()
+        self.hits = metrics.counter("wopi_disk_cache_hits_total", "Чтения файлов из дискового кэша")
+        self.misses = metrics.counter("wopi_disk_cache_misses_total", "Чтения файлов мимо дискового кэша")
+        metrics.gauge("wopi_disk_cache_bytes", "Объём дискового кэша файлов", func=lambda: self.total_size)
+
+        if self.enabled:
+            self._load()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory)
+
+    @staticmethod
+    def _worker_dir(pid: int) -> str:
+        return f"{socket.gethostname()}-{pid}"
+
+    def _adopt_stale_dirs(self):
+        """Подкаталоги завершившихся воркеров этого хоста: первый забирается, остальные удаляются"""
+        os.makedirs(self.root, exist_ok=True)
+        prefix = self._worker_dir(0)[:-1]
+        for entry in os.scandir(self.root):
+            if entry.is_file():
+                # файл кэша из общего каталога, который был до подкаталогов воркеров
+                os.unlink(entry.path)
+                continue
+            pid = entry.name[len(prefix):]
+            if not entry.is_dir() or not entry.name.startswith(prefix) or not pid.isdigit():
+                continue
+            if entry.path == self.directory or _process_alive(int(pid)):
+                continue
+            if not os.path.exists(self.directory):
+                try:
+                    os.rename(entry.path, self.directory)
+                    continue
+                except OSError:
+                    # каталог уже забрал другой воркер или свой только что создан
+                    pass
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+    def _load(self):
+        """Учёт файлов, оставшихся с прошлого запуска (от старых к новым по времени доступа)"""
+        self._adopt_stale_dirs()
+        os.makedirs(self.directory, exist_ok=True)
+        files = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_file():
+                continue
+            if entry.name.endswith(TEMP_SUFFIX):
+                # недописанный файл прерванной загрузки
+                os.unlink(entry.path)
+                continue
+            stat = entry.stat()
+            files.append((stat.st_atime, entry.name, stat.st_size))
+        for _, name, size in sorted(files):
+            self._entries[name] = (size, None)
+            self.total_size += size
+        self._evict()
+
+    @staticmethod
+    def _name(key: str, etag: str) -> str:
+        return hashlib.sha256(f"{key}\0{etag}".encode()).hexdigest()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def get(self, key: str, etag: Optional[str]) -> Optional[tuple[str, os.stat_result]]:
+        """Путь к файлу кэша и его stat или None"""
+        if not self.enabled or not etag:
+            return None
+        name = self._name(key, etag)
+        if name in self._entries:
+            try:
+                stat = os.stat(self._path(name))
+            except FileNotFoundError:
+                self._remove(name)
+            else:
+                self._entries.move_to_end(name)
+                self.hits.inc()
+                return self._path(name), stat
+        self.misses.inc()
+        return None
+
+    def accepts(self, size: int) -> bool:
+        return self.enabled and size <= self.max_object_bytes
+
+    async def fill(self, key: str, etag: Optional[str], chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        """
+        Пропускает поток объекта дальше, параллельно записывая его в кэш.
+        Если поток не дочитан (обрыв, ошибка), временный файл удаляется.
+        """
+        if not self.enabled or not etag:
+            async for chunk in chunks:
+                yield chunk
+            return
+
+        name = self._name(key, etag)
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=TEMP_SUFFIX)
+        size = 0
+        try:
+            with os.fdopen(fd, "wb") as file:
+                async for chunk in chunks:
+                    await asyncio.to_thread(file.write, chunk)
+                    size += len(chunk)
+                    yield chunk
+            os.replace(temp_path, self._path(name))
+        except BaseException:
+            try:
+                os.unlink(temp_path)
+            except FileNotFoundError:
+                pass
+            raise
+
+        if name in self._entries:
+            self.total_size -= self._entries[name][0]
+        self._entries[name] = (size, key)
+        self.total_size += size
+        self._evict()
+
+    def invalidate(self, key: str):
+        """Удаление записей объекта (после его перезаписи через PutFile)"""
+        for name in [name for name, (_, entry_key) in self._entries.items() if entry_key == key]:
+            self._remove(name)
+
+    def _remove(self, name: str):
+        entry = self._entries.pop(name, None)
+        if entry is None:
+            return
+        self.total_size -= entry[0]
+        try:
+            os.unlink(self._path(name))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        while self.total_size > self.max_bytes and self._entries:
+            name = next(iter(self._entries))
+            self._remove(name)
+
+
+disk_cache = DiskCache()
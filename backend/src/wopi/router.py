@@ -1,21 +1,34 @@
+import asyncio
+import hashlib
 import logging
-from datetime import datetime, timezone
+from datetime import timezone
+from email.utils import format_datetime
 from pathlib import Path
-from urllib.parse import unquote
+from typing import Literal, Optional
+from urllib.parse import quote, unquote
 
 from botocore.exceptions import ClientError
 
-from auth.utils import get_user_by_token
-from fastapi import APIRouter, HTTPException
-from starlette.requests import Request
-from starlette.responses import JSONResponse, Response, StreamingResponse
+from auth.utils import get_principal_by_token
+from fastapi import APIRouter, HTTPException, Query
+from starlette.requests import ClientDisconnect, Request
+from starlette.responses import FileResponse, JSONResponse, Response, StreamingResponse
 
-from config import S3_CLIENT, WOPI_BUCKET
+from config import (S3_PRESIGNED_URL_TTL_SECONDS, WOPI_BUCKET, WOPI_LIST_HEAD_CONCURRENCY, WOPI_MAX_FILE_SIZE,
+                    WOPI_STORAGE_MODE)
+from database import database
 from file_permission.schemas import RIGHT_TYPES
 from file_permission.utils import add_permission, check_file_access, get_file_owner_id
 from models.utils import MessageResponse, DetailResponse
-from wopi.schemas import FileInfoResponse
-from wopi.utils import get_user_file_paths
+from storage import ObjectTooLarge, is_not_found, storage
+from wopi.blobs import BLOB_PREFIX, acquire_blob, attach_blob, new_blob_key, release_blob, store_blob
+from wopi.disk_cache import disk_cache
+from wopi.schemas import FileInfoResponse, LastModifiedResponse, PresignedUrlResponse
+from wopi.utils import (RangeNotSatisfiable, VersionConflict, etag_matches, fetch_file_record, file_owner_query,
+                        file_version, format_wopi_time, get_file_records, get_user_files, normalize_etag,
+                        not_modified_since, object_key, parse_byte_range, record_file, to_naive_utc)
+
+import metrics
 
 logging.basicConfig(
     format='%(levelname)s:     %(message)s',
@@ -23,70 +36,258 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+unchanged_saves = metrics.counter("wopi_putfile_unchanged_total", "PutFile с тем же содержимым, без записи в S3")
+conflicting_saves = metrics.counter("wopi_putfile_conflicts_total", "PutFile, отклонённые из-за смены версии")
+
 router = APIRouter(prefix="/wopi", tags=["wopi"])
 
 
 @router.get("/files/{file_path:path}/contents", include_in_schema=False)
-def file_contents(file_path: str, access_token: str):
-    obj = S3_CLIENT.get_object(Bucket=WOPI_BUCKET, Key=file_path)
+async def file_contents(file_path: str, request: Request, access_token: str):
+    """
+    GetFile. Версия (ETag) и время изменения берутся из каталога files, поэтому
+    If-None-Match и If-Modified-Since отвечаются 304 без обращения к S3.
+    Заголовок Range с одним диапазоном отдаётся ответом 206. Файлы из
+    дискового кэша (WOPI_DISK_CACHE_DIR) читаются с локального диска вместо
+    S3, но через FileResponse, то есть обычным чтением кусками в процессе, а
+    не sendfile. Промах по кэшу при чтении целиком заполняет его.
+    """
+    record = (await get_file_records([file_path])).get(file_path)
+    if record is None:
+        record = await fetch_file_record(file_path, file_owner_query(file_path))
+    if record is None:
+        raise HTTPException(status_code=404, detail=f"File not found: {file_path}")
+
+    headers = {
+        "ETag": f'"{file_version(record)}"',
+        "Last-Modified": format_datetime(record["last_modified"].replace(tzinfo=timezone.utc), usegmt=True),
+        "Accept-Ranges": "bytes",
+    }
+    if_none_match = request.headers.get("if-none-match")
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_none_match is not None:
+        if etag_matches(if_none_match, file_version(record)):
+            return Response(status_code=304, headers=headers)
+    elif if_modified_since is not None and not_modified_since(if_modified_since, record["last_modified"]):
+        return Response(status_code=304, headers=headers)
+
+    byte_range = None
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header is not None and (if_range is None or etag_matches(if_range, file_version(record))):
+        try:
+            byte_range = parse_byte_range(range_header, record["size"])
+        except RangeNotSatisfiable:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{record['size']}"})
+
+    content_disposition = f'attachment; filename="{file_path.split("/")[-1]}"'
+    cached = disk_cache.get(file_path, record["etag"])
+    if cached is not None:
+        # Range и If-Range для файла на диске FileResponse обрабатывает сам.
+        # Файл читается кусками и отправляется потоком: uvicorn не поддерживает
+        # pathsend, поэтому копирования в пространство пользователя не избежать
+        path, stat_result = cached
+        return FileResponse(path, headers={**headers, "Content-Disposition": content_disposition},
+                            media_type="application/octet-stream", stat_result=stat_result)
+
+    try:
+        if byte_range is None:
+            obj = await storage.get_object(WOPI_BUCKET, object_key(record))
+        else:
+            obj = await storage.get_object(WOPI_BUCKET, object_key(record),
+                                           Range=f"bytes={byte_range[0]}-{byte_range[1]}")
+    except ClientError as e:
+        if is_not_found(e):
+            raise HTTPException(status_code=404, detail=f"File not found: {file_path}")
+        raise HTTPException(status_code=500, detail="S3 error: " + str(e))
+
+    # Метаданные самого объекта точнее каталога, если файл изменили в обход API
+    headers["ETag"] = obj.get("ETag", headers["ETag"])
+    headers["Content-Length"] = str(obj["ContentLength"])
+    headers["Content-Disposition"] = content_disposition
+    body = storage.iter_body(obj['Body'])
+    status_code = 200
+    if byte_range is not None:
+        status_code = 206
+        headers["Content-Range"] = obj.get("ContentRange", f"bytes {byte_range[0]}-{byte_range[1]}/{record['size']}")
+    elif disk_cache.accepts(obj["ContentLength"]):
+        body = disk_cache.fill(file_path, normalize_etag(obj.get("ETag")), body)
     return StreamingResponse(
-        obj['Body'],
+        body,
+        status_code=status_code,
         media_type="application/octet-stream",
-        headers={"Content-Disposition": f'attachment; filename="{file_path.split("/")[-1]}"'}
+        headers=headers,
     )
 
 
+@router.get("/files/{file_path:path}/download-url", response_model=PresignedUrlResponse, responses={
+    401: {"description": "Unauthorized"},
+    403: {"description": "Access denied"},
+    404: {"description": "File not found"},
+    501: {"description": "Presigned URLs are disabled"},
+})
+async def file_download_url(file_path: str, access_token: str):
+    """
+    Временная ссылка на скачивание файла напрямую из MinIO (после проверки
+    права на чтение): содержимое не проходит через backend.
+    """
+
+    if not access_token:
+        raise HTTPException(status_code=401, detail="Missing token")
+    if storage.presign_client is None:
+        raise HTTPException(status_code=501, detail="Presigned URLs are disabled")
+
+    user = await get_principal_by_token(access_token)
+    if not await check_file_access(file_path, user.id, RIGHT_TYPES.VIEWER):
+        raise HTTPException(status_code=403, detail="Access denied")
+
+    record = (await get_file_records([file_path])).get(file_path)
+    if record is None:
+        try:
+            record = await fetch_file_record(file_path, file_owner_query(file_path))
+        except ClientError as e:
+            raise HTTPException(status_code=500, detail="S3 error: " + str(e))
+    if record is None:
+        raise HTTPException(status_code=404, detail=f"File not found: {file_path}")
+
+    filename = quote(file_path.split("/")[-1])
+    url = storage.presigned_url("get_object", WOPI_BUCKET, object_key(record),
+                                ResponseContentDisposition=f"attachment; filename*=UTF-8''{filename}")
+    return {"url": url, "expires_in": S3_PRESIGNED_URL_TTL_SECONDS}
+
+
 @router.post("/files/{file_path:path}/contents", include_in_schema=False)
 async def file_contents(file_path: str, request: Request, access_token: str):
-    content = await request.body()
+    """
+    PutFile: тело запроса потоком пишется в S3 частями по S3_UPLOAD_PART_SIZE,
+    без чтения в память целиком. Больше WOPI_MAX_FILE_SIZE — 413.
+
+    Если версия из X-WOPI-ItemVersion или время из X-COOL-WOPI-Timestamp не
+    совпадают с каталогом, файл изменён кем-то ещё: 409 до начала загрузки.
+    Строка каталога обновляется только при той же версии, что была
+    проверена, иначе тоже 409.
+    Содержимое с тем же sha256, что в каталоге, не перезаписывается.
+    В режиме direct тело загружается во временный объект и копируется под
+    ключ файла только после условного обновления каталога, поэтому
+    отклонённое сохранение не трогает содержимое файла.
+    В режиме WOPI_STORAGE_MODE=cas содержимое пишется в блоб, и если блоб с
+    таким содержимым уже есть, файл просто начинает ссылаться на него.
+    """
+    content_length = request.headers.get("content-length")
+    if content_length is not None and content_length.isdigit() and int(content_length) > WOPI_MAX_FILE_SIZE:
+        raise HTTPException(status_code=413, detail="File is too large")
+
+    record = (await get_file_records([file_path])).get(file_path)
+    if record is not None:
+        item_version = request.headers.get("x-wopi-itemversion")
+        timestamp = request.headers.get("x-cool-wopi-timestamp")
+        if (item_version and item_version != file_version(record)) or \
+                (timestamp and timestamp != format_wopi_time(record["last_modified"])):
+            return _version_conflict(record)
+
+    current_sha256 = record["content_hash"] if record is not None else None
+
+    async def unchanged(sha256: str) -> bool:
+        return sha256 == current_sha256
+
     try:
-        S3_CLIENT.put_object(Bucket=WOPI_BUCKET, Key=file_path, Body=content)
+        if WOPI_STORAGE_MODE == "cas":
+            upload = await store_blob(request.stream(), WOPI_MAX_FILE_SIZE, current_sha256)
+        else:
+            staging_key = new_blob_key()
+            upload = await storage.upload_stream(WOPI_BUCKET, staging_key, request.stream(),
+                                                 max_size=WOPI_MAX_FILE_SIZE, skip=unchanged)
+    except ObjectTooLarge:
+        raise HTTPException(status_code=413, detail="File is too large")
+    except ClientDisconnect:
+        logger.info(f"Загрузка {file_path} прервана клиентом")
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail="Error writing file to S3: " + str(e))
-    last_modified_str = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
-    return JSONResponse(content={"LastModifiedTime": last_modified_str}, status_code=200)
+
+    if upload.sha256 == current_sha256:
+        # автосохранение без изменений: объект и каталог не трогаем
+        unchanged_saves.inc()
+        return JSONResponse(content={"LastModifiedTime": format_wopi_time(record["last_modified"])},
+                            headers={"X-WOPI-ItemVersion": file_version(record)})
+    disk_cache.invalidate(file_path)
+
+    # Строка каталога пишется только после успешной записи в S3 и только
+    # если версия не изменилась с момента проверки
+    last_modified = to_naive_utc()
+    try:
+        if WOPI_STORAGE_MODE == "cas":
+            etag = (await attach_blob(file_path, upload.sha256, last_modified, file_owner_query(file_path),
+                                      expected=record))["etag"]
+        else:
+            etag = await _publish_upload(file_path, staging_key, upload, last_modified, record)
+    except VersionConflict:
+        return _version_conflict((await get_file_records([file_path])).get(file_path))
+    if WOPI_STORAGE_MODE == "cas":
+        if record is not None and record["blob"] is None:
+            # файл хранился под своим ключом до включения cas
+            await storage.delete_object(WOPI_BUCKET, file_path)
+    elif record is not None and record["blob"] is not None:
+        await release_blob(record["blob"])
+    return JSONResponse(content={"LastModifiedTime": format_wopi_time(last_modified)}, status_code=200,
+                        headers={"X-WOPI-ItemVersion": file_version({"etag": etag, "last_modified": last_modified})})
 
 
 @router.get("/files", response_model=list[FileInfoResponse], responses={
     401: {"description": "Unauthorized"},
 })
-async def list_user_files(access_token: str):
-    """Вернуть список файлов, к которым у пользователя есть доступ"""
+async def list_user_files(
+        access_token: str,
+        limit: Optional[int] = Query(None, ge=1, le=1000),
+        offset: int = Query(0, ge=0),
+        sort: Literal["path", "name"] = "path",
+        order: Literal["asc", "desc"] = "asc",
+):
+    """
+    Вернуть список файлов, к которым у пользователя есть доступ.
+    Права и владельцы берутся одним запросом, размеры — из каталога files.
+    Файлы, которых ещё нет в каталоге, читаются из S3 параллельно (не больше
+    WOPI_LIST_HEAD_CONCURRENCY запросов) и добавляются в него. Файлы, которых
+    нет в бакете, пропускаются, поэтому страница может быть короче limit.
+    """
 
     if not access_token:
         raise HTTPException(status_code=401, detail="Missing token")
 
-    user = await get_user_by_token(access_token)
+    user = await get_principal_by_token(access_token)
+    files = await get_user_files(user.id, sort, order == "desc", limit, offset)
+    records = await get_file_records([unquote(file["file_path"]) for file in files])
 
-    # Получаем список файлов, к которым есть доступ (должна быть реализована)
-    # file_paths = await get_user_files(user.id)
-    # Пример заглушки:
-    file_paths = await get_user_file_paths(user.id)  # Должна возвращать список путей файлов
+    semaphore = asyncio.Semaphore(WOPI_LIST_HEAD_CONCURRENCY)
 
-    files_info = []
-    for file_path in file_paths:
-        key = unquote(file_path)
-        try:
-            metadata = S3_CLIENT.head_object(Bucket=WOPI_BUCKET, Key=key)
-        except ClientError as e:
-            # если файла нет в бакете - пропускаем
-            if e.response["Error"]["Code"] == "404":
-                continue
-            else:
-                raise HTTPException(status_code=500, detail="S3 error: " + str(e))
+    async def load(file):
+        key = unquote(file["file_path"])
+        if key in records:
+            return records[key]
+        async with semaphore:
+            return await fetch_file_record(key, file["owner_id"])
 
-        can_write = await check_file_access(file_path, user.id, RIGHT_TYPES.EDITOR)
-        owner_id = await get_file_owner_id(file_path)
+    try:
+        objects = await asyncio.gather(*(load(file) for file in files))
+    except ClientError as e:
+        raise HTTPException(status_code=500, detail="S3 error: " + str(e))
+
+    files_info = []
+    for file, record in zip(files, objects):
+        # если файла нет в бакете - пропускаем
+        if record is None:
+            continue
 
         files_info.append({
-            "BaseFileName": Path(key).name,
-            "Size": metadata["ContentLength"],
-            "OwnerId": owner_id,
+            "BaseFileName": Path(unquote(file["file_path"])).name,
+            "Size": record["size"],
+            "OwnerId": file["owner_id"],
             "UserId": user.id,
-            "Version": "1",
-            "UserCanWrite": can_write,
+            "Version": file_version(record),
+            "UserCanWrite": file["can_write"],
             "UserFriendlyName": user.email,
-            "FilePath": file_path,
+            "FilePath": file["file_path"],
+            "LastModifiedTime": format_wopi_time(record["last_modified"]),
         })
 
     return files_info
@@ -102,30 +303,169 @@ async def file_info(file_path: str, access_token: str):
     if not access_token:
         raise HTTPException(status_code=401, detail="Missing token")
 
-    user = await get_user_by_token(access_token)
+    user = await get_principal_by_token(access_token)
 
     can_write = await check_file_access(file_path, user.id, RIGHT_TYPES.EDITOR)
-    owner_id = await get_file_owner_id(file_path)
 
     key = unquote(file_path)
 
-    try:
-        metadata = S3_CLIENT.head_object(Bucket=WOPI_BUCKET, Key=key)
-    except S3_CLIENT.exceptions.ClientError:
+    record = (await get_file_records([key])).get(key)
+    if record is None:
+        # файла ещё нет в каталоге (создан в обход API) - читаем из S3
+        try:
+            record = await fetch_file_record(key, await get_file_owner_id(file_path))
+        except ClientError:
+            record = None
+    if record is None:
         raise HTTPException(status_code=404, detail=f"File not found: {key}")
 
+    owner_id = record["owner_id"]
+    if owner_id is None:
+        owner_id = await get_file_owner_id(file_path)
+
     return JSONResponse({
         "BaseFileName": Path(key).name,
-        "Size": metadata["ContentLength"],
+        "Size": record["size"],
         "OwnerId": owner_id,
         "UserId": user.id,
-        "Version": "1",
+        "Version": file_version(record),
         "UserCanWrite": can_write,
         "UserFriendlyName": user.email,
         "FilePath": file_path,
+        "LastModifiedTime": format_wopi_time(record["last_modified"]),
     })
 
 
+@router.post("/files/{file_path:path}/upload-url", response_model=PresignedUrlResponse, responses={
+    401: {"description": "Unauthorized"},
+    403: {"description": "Access denied"},
+    409: {"description": "Direct uploads are not available in cas mode"},
+    413: {"description": "File is too large"},
+    501: {"description": "Presigned URLs are disabled"},
+})
+async def file_upload_url(file_path: str, size: int = Query(..., ge=0), access_token: str = Query(...)):
+    """
+    Временная ссылка на загрузку файла (PUT ровно size байт) напрямую в MinIO.
+    После загрузки клиент вызывает upload-complete, чтобы обновить каталог.
+    В режиме cas содержимое должно пройти через PutFile (нужен sha256), поэтому 409.
+    """
+
+    if not access_token:
+        raise HTTPException(status_code=401, detail="Missing token")
+    if storage.presign_client is None:
+        raise HTTPException(status_code=501, detail="Presigned URLs are disabled")
+
+    user = await get_principal_by_token(access_token)
+    if not await check_file_access(file_path, user.id, RIGHT_TYPES.EDITOR):
+        raise HTTPException(status_code=403, detail="Access denied")
+    if WOPI_STORAGE_MODE == "cas":
+        raise HTTPException(status_code=409, detail="Direct uploads are not available in cas mode")
+    if size > WOPI_MAX_FILE_SIZE:
+        raise HTTPException(status_code=413, detail="File is too large")
+
+    url = storage.presigned_url("put_object", WOPI_BUCKET, file_path, ContentLength=size)
+    return {"url": url, "expires_in": S3_PRESIGNED_URL_TTL_SECONDS}
+
+
+@router.post("/files/{file_path:path}/upload-complete", response_model=LastModifiedResponse, responses={
+    401: {"description": "Unauthorized"},
+    403: {"description": "Access denied"},
+    404: {"description": "File not found"},
+    409: {"description": "Direct uploads are not available in cas mode"},
+})
+async def file_upload_complete(file_path: str, access_token: str):
+    """
+    Запись в каталог метаданных файла, загруженного по ссылке из upload-url.
+    Проверки версии нет, побеждает последний записавший: к этому моменту
+    байты уже лежат под ключом файла, и отказ их бы не вернул. Если строка
+    каталога ссылалась на блоб (файл сохранялся в режиме cas), ссылка на
+    него освобождается.
+    """
+
+    if not access_token:
+        raise HTTPException(status_code=401, detail="Missing token")
+
+    user = await get_principal_by_token(access_token)
+    if not await check_file_access(file_path, user.id, RIGHT_TYPES.EDITOR):
+        raise HTTPException(status_code=403, detail="Access denied")
+    if WOPI_STORAGE_MODE == "cas":
+        raise HTTPException(status_code=409, detail="Direct uploads are not available in cas mode")
+
+    try:
+        metadata = await storage.head_object(WOPI_BUCKET, file_path)
+    except ClientError as e:
+        raise HTTPException(status_code=500, detail="S3 error: " + str(e))
+    if metadata is None:
+        raise HTTPException(status_code=404, detail=f"File not found: {file_path}")
+
+    disk_cache.invalidate(file_path)
+    last_modified = to_naive_utc(metadata.get("LastModified"))
+    while True:
+        # expected — только чтобы освободить блоб именно той строки, которую заменили
+        record = (await get_file_records([file_path])).get(file_path)
+        try:
+            # хэш содержимого неизвестен: байты не проходили через backend
+            await record_file(file_path, metadata["ContentLength"], normalize_etag(metadata.get("ETag")),
+                              last_modified, owner_id=file_owner_query(file_path), expected=record)
+        except VersionConflict:
+            continue
+        break
+    if record is not None and record["blob"] is not None:
+        await release_blob(record["blob"])
+    return {"LastModifiedTime": format_wopi_time(last_modified)}
+
+
+@router.post("/files/{file_path:path}/copy", status_code=201, response_model=DetailResponse, responses={
+    201: {"description": "File copied successfully"},
+    401: {"description": "Unauthorized"},
+    403: {"description": "Access denied"},
+    404: {"description": "File not found"},
+    409: {"description": "File already exists"},
+})
+async def file_copy(file_path: str, target: str, access_token: str):
+    """
+    Копия файла под путём target, владелец копии — текущий юзер.
+    Файл в блобе копируется только в каталоге (ещё одна ссылка на блоб),
+    файл под своим ключом — копированием объекта внутри S3.
+    """
+
+    if not access_token:
+        raise HTTPException(status_code=401, detail="Missing token")
+
+    user = await get_principal_by_token(access_token)
+    if not await check_file_access(file_path, user.id, RIGHT_TYPES.VIEWER):
+        raise HTTPException(status_code=403, detail="Access denied")
+
+    key = unquote(file_path)
+    target_key = unquote(target)
+    if target_key.startswith(BLOB_PREFIX):
+        raise HTTPException(status_code=400, detail="Invalid file path")
+
+    try:
+        record = (await get_file_records([key])).get(key)
+        if record is None:
+            record = await fetch_file_record(key, await get_file_owner_id(file_path))
+        if record is None:
+            raise HTTPException(status_code=404, detail=f"File not found: {key}")
+        if await _file_exists(target_key):
+            return JSONResponse(status_code=409, content={"detail": "File already exists"})
+
+        async with database.transaction():
+            await add_permission(target, user.id, RIGHT_TYPES.OWNER)
+            if record["blob"] is not None:
+                if await acquire_blob(record["blob"]) is None:
+                    raise HTTPException(status_code=404, detail=f"File not found: {key}")
+                await attach_blob(target_key, record["blob"], to_naive_utc(), user.id)
+            else:
+                response = await storage.copy_object(WOPI_BUCKET, key, target_key)
+                await record_file(target_key, record["size"], normalize_etag(response["CopyObjectResult"].get("ETag")),
+                                  to_naive_utc(), content_hash=record["content_hash"], owner_id=user.id)
+    except ClientError as e:
+        raise HTTPException(status_code=500, detail="S3 error: " + str(e))
+
+    return JSONResponse(status_code=201, content={"detail": "File copied successfully"})
+
+
 @router.post("/files/{file_path:path}", status_code=201, response_model=DetailResponse, responses={
     201: {"description": "File created successfully"},
     401: {"description": "Unauthorized"},
@@ -138,25 +478,76 @@ async def file_create(file_path: str, access_token: str):
     if not access_token:
         raise HTTPException(status_code=401, detail="Missing token")
 
-    user = await get_user_by_token(access_token)
+    user = await get_principal_by_token(access_token)
     key = unquote(file_path)
+    if key.startswith(BLOB_PREFIX):
+        raise HTTPException(status_code=400, detail="Invalid file path")
 
-    perm_id = await add_permission(file_path, user.id, RIGHT_TYPES.OWNER)
-
-    file_exists = False
     try:
-        S3_CLIENT.head_object(Bucket=WOPI_BUCKET, Key=key)
-        file_exists = True
+        file_exists = await _file_exists(key)
     except ClientError as e:
-        if e.response["Error"]["Code"] != "404":
-            raise HTTPException(status_code=500, detail="S3 error: " + str(e))
+        raise HTTPException(status_code=500, detail="S3 error: " + str(e))
 
     if file_exists:
         return JSONResponse(status_code=409, content={"detail": "File already exists"})
 
     try:
-        S3_CLIENT.put_object(Bucket=WOPI_BUCKET, Key=key, Body=b"")
+        # Право владельца и строка каталога сохраняются, только если файл записан в S3
+        async with database.transaction():
+            await add_permission(file_path, user.id, RIGHT_TYPES.OWNER)
+            if WOPI_STORAGE_MODE == "cas":
+                upload = await store_blob(b"")
+                await attach_blob(key, upload.sha256, to_naive_utc(), user.id)
+            else:
+                response = await storage.put_object(WOPI_BUCKET, key, b"")
+                await record_file(key, 0, normalize_etag(response.get("ETag")), to_naive_utc(),
+                                  content_hash=hashlib.sha256(b"").hexdigest(), owner_id=user.id)
     except Exception as e:
         raise HTTPException(status_code=500, detail="Error uploading file to S3: " + str(e))
 
     return JSONResponse(status_code=201, content={"detail": "File created successfully"})
+
+
+async def _file_exists(key: str) -> bool:
+    """Файл есть в каталоге (в том числе в блобе) или под своим ключом в S3"""
+    if await get_file_records([key]):
+        return True
+    return await storage.head_object(WOPI_BUCKET, key) is not None
+
+
+async def _publish_upload(file_path: str, staging_key: str, upload, last_modified, expected: Optional[dict]) -> str:
+    """
+    Перенос содержимого из временного объекта под ключ файла (режим direct).
+    Сначала условно обновляется строка каталога: до конца транзакции она
+    заблокирована, и параллельное сохранение той же версии получит
+    VersionConflict, не дойдя до копирования. Временный объект удаляется
+    в любом случае.
+    :return: ETag объекта под ключом файла
+    :raises VersionConflict: если версия в каталоге уже другая
+    """
+    try:
+        async with database.transaction():
+            etag = normalize_etag(upload.etag)
+            await record_file(file_path, upload.size, etag, last_modified, content_hash=upload.sha256,
+                              owner_id=file_owner_query(file_path), expected=expected)
+            response = await storage.copy_object(WOPI_BUCKET, staging_key, file_path)
+            copied_etag = normalize_etag(response["CopyObjectResult"].get("ETag"))
+            if copied_etag != etag:
+                # у копии multipart-объекта ETag не совпадает с исходным
+                etag = copied_etag
+                await record_file(file_path, upload.size, etag, last_modified, content_hash=upload.sha256,
+                                  owner_id=file_owner_query(file_path))
+    finally:
+        await storage.delete_object(WOPI_BUCKET, staging_key)
+    return etag
+
+
+def _version_conflict(record: Optional[dict]) -> JSONResponse:
+    """Ответ PutFile на сохранение поверх чужих изменений"""
+    conflicting_saves.inc()
+    return JSONResponse(
+        status_code=409,
+        # 1010 — код Collabora «документ изменён в хранилище»
+        content={"detail": "File was modified", "COOLStatusCode": 1010},
+        headers={"X-WOPI-ItemVersion": file_version(record)} if record is not None else None,
+    )
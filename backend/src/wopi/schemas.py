@@ -1,12 +1,24 @@
+from typing import Optional
+
 from pydantic import BaseModel
 
 
 class FileInfoResponse(BaseModel):
     BaseFileName: str
     Size: int
-    OwnerId: int
+    OwnerId: Optional[int] = None
     UserId: int
     Version: str
     UserCanWrite: bool
     UserFriendlyName: str
     FilePath: str
+    LastModifiedTime: Optional[str] = None
+
+
+class PresignedUrlResponse(BaseModel):
+    url: str
+    expires_in: int
+
+
+class LastModifiedResponse(BaseModel):
+    LastModifiedTime: str
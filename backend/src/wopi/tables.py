@@ -0,0 +1,32 @@
+from database import metadata
+from sqlalchemy import BigInteger, Column, DateTime, ForeignKey, Integer, String, Table, func, text
+
+# Каталог метаданных объектов бакета WOPI_BUCKET: файловые эндпоинты отвечают
+# по нему без обращений к S3. Сверку с бакетом делает wopi.catalog
+Files = Table(
+    "files",
+    metadata,
+    Column("key", String, primary_key=True),
+    Column("size", BigInteger, nullable=False),
+    Column("etag", String, nullable=True),
+    Column("last_modified", DateTime, nullable=False),
+    Column("owner_id", Integer, ForeignKey("users.id"), nullable=True),
+    # sha256 содержимого; NULL, если объект изменён в обход API
+    Column("content_hash", String(64), nullable=True),
+    # sha256 блоба file_blobs, где лежит содержимое (WOPI_STORAGE_MODE=cas); NULL — объект под key
+    Column("blob", String(64), nullable=True),
+    Column("updated_at", DateTime, nullable=False, server_default=func.now(), onupdate=func.now()),
+)
+
+# Блобы с содержимым файлов в режиме WOPI_STORAGE_MODE=cas: одинаковые файлы
+# хранятся одним объектом, refcount — число строк files, ссылающихся на блоб
+Blobs = Table(
+    "file_blobs",
+    metadata,
+    Column("sha256", String(64), primary_key=True),
+    Column("key", String, nullable=False, unique=True),
+    Column("size", BigInteger, nullable=False),
+    Column("etag", String, nullable=True),
+    Column("refcount", Integer, nullable=False, server_default=text("0")),
+    Column("updated_at", DateTime, nullable=False, server_default=func.now(), onupdate=func.now()),
+)
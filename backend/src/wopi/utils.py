@@ -1,11 +1,233 @@
-from sqlalchemy import select
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Optional
 
+from sqlalchemy import DateTime, and_, cast, func, select
+from sqlalchemy.dialects.postgresql import insert
+
+from config import WOPI_BUCKET
 from database import database
+from file_permission.schemas import RIGHT_TYPES
 from file_permission.tables import FilePermissions
+from storage import storage
+from wopi.tables import Blobs, Files
+
+# Время на момент выполнения запроса (now() — время начала транзакции)
+CLOCK_NOW = cast(func.clock_timestamp(), DateTime)
+
+
+class RangeNotSatisfiable(Exception):
+    """Запрошенный диапазон байт вне файла"""
+
+
+class VersionConflict(Exception):
+    """Строку каталога изменили после того, как была проверена её версия"""
+
+
+# Ключи сортировки списка файлов
+FILE_SORT_KEYS = {
+    "path": FilePermissions.c.file_path,
+    "name": func.regexp_replace(FilePermissions.c.file_path, "^.*/", ""),
+}
+
+
+async def get_user_files(user_id: int, sort: str = "path", descending: bool = False,
+                         limit: Optional[int] = None, offset: int = 0):
+    """
+    Файлы, к которым у пользователя есть доступ, одним запросом.
+    :return: строки с file_path, can_write (право владельца или редактора) и owner_id
+        (None, если у файла нет владельца)
+    """
+    owners = FilePermissions.alias("owners")
+    sort_key = FILE_SORT_KEYS[sort]
+    query = (
+        select(
+            FilePermissions.c.file_path,
+            func.bool_or(FilePermissions.c.rights_type != RIGHT_TYPES.VIEWER).label("can_write"),
+            func.min(owners.c.user_id).label("owner_id"),
+        )
+        .select_from(FilePermissions.outerjoin(owners, and_(
+            owners.c.file_path == FilePermissions.c.file_path,
+            owners.c.rights_type == RIGHT_TYPES.OWNER,
+        )))
+        .where(FilePermissions.c.user_id == user_id)
+        .group_by(FilePermissions.c.file_path)
+        .order_by(sort_key.desc() if descending else sort_key,
+                  FilePermissions.c.file_path.desc() if descending else FilePermissions.c.file_path)
+        .offset(offset)
+    )
+    if limit is not None:
+        query = query.limit(limit)
+    return await database.fetch_all(query)
+
+
+def to_naive_utc(value: Optional[datetime] = None) -> datetime:
+    """Время в naive UTC, как в timestamp-колонках (по умолчанию — текущее)"""
+    if value is None:
+        value = datetime.now(timezone.utc)
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def format_wopi_time(value: datetime) -> str:
+    """LastModifiedTime для WOPI (ISO 8601, UTC); Collabora возвращает его в X-COOL-WOPI-Timestamp"""
+    return value.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def normalize_etag(etag: Optional[str]) -> Optional[str]:
+    return etag.strip('"') if etag else None
+
+
+def file_owner_query(key: str):
+    """Владелец файла по правам доступа (для строк каталога, найденных сверкой)"""
+    return select(FilePermissions.c.user_id).where(
+        FilePermissions.c.file_path == key,
+        FilePermissions.c.rights_type == RIGHT_TYPES.OWNER,
+    ).limit(1).scalar_subquery()
+
+
+async def get_file_records(keys: list[str]) -> dict:
+    """Строки каталога files по путям файлов (с ключом блоба в blob_key)"""
+    if not keys:
+        return {}
+    rows = await database.fetch_all(
+        select(Files, Blobs.c.key.label("blob_key"))
+        .select_from(Files.outerjoin(Blobs, Blobs.c.sha256 == Files.c.blob))
+        .where(Files.c.key.in_(keys))
+    )
+    return {row["key"]: row for row in rows}
+
+
+def object_key(record) -> str:
+    """Ключ объекта S3 с содержимым файла"""
+    return record["blob_key"] or record["key"]
+
+
+async def record_file(key: str, size: int, etag: Optional[str], last_modified: datetime,
+                      content_hash: Optional[str] = None, owner_id=None,
+                      older_than: Optional[datetime] = None, blob: Optional[str] = None,
+                      expected: Optional[dict] = None):
+    """
+    Запись метаданных объекта в каталог (insert или update).
+    Владелец уже существующей строки не меняется. С older_than строка
+    обновляется, только если её не меняли после этого момента. С expected
+    (прочитанная ранее строка) — только если версия файла с тех пор та же.
+    :raises VersionConflict: если с expected строка не обновлена
+    """
+    query = insert(Files).values(
+        key=key,
+        size=size,
+        etag=etag,
+        last_modified=last_modified,
+        owner_id=owner_id,
+        content_hash=content_hash,
+        blob=blob,
+        updated_at=CLOCK_NOW,
+    )
+    conditions = []
+    if older_than is not None:
+        conditions.append(Files.c.updated_at < older_than)
+    if expected is not None:
+        conditions.append(version_condition(expected))
+    query = query.on_conflict_do_update(
+        index_elements=[Files.c.key],
+        set_={
+            "size": query.excluded.size,
+            "etag": query.excluded.etag,
+            "last_modified": query.excluded.last_modified,
+            "owner_id": func.coalesce(Files.c.owner_id, query.excluded.owner_id),
+            "content_hash": query.excluded.content_hash,
+            "blob": query.excluded.blob,
+            "updated_at": CLOCK_NOW,
+        },
+        where=and_(*conditions) if conditions else None,
+    ).returning(Files.c.key)
+    if await database.fetch_val(query) is None and expected is not None:
+        raise VersionConflict(key)
+
+
+async def fetch_file_record(key: str, owner_id: Optional[int] = None) -> Optional[dict]:
+    """
+    Метаданные объекта, которого ещё нет в каталоге: читаются из S3 и
+    записываются в каталог. None, если объекта нет в бакете.
+    """
+    metadata = await storage.head_object(WOPI_BUCKET, key)
+    if metadata is None:
+        return None
+    record = {
+        "key": key,
+        "size": metadata["ContentLength"],
+        "etag": normalize_etag(metadata.get("ETag")),
+        "last_modified": to_naive_utc(metadata.get("LastModified")),
+        "owner_id": owner_id,
+    }
+    await record_file(**record)
+    return {**record, "blob": None, "blob_key": None}
+
+
+def file_version(record) -> str:
+    """Версия файла для WOPI: ETag объекта, без него — время изменения"""
+    if record["etag"]:
+        return record["etag"]
+    return str(int(record["last_modified"].replace(tzinfo=timezone.utc).timestamp() * 1000))
+
+
+def version_condition(record):
+    """Условие на строку files: версия файла та же, что у прочитанной строки record"""
+    if record["etag"]:
+        return Files.c.etag == record["etag"]
+    return and_(Files.c.etag.is_(None), Files.c.last_modified == record["last_modified"])
+
+
+def etag_matches(header: str, etag: Optional[str]) -> bool:
+    """Совпадает ли ETag с одним из значений If-None-Match/If-Range (сравнение слабое)"""
+    if etag is None:
+        return False
+    for value in header.split(","):
+        value = value.strip()
+        if value == "*":
+            return True
+        if value.startswith("W/"):
+            value = value[2:]
+        if value.strip('"') == etag:
+            return True
+    return False
+
+
+def not_modified_since(header: str, last_modified: datetime) -> bool:
+    """Файл не менялся с даты из If-Modified-Since (точность HTTP-дат — секунда)"""
+    try:
+        since = parsedate_to_datetime(header)
+    except (TypeError, ValueError):
+        return False
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    return to_naive_utc(since) >= last_modified.replace(microsecond=0)
 
 
-async def get_user_file_paths(user_id):
-    query = select(FilePermissions.c.file_path).where(FilePermissions.c.user_id == user_id)
-    rows = await database.fetch_all(query)
-    # Возвращаем список строк (пути к файлам)
-    return [row['file_path'] for row in rows]
+def parse_byte_range(header: str, size: int) -> Optional[tuple[int, int]]:
+    """
+    Диапазон из заголовка Range: (первый, последний байт включительно).
+    None, если заголовок не разобран или диапазонов несколько — тогда
+    отдаётся весь файл. RangeNotSatisfiable, если диапазон вне файла.
+    """
+    unit, _, ranges = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in ranges:
+        return None
+    first, dash, last = ranges.strip().partition("-")
+    if not dash:
+        return None
+    try:
+        if first:
+            start = int(first)
+            end = int(last) if last else size - 1
+        else:
+            # bytes=-N: последние N байт
+            start = max(size - int(last), 0)
+            end = size - 1
+    except ValueError:
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable(f"Range {header} is outside of {size} bytes")
+    if end < start:
+        return None
+    return start, min(end, size - 1)
@@ -0,0 +1,67 @@
+const API_URL = import.meta.env.VITE_API_URL || 'http://localhost:8000';
+
+interface PresignedUrlResponse {
+  url: string;
+  expires_in: number;
+}
+
+const fileUrl = (filePath: string, suffix: string, accessToken: string) =>
+  `${API_URL}/api/v1/wopi/files/${filePath.split('/').map(encodeURIComponent).join('/')}/${suffix}` +
+  `?access_token=${encodeURIComponent(accessToken)}`;
+
+const errorDetail = async (response: Response, fallback: string) => {
+  const errorData = await response.json().catch(() => ({}));
+  return errorData.detail || fallback;
+};
+
+// Скачать файл: по временной ссылке напрямую из MinIO, если backend её выдаёт,
+// иначе через backend
+export const downloadFile = async (filePath: string, accessToken: string): Promise<void> => {
+  const response = await fetch(fileUrl(filePath, 'download-url', accessToken));
+
+  let url: string;
+  if (response.ok) {
+    url = ((await response.json()) as PresignedUrlResponse).url;
+  } else if (response.status === 501) {
+    url = fileUrl(filePath, 'contents', accessToken);
+  } else {
+    throw new Error(await errorDetail(response, 'Не удалось скачать файл'));
+  }
+
+  const link = document.createElement('a');
+  link.href = url;
+  link.download = filePath.split('/').pop() || filePath;
+  document.body.appendChild(link);
+  link.click();
+  link.remove();
+};
+
+// Загрузить новое содержимое файла: PUT по временной ссылке в MinIO и отметка
+// о загрузке, либо через backend, если прямая загрузка недоступна
+export const uploadFile = async (filePath: string, file: File, accessToken: string): Promise<void> => {
+  const response = await fetch(`${fileUrl(filePath, 'upload-url', accessToken)}&size=${file.size}`, {
+    method: 'POST',
+  });
+
+  if (response.ok) {
+    const {url} = (await response.json()) as PresignedUrlResponse;
+    const upload = await fetch(url, {method: 'PUT', body: file});
+    if (!upload.ok) {
+      throw new Error('Не удалось загрузить файл в хранилище');
+    }
+    const complete = await fetch(fileUrl(filePath, 'upload-complete', accessToken), {method: 'POST'});
+    if (!complete.ok) {
+      throw new Error(await errorDetail(complete, 'Не удалось сохранить файл'));
+    }
+    return;
+  }
+
+  if (response.status !== 501 && response.status !== 409) {
+    throw new Error(await errorDetail(response, 'Не удалось загрузить файл'));
+  }
+
+  const putFile = await fetch(fileUrl(filePath, 'contents', accessToken), {method: 'POST', body: file});
+  if (!putFile.ok) {
+    throw new Error(await errorDetail(putFile, 'Не удалось загрузить файл'));
+  }
+};
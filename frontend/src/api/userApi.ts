@@ -1,8 +1,18 @@
 // src/api/userApi.ts
 const API_URL = import.meta.env.VITE_API_URL || 'http://localhost:8000';
+const USERS_PAGE_SIZE = 500;
 
 export async function fetchAllUsers() {
-    const resp = await fetch(`${API_URL}/api/v1/users/`);
-    if (!resp.ok) throw new Error('Failed to fetch users');
-    return resp.json(); // [{id, email, ...}]
+    // Бэкенд отдаёт пользователей страницами; курсор следующей страницы — в X-Next-Cursor
+    const users: any[] = [];
+    let afterId: string | null = null;
+    do {
+        const params = new URLSearchParams({limit: String(USERS_PAGE_SIZE)});
+        if (afterId) params.set('after_id', afterId);
+        const resp = await fetch(`${API_URL}/api/v1/users/?${params}`);
+        if (!resp.ok) throw new Error('Failed to fetch users');
+        users.push(...await resp.json()); // [{id, email, ...}]
+        afterId = resp.headers.get('X-Next-Cursor');
+    } while (afterId);
+    return users;
 }
@@ -8,7 +8,7 @@ const API_URL = import.meta.env.VITE_API_URL || 'http://localhost:8000';
 interface UserFile {
     BaseFileName: string;
     Size: number;
-    OwnerId: number;
+    OwnerId: number | null;
     UserId: number;
     Version: string;
     UserCanWrite: boolean;
@@ -103,7 +103,7 @@ const UserFilesModal: React.FC<Props> = ({isOpen, onClose, accessToken}) => {
                                     {f.Size ? (f.Size / 1024).toFixed(1) + ' КБ' : '—'}
                                 </td>
                                 <td style={{padding: '6px 4px', textAlign: 'center'}}>
-                                    {idToEmail[f.OwnerId] || f.OwnerId}
+                                    {f.OwnerId === null ? '—' : idToEmail[f.OwnerId] || f.OwnerId}
                                 </td>
                                 <td style={{padding: '6px 4px', textAlign: 'center'}}>
                                     {f.UserCanWrite ? '✅' : '🔒'}
@@ -1,14 +1,26 @@
 import React, {useEffect, useState} from 'react';
 import {fetchAllUsers} from '@/api/userApi';
+import {downloadFile, uploadFile} from '@/api/fileApi';
 import FilePermissionsModal from './FilePermissionsModal';
 
 const API_URL = import.meta.env.VITE_API_URL || 'http://localhost:8000';
 const FOOTER_HEIGHT = 72;
 
+const transferButtonStyle: React.CSSProperties = {
+    marginLeft: 8,
+    padding: '2px 7px',
+    borderRadius: 6,
+    fontSize: 13,
+    background: '#333',
+    color: '#b36af7',
+    border: '1px solid #b36af7',
+    cursor: 'pointer',
+};
+
 interface UserFile {
     BaseFileName: string;
     Size: number;
-    OwnerId: number;
+    OwnerId: number | null;
     UserId: number;
     Version: string;
     UserCanWrite: boolean;
@@ -36,6 +48,8 @@ const UserFilesPanel: React.FC<Props> = ({visible, accessToken, currentUserId})
     const [collaboraUrl, setCollaboraUrl] = useState<string | null>(null);
     const [iframeLoading, setIframeLoading] = useState(false);
     const [permModalFile, setPermModalFile] = useState<string | null>(null);
+    const [transferFile, setTransferFile] = useState<string | null>(null);
+    const [reloadKey, setReloadKey] = useState(0);
 
     useEffect(() => {
         if (!visible) return;
@@ -55,7 +69,7 @@ const UserFilesPanel: React.FC<Props> = ({visible, accessToken, currentUserId})
             })
             .catch((e) => setError(e.message || 'Ошибка загрузки'))
             .finally(() => setLoading(false));
-    }, [visible, accessToken]);
+    }, [visible, accessToken, reloadKey]);
 
     const idToEmail = React.useMemo(() => {
         const map: Record<number, string> = {};
@@ -95,6 +109,30 @@ const UserFilesPanel: React.FC<Props> = ({visible, accessToken, currentUserId})
         }
     };
 
+    const handleDownload = async (filePath: string) => {
+        setTransferFile(filePath);
+        try {
+            await downloadFile(filePath, accessToken);
+        } catch (e: any) {
+            alert('Ошибка скачивания файла: ' + (e?.message || e));
+        } finally {
+            setTransferFile(null);
+        }
+    };
+
+    const handleUpload = async (filePath: string, file: File | undefined) => {
+        if (!file) return;
+        setTransferFile(filePath);
+        try {
+            await uploadFile(filePath, file, accessToken);
+            setReloadKey((key) => key + 1);
+        } catch (e: any) {
+            alert('Ошибка загрузки файла: ' + (e?.message || e));
+        } finally {
+            setTransferFile(null);
+        }
+    };
+
     const handleBack = () => {
         setOpenFile(null);
         setCollaboraUrl(null);
@@ -180,7 +218,7 @@ const UserFilesPanel: React.FC<Props> = ({visible, accessToken, currentUserId})
                                             borderLeft: '1px solid #b36af7',
                                         }}
                                     >
-                                        Могу редактировать / Права
+                                        Могу редактировать / Файл / Права
                                     </th>
                                 </tr>
                                 </thead>
@@ -211,7 +249,7 @@ const UserFilesPanel: React.FC<Props> = ({visible, accessToken, currentUserId})
                                             {f.Size ? (f.Size / 1024).toFixed(1) + ' КБ' : '—'}
                                         </td>
                                         <td style={{padding: '6px 4px', textAlign: 'center'}}>
-                                            {idToEmail[f.OwnerId] || f.OwnerId}
+                                            {f.OwnerId === null ? '—' : idToEmail[f.OwnerId] || f.OwnerId}
                                         </td>
                                         <td
                                             style={{
@@ -226,6 +264,28 @@ const UserFilesPanel: React.FC<Props> = ({visible, accessToken, currentUserId})
                                             }}
                                         >
                                             {f.UserCanWrite ? '✅' : '🔒'}
+                                            <button
+                                                style={transferButtonStyle}
+                                                title="Скачать файл"
+                                                disabled={transferFile === f.FilePath}
+                                                onClick={() => handleDownload(f.FilePath)}
+                                            >
+                                                ⬇
+                                            </button>
+                                            {f.UserCanWrite && (
+                                                <label style={transferButtonStyle} title="Загрузить новое содержимое">
+                                                    ⬆
+                                                    <input
+                                                        type="file"
+                                                        style={{display: 'none'}}
+                                                        disabled={transferFile === f.FilePath}
+                                                        onChange={(e) => {
+                                                            handleUpload(f.FilePath, e.target.files?.[0]);
+                                                            e.target.value = '';
+                                                        }}
+                                                    />
+                                                </label>
+                                            )}
                                             {f.OwnerId === currentUserId && (
                                                 <button
                                                     style={{